@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import fcntl
+import os
+
+import bob.io.base
+import bob.bio.base
+
+from ..preprocessor.StageCache import StageCache, content_hash, read_hashed, object_hash
+from ..preprocessor.Journal import atomic_write
+from bob.bio.base.algorithm import Algorithm
+
+class CachedAlgorithm (Algorithm):
+  """Runs the given algorithm, but takes projected features, enrolled models and scores from a :py:class:`bob.bio.face.preprocessor.StageCache`, when they have already been computed from the same input with the same configuration.
+
+  Together with :py:class:`bob.bio.face.preprocessor.CachedPreprocessor` and :py:class:`bob.bio.face.extractor.CachedExtractor`, this allows to recompute experiments incrementally.
+  Each artifact is keyed by the configuration of its stage, the content of the trained projector and enroller files and the content of its inputs.
+  The trained projector and enroller files are cached, too, keyed by the configuration and the content of the training features, so that unchanged training steps are not repeated and do not invalidate the artifacts that depend on them.
+  When a parameter of a stage changes, all artifacts of this stage and all artifacts that depend on them obtain new keys and are recomputed, while all other artifacts are taken from the cache.
+  When new images are added to a database, only the features of the new images, the models enrolled from them and the scores that include them are computed.
+
+  Scores are stored per model in a ``.scores`` text file in the cache directory, which contains one line with the key of the probe and the score for each probe that was compared to the model.
+  The lines are appended under a lock, so that parallel jobs can score the same model, and incomplete lines of interrupted jobs are skipped.
+  The keys of probes that are read by :py:meth:`read_feature`, :py:meth:`read_probe` or by :py:meth:`bob.bio.face.extractor.CachedExtractor.read_feature` are computed only once per probe file, see :py:func:`bob.bio.face.preprocessor.read_hashed`.
+
+  **Parameters:**
+
+  algorithm : str or :py:class:`bob.bio.base.algorithm.Algorithm`
+    The algorithm to run, or the name of a registered algorithm resource.
+
+  cache_directory : str
+    The directory of the :py:class:`bob.bio.face.preprocessor.StageCache`.
+
+  max_size : int or ``None``
+    The maximum size of the cache directory in bytes.
+  """
+
+  def __init__(
+      self,
+      algorithm,
+      cache_directory,
+      max_size = None
+  ):
+    self.algorithm = bob.bio.base.load_resource(algorithm, 'algorithm') if isinstance(algorithm, str) else algorithm
+
+    # call base class constructor with its set of parameters
+    # the score fusion of multiple models and probes is handled by the wrapped algorithm
+    Algorithm.__init__(
+        self,
+        performs_projection = self.algorithm.performs_projection,
+        requires_projector_training = self.algorithm.requires_projector_training,
+        split_training_features_by_client = self.algorithm.split_training_features_by_client,
+        use_projected_features_for_enrollment = self.algorithm.use_projected_features_for_enrollment,
+        requires_enroller_training = self.algorithm.requires_enroller_training,
+        algorithm = algorithm,
+        cache_directory = cache_directory,
+        max_size = max_size,
+        multiple_model_scoring = None,
+        multiple_probe_scoring = None
+    )
+
+    self.cache = StageCache(cache_directory, max_size)
+    # the configuration of the algorithm, including the trained projector and enroller
+    self._config = {'algorithm' : self.algorithm}
+    # the last model with its key and its scores
+    self._model = (None, None, None)
+
+
+  def _load(self, name, filename):
+    """Adds the content of the given file to the configuration of the algorithm."""
+    with open(filename, 'rb') as f:
+      self._config[name] = content_hash(f.read())
+
+
+  def train_projector(self, training_features, projector_file):
+    """Restores the cached projector that was trained with the same configuration and training features, or trains the projector of the ``algorithm`` given in the constructor and stores it in the cache."""
+    key = content_hash('train_projector', self._config, training_features)
+    self.cache.cached_file(key, projector_file, lambda filename : self.algorithm.train_projector(training_features, filename))
+
+
+  def load_projector(self, projector_file):
+    """Loads the projector of the ``algorithm`` given in the constructor, and adds the content of the ``projector_file`` to the cache keys."""
+    if self.requires_projector_training:
+      self._load('projector', projector_file)
+    return self.algorithm.load_projector(projector_file)
+
+
+  def train_enroller(self, training_features, enroller_file):
+    """Restores the cached enroller that was trained with the same configuration (including the projector) and training features, or trains the enroller of the ``algorithm`` given in the constructor and stores it in the cache."""
+    key = content_hash('train_enroller', self._config, training_features)
+    self.cache.cached_file(key, enroller_file, lambda filename : self.algorithm.train_enroller(training_features, filename))
+
+
+  def load_enroller(self, enroller_file):
+    """Loads the enroller of the ``algorithm`` given in the constructor, and adds the content of the ``enroller_file`` to the cache keys."""
+    if self.requires_enroller_training:
+      self._load('enroller', enroller_file)
+    return self.algorithm.load_enroller(enroller_file)
+
+
+  def project(self, feature):
+    """project(feature) -> projected
+
+    Returns the cached projected feature, or projects the feature using the ``algorithm`` given in the constructor and stores it in the cache.
+    """
+    key = content_hash('project', self._config, feature)
+    projected = self.cache.read(key, self.algorithm.read_feature)
+    if projected is None:
+      projected = self.algorithm.project(feature)
+      self.cache.write(key, projected, self.algorithm.write_feature)
+    return projected
+
+
+  def enroll(self, enroll_features):
+    """enroll(enroll_features) -> model
+
+    Returns the cached model, or enrolls the model from the given features using the ``algorithm`` given in the constructor and stores it in the cache.
+    """
+    key = content_hash('enroll', self._config, enroll_features)
+    model = self.cache.read(key, self.algorithm.read_model)
+    if model is None:
+      model = self.algorithm.enroll(enroll_features)
+      self.cache.write(key, model, self.algorithm.write_model)
+    return model
+
+
+  def _scores(self, model):
+    """Returns the key of the given model and the scores of all probes that are already cached for it."""
+    if self._model[0] is not model:
+      key = content_hash('score', self._config, model)
+      scores = {}
+      filename = self.cache.filename(key, ".scores")
+      if os.path.exists(filename):
+        with open(filename) as f:
+          for line in f:
+            splits = line.split()
+            # ignore incomplete lines, which might have been written by an interrupted process
+            if line.endswith('\n') and len(splits) == 2 and len(splits[0]) == len(key):
+              try:
+                scores[splits[0]] = float(splits[1])
+              except ValueError:
+                pass
+        os.utime(filename, None)
+      self._model = (model, key, scores)
+    return self._model[1:]
+
+
+  def _score(self, model, probe, function):
+    """Returns the cached score between the model and the probe, or computes it using the given scoring function."""
+    model_key, scores = self._scores(model)
+    probe_key = object_hash(probe)
+    if probe_key in scores:
+      self.cache.hits += 1
+      return scores[probe_key]
+    self.cache.misses += 1
+    score = function(model, probe)
+    scores[probe_key] = score
+    filename = self.cache.filename(model_key, ".scores")
+    bob.io.base.create_directories_safe(os.path.dirname(filename))
+    with open(filename, 'a+b') as f:
+      fcntl.lockf(f, fcntl.LOCK_EX)
+      try:
+        f.seek(0, os.SEEK_END)
+        if f.tell():
+          # invalidate and terminate the incomplete line of an interrupted process, so that it is skipped
+          f.seek(-1, os.SEEK_END)
+          if f.read(1) != b'\n':
+            f.write(b'!\n')
+        f.write(("%s %r\n" % (probe_key, float(score))).encode('utf-8'))
+        f.flush()
+      finally:
+        fcntl.lockf(f, fcntl.LOCK_UN)
+    return score
+
+
+  def score(self, model, probe):
+    """score(model, probe) -> score
+
+    Returns the cached score, or computes the score using the ``algorithm`` given in the constructor and stores it in the cache.
+    """
+    return self._score(model, probe, self.algorithm.score)
+
+
+  def score_for_multiple_models(self, models, probe):
+    """Computes the score for several models using the ``algorithm`` given in the constructor."""
+    return self.algorithm.score_for_multiple_models(models, probe)
+
+
+  def score_for_multiple_probes(self, model, probes):
+    """score_for_multiple_probes(model, probes) -> score
+
+    Returns the cached score, or computes the score for several probes using the ``algorithm`` given in the constructor and stores it in the cache.
+    """
+    return self._score(model, probes, self.algorithm.score_for_multiple_probes)
+
+
+  def write_feature(self, feature, feature_file):
+    """Writes the projected feature atomically using the ``algorithm`` given in the constructor."""
+    atomic_write(self.algorithm.write_feature, feature, feature_file)
+
+
+  def read_feature(self, feature_file):
+    """Reads the projected feature using the ``algorithm`` given in the constructor, and remembers its hash for scoring."""
+    return read_hashed(feature_file, self.algorithm.read_feature)
+
+
+  def write_model(self, model, model_file):
+    """Writes the model atomically using the ``algorithm`` given in the constructor."""
+    atomic_write(self.algorithm.write_model, model, model_file)
+
+
+  def read_model(self, model_file):
+    """Reads the model using the ``algorithm`` given in the constructor."""
+    return self.algorithm.read_model(model_file)
+
+
+  def read_probe(self, probe_file):
+    """Reads the probe using the ``algorithm`` given in the constructor, and remembers its hash for scoring."""
+    return read_hashed(probe_file, self.algorithm.read_probe)
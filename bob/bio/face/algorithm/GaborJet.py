@@ -8,6 +8,7 @@ import bob.io.base
 import numpy
 import math
 
+from ..extractor.GaborEngine import gabor_engine
 from bob.bio.base.algorithm import Algorithm
 
 class GaborJet (Algorithm):
@@ -73,8 +74,8 @@ class GaborJet (Algorithm):
         multiple_probe_scoring = None
     )
 
-    # the Gabor wavelet transform; used by (some of) the Gabor jet similarities
-    gwt = bob.ip.gabor.Transform(
+    # the Gabor wavelet transform shared with the extractors; used by (some of) the Gabor jet similarities
+    gwt = gabor_engine(
         number_of_scales = gabor_scales,
         number_of_directions = gabor_directions,
         sigma = gabor_sigma,
@@ -82,7 +83,7 @@ class GaborJet (Algorithm):
         k_fac = gabor_frequency_step,
         power_of_k = gabor_power_of_k,
         dc_free = gabor_dc_free
-    )
+    ).gwt
 
     # jet comparison function
     self.similarity_function = bob.ip.gabor.Similarity(gabor_jet_similarity_type, gwt)
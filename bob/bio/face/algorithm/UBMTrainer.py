@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import numpy
+
+import bob.core
+import bob.learn.em
+
+import logging
+logger = logging.getLogger("bob.bio.face")
+
+class UBMTrainer:
+  """Trains a Gaussian mixture model as universal background model (UBM) by streaming the features of a :py:class:`bob.bio.face.extractor.FeatureMatrix`.
+
+  The UBM is trained as in the ``'gmm'`` algorithm of ``bob.bio.gmm``, using the :py:class:`bob.learn.em.KMeansTrainer` for the initialization and the :py:class:`bob.learn.em.ML_GMMTrainer` for the refinement of means, variances and weights.
+  The training loop is the one of :py:func:`bob.learn.em.train`, but the E-step of each iteration is one pass over :py:meth:`bob.bio.face.extractor.FeatureMatrix.iterate`, where the statistics of the chunks are summed up before the M-step.
+  Hence, the UBM can be trained from the DCT blocks of large training sets, which do not fit into memory as ``float64`` arrays.
+
+  The k-means means are initialized from the rows of the selected features, if they fit into a single chunk, and from ``chunk_size`` randomly selected rows otherwise.
+  In the former case, the trained UBM is identical to the one of ``bob.bio.gmm``.
+
+  The trained UBM is a :py:class:`bob.learn.em.GMMMachine`.
+  When it is saved into the projector file, it can be loaded by the ``'gmm'`` algorithm, and ``--skip-projector-training`` can be used.
+
+  **Parameters:**
+
+  number_of_gaussians : int
+    The number of Gaussians of the UBM.
+
+  kmeans_training_iterations : int
+    The maximum number of k-means iterations.
+
+  gmm_training_iterations : int
+    The maximum number of maximum likelihood iterations.
+
+  training_threshold : float
+    The relative change of the average distance (k-means) or the average log-likelihood (maximum likelihood), below which the training is stopped.
+
+  variance_threshold : float
+    The variance thresholds of the UBM, see :py:meth:`bob.learn.em.GMMMachine.set_variance_thresholds`.
+
+  chunk_size : int
+    The number of feature rows that are processed at once; memory usage is about ``chunk_size * number_of_gaussians`` floats.
+
+  seed : int
+    The seed of the random number generators, which select the rows to initialize the k-means means.
+  """
+
+  def __init__(
+      self,
+      number_of_gaussians,
+      kmeans_training_iterations = 25,
+      gmm_training_iterations = 25,
+      training_threshold = 5e-4,
+      variance_threshold = 5e-4,
+      chunk_size = 10000,
+      seed = 5489
+  ):
+    self.number_of_gaussians = number_of_gaussians
+    self.kmeans_training_iterations = kmeans_training_iterations
+    self.gmm_training_iterations = gmm_training_iterations
+    self.training_threshold = training_threshold
+    self.variance_threshold = variance_threshold
+    self.chunk_size = chunk_size
+    self.seed = seed
+
+
+  def _sample(self, matrix, keys):
+    """Returns all rows of the selected features in storage order, if they fit into one chunk, or ``chunk_size`` randomly selected rows."""
+    # the same order of rows as in FeatureMatrix.iterate
+    ranges = sorted(matrix.index[key] for key in matrix.keys()) if keys is None else [matrix.index[key] for key in keys]
+    offsets = numpy.cumsum([0] + [stop - start for start, stop in ranges])
+    if offsets[-1] < self.number_of_gaussians:
+      raise ValueError("There are only %d feature rows to train %d Gaussians" % (offsets[-1], self.number_of_gaussians))
+    if offsets[-1] <= self.chunk_size:
+      selected = numpy.arange(offsets[-1])
+    else:
+      selected = numpy.sort(numpy.random.RandomState(self.seed).choice(offsets[-1], self.chunk_size, replace = False))
+    feature = numpy.searchsorted(offsets, selected, side = 'right') - 1
+    rows = numpy.array([ranges[f][0] for f in feature]) + selected - offsets[feature]
+    return numpy.array(matrix.matrix()[rows], numpy.float64)
+
+
+  def _train(self, trainer, machine, e_step, max_iterations):
+    """Runs the training loop of :py:func:`bob.learn.em.train`, using the given streamed E-step."""
+    average_output = e_step()
+    for iteration in range(max_iterations):
+      average_output_previous = average_output
+      trainer.m_step(machine)
+      average_output = e_step()
+      logger.debug("Iteration %d: average output %f", iteration, average_output)
+      if abs((average_output_previous - average_output) / average_output_previous) <= self.training_threshold:
+        break
+
+
+  def _kmeans_e_step(self, trainer, kmeans, matrix, keys):
+    """Sums up the k-means statistics of all chunks in the trainer, and returns the average distance."""
+    zeroeth, first, distance, count = 0., 0., 0., 0
+    for chunk in matrix.iterate(keys, self.chunk_size):
+      trainer.reset_accumulators(kmeans)
+      trainer.e_step(kmeans, chunk)
+      zeroeth = zeroeth + trainer.zeroeth_order_statistics
+      first = first + trainer.first_order_statistics
+      distance += trainer.average_min_distance * len(chunk)
+      count += len(chunk)
+    trainer.zeroeth_order_statistics = zeroeth
+    trainer.first_order_statistics = first
+    trainer.average_min_distance = distance / count
+    return trainer.compute_likelihood(kmeans)
+
+
+  def _gmm_e_step(self, trainer, ubm, matrix, keys):
+    """Sums up the GMM statistics of all chunks in the trainer, and returns the average log-likelihood."""
+    statistics = bob.learn.em.GMMStats(self.number_of_gaussians, matrix.dimension)
+    for chunk in matrix.iterate(keys, self.chunk_size):
+      trainer.e_step(ubm, chunk)
+      statistics += trainer.gmm_statistics
+    trainer.gmm_statistics = statistics
+    return trainer.compute_likelihood(ubm)
+
+
+  def train(self, matrix, keys = None):
+    """train(matrix, keys = None) -> ubm
+
+    Trains the UBM from the rows of the given features.
+
+    **Parameters:**
+
+    matrix : :py:class:`bob.bio.face.extractor.FeatureMatrix`
+      The matrix that contains the training features.
+
+    keys : [str] or ``None``
+      The keys of the training features in the ``matrix``; if ``None``, all features are used.
+
+    **Returns:**
+
+    ubm : :py:class:`bob.learn.em.GMMMachine`
+      The trained UBM.
+    """
+    # k-means clustering
+    kmeans = bob.learn.em.KMeansMachine(self.number_of_gaussians, matrix.dimension)
+    kmeans_trainer = bob.learn.em.KMeansTrainer()
+    kmeans_trainer.initialize(kmeans, self._sample(matrix, keys), bob.core.random.mt19937(self.seed))
+    self._train(kmeans_trainer, kmeans, lambda: self._kmeans_e_step(kmeans_trainer, kmeans, matrix, keys), self.kmeans_training_iterations)
+
+    # the variances and weights of the clusters
+    variances = numpy.zeros((self.number_of_gaussians, matrix.dimension))
+    weights = numpy.zeros(self.number_of_gaussians)
+    kmeans.__get_variances_and_weights_for_each_cluster_init__(variances, weights)
+    for chunk in matrix.iterate(keys, self.chunk_size):
+      kmeans.__get_variances_and_weights_for_each_cluster_acc__(chunk, variances, weights)
+    kmeans.__get_variances_and_weights_for_each_cluster_fin__(variances, weights)
+
+    # maximum likelihood training of the UBM
+    ubm = bob.learn.em.GMMMachine(self.number_of_gaussians, matrix.dimension)
+    ubm.means = kmeans.means
+    ubm.variances = variances
+    ubm.weights = weights
+    ubm.set_variance_thresholds(self.variance_threshold)
+    gmm_trainer = bob.learn.em.ML_GMMTrainer(True, True, True)
+    gmm_trainer.initialize(ubm)
+    self._train(gmm_trainer, ubm, lambda: self._gmm_e_step(gmm_trainer, ubm, matrix, keys), self.gmm_training_iterations)
+    return ubm
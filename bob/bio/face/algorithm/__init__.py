@@ -1,5 +1,8 @@
 from .GaborJet import GaborJet
 from .Histogram import Histogram
+from .UBMTrainer import UBMTrainer
+
+from .CachedAlgorithm import CachedAlgorithm
 
 # gets sphinx autodoc done right - don't remove it
 __all__ = [_ for _ in dir() if not _.startswith('_')]
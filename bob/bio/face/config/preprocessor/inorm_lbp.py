@@ -1,17 +1,18 @@
 import bob.bio.face
 import numpy
 
+# LBP codes with 8 neighbors fit into uint8; extractors convert them to float when required
 preprocessor = bob.bio.face.preprocessor.INormLBP(
   face_cropper = 'face-crop-eyes',
-  dtype = numpy.float64
+  dtype = numpy.uint8
 )
 
 preprocessor_landmark = bob.bio.face.preprocessor.INormLBP(
   face_cropper = 'landmark-detect',
-  dtype = numpy.float64
+  dtype = numpy.uint8
 )
 
 preprocessor_no_crop = bob.bio.face.preprocessor.INormLBP(
   face_cropper = None,
-  dtype = numpy.float64
+  dtype = numpy.uint8
 )
@@ -0,0 +1,7 @@
+import bob.bio.face
+
+# face crop and all photometric enhancements, computed in one pass
+preprocessor = bob.bio.face.preprocessor.PhotometricVariants(
+  face_cropper = 'face-crop-eyes',
+  variants = ('tan-triggs', 'self-quotient', 'histogram', 'inorm-lbp')
+)
@@ -0,0 +1,6 @@
+import bob.bio.face
+
+# face crop and Tan&Triggs, run as one fused pipeline
+preprocessor = bob.bio.face.preprocessor.Pipeline(
+  stages = ['face-crop-eyes', 'tan-triggs']
+)
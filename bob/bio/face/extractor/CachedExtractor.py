@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import bob.bio.base
+
+from ..preprocessor.StageCache import StageCache, content_hash, read_hashed
+from ..preprocessor.Journal import atomic_write
+from bob.bio.base.extractor import Extractor
+
+class CachedExtractor (Extractor):
+  """Runs the given extractor, but takes the features from a :py:class:`bob.bio.face.preprocessor.StageCache` when the same data has already been processed with the same configuration.
+
+  The cache key is computed by :py:func:`bob.bio.face.preprocessor.content_hash` from the constructor parameters of the ``extractor`` and the content of the preprocessed data.
+  For extractors that require training, the content of the extractor file loaded by :py:meth:`load` is part of the key, too; the extractor file itself is cached by :py:meth:`train`.
+  Hence, features are re-used by all experiments that share the ``cache_directory``, independent of their ``--sub-directory``.
+
+  **Parameters:**
+
+  extractor : str or :py:class:`bob.bio.base.extractor.Extractor`
+    The extractor to run, or the name of a registered extractor resource.
+
+  cache_directory : str
+    The directory of the :py:class:`bob.bio.face.preprocessor.StageCache`.
+
+  max_size : int or ``None``
+    The maximum size of the cache directory in bytes.
+  """
+
+  def __init__(
+      self,
+      extractor,
+      cache_directory,
+      max_size = None
+  ):
+    self.extractor = bob.bio.base.load_resource(extractor, 'extractor') if isinstance(extractor, str) else extractor
+
+    # call base class constructor with its set of parameters
+    Extractor.__init__(
+        self,
+        requires_training = self.extractor.requires_training,
+        split_training_data_by_client = self.extractor.split_training_data_by_client,
+        extractor = extractor,
+        cache_directory = cache_directory,
+        max_size = max_size
+    )
+
+    self.cache = StageCache(cache_directory, max_size)
+    # the configuration of the extractor, including the trained model
+    self._config = [self.extractor]
+
+
+  def __call__(self, data):
+    """__call__(data) -> feature
+
+    Returns the cached feature, or extracts the feature using the ``extractor`` given in the constructor and stores it in the cache.
+
+    **Parameters:**
+
+    data : object
+      The preprocessed data.
+
+    **Returns:**
+
+    feature : object
+      The extracted feature.
+    """
+    key = content_hash(self._config, data)
+    feature = self.cache.read(key, self.extractor.read_feature)
+    if feature is None:
+      feature = self.extractor(data)
+      self.cache.write(key, feature, self.extractor.write_feature)
+    return feature
+
+
+  def train(self, training_data, extractor_file):
+    """Restores the cached extractor file that was trained with the same configuration and training data, or trains the ``extractor`` given in the constructor and stores the extractor file in the cache."""
+    key = content_hash('train', self._config, training_data)
+    self.cache.cached_file(key, extractor_file, lambda filename : self.extractor.train(training_data, filename))
+
+
+  def load(self, extractor_file):
+    """Loads the ``extractor`` given in the constructor, and adds the content of the ``extractor_file`` to the cache key."""
+    with open(extractor_file, 'rb') as f:
+      self._config = [self.extractor, content_hash(f.read())]
+    return self.extractor.load(extractor_file)
+
+
+  def write_feature(self, feature, feature_file):
+    """Writes the feature atomically using the ``extractor`` given in the constructor."""
+    atomic_write(self.extractor.write_feature, feature, feature_file)
+
+
+  def read_feature(self, feature_file):
+    """Reads the feature using the ``extractor`` given in the constructor, and remembers its hash for the :py:class:`bob.bio.face.algorithm.CachedAlgorithm`, see :py:func:`bob.bio.face.preprocessor.read_hashed`."""
+    return read_hashed(feature_file, self.extractor.read_feature)
@@ -6,9 +6,68 @@
 
 import bob.ip.base
 import numpy
+import os
 
+from .FeatureMatrix import FeatureMatrix
+from ..preprocessor.Journal import atomic_write, write_marker
 from bob.bio.base.extractor import Extractor
 
+# the epsilon that bob.ip.base.DCTFeatures uses to detect constant blocks and coefficients
+_EPSILON = 10. * numpy.finfo(numpy.float64).eps
+
+
+def _zigzag(shape, count):
+  """Returns the (y, x) positions of the first ``count`` DCT coefficients of a block of the given shape in zigzag order, as used by :py:class:`bob.ip.base.DCTFeatures`."""
+  height, width = shape
+  positions = []
+  diagonal = 0
+  while len(positions) < count:
+    # the diagonals are traversed in alternating directions, starting from the top right
+    diagonal_positions = [(y, diagonal - y) for y in range(min(diagonal, height - 1), -1, -1) if diagonal - y < width]
+    if diagonal % 2:
+      diagonal_positions.reverse()
+    positions.extend(diagonal_positions)
+    diagonal += 1
+  return positions[:count]
+
+
+def _dct_matrix(size):
+  """Returns the orthonormal DCT-II matrix of the given size, where the first index is the frequency."""
+  frequencies = numpy.arange(size)[:, None]
+  matrix = numpy.cos(numpy.pi * (2. * numpy.arange(size)[None, :] + 1.) * frequencies / (2. * size)) * numpy.sqrt(2. / size)
+  matrix[0] /= numpy.sqrt(2.)
+  return matrix
+
+
+def _blocks(images, block_size, step):
+  """Returns a view of all (overlapping) blocks of the given stack of images with shape ``(N, blocks_y, blocks_x, block_height, block_width)``, without copying the data."""
+  images = numpy.ascontiguousarray(images)
+  count = [(images.shape[i+1] - block_size[i]) // step[i] + 1 for i in (0, 1)]
+  strides = images.strides
+  return numpy.lib.stride_tricks.as_strided(
+      images,
+      shape = (images.shape[0], count[0], count[1], block_size[0], block_size[1]),
+      strides = (strides[0], strides[1] * step[0], strides[2] * step[1], strides[1], strides[2])
+  )
+
+
+def _sliding(array, axis, size, step):
+  """Returns a view of the given array, where the given axis is split into (overlapping) windows of the given size and step; the window axis is appended as the last axis."""
+  shape, strides = list(array.shape), list(array.strides)
+  shape[axis] = (shape[axis] - size) // step + 1
+  strides[axis] *= step
+  return numpy.lib.stride_tricks.as_strided(array, shape = shape + [size], strides = strides + [array.strides[axis]])
+
+
+def _normalize(values, axis):
+  """Normalizes the given values in-place to zero mean and unit standard deviation along the given axis, leaving (almost) constant values unscaled."""
+  values -= values.mean(axis = axis, keepdims = True)
+  std = numpy.sqrt((values ** 2).mean(axis = axis, keepdims = True))
+  std[std ** 2 < _EPSILON] = 1.
+  values /= std
+  return values
+
+
 class DCTBlocks (Extractor):
 
   """Extracts *Discrete Cosine Transform* (DCT) features from (overlapping) image blocks.
@@ -38,6 +97,12 @@ class DCTBlocks (Extractor):
 
   normalize_dcts : bool
     Normalize the values of the DCT components to zero mean and unit standard deviation. Default is ``True``.
+
+  feature_matrix : str or ``None``
+    If given, the features are not written into one HDF5 file each, but appended as ``float32`` rows to a :py:class:`FeatureMatrix` in this directory.
+    The name of the feature file serves as the key in the matrix, so that the features can be read with the usual file names, and a marker file that names the rows of the feature is written in place of the feature file.
+    Since the features are stored as ``float32``, the features that are read back differ from the extracted ``float64`` features by the rounding to single precision, i.e., by a relative error of about ``6e-8``.
+    The matrix can be streamed for background model training, e.g., by the :py:class:`bob.bio.face.algorithm.UBMTrainer`.
   """
   def __init__(
       self,
@@ -46,7 +111,8 @@ class DCTBlocks (Extractor):
       number_of_dct_coefficients = 45,
       normalize_blocks = True,
       normalize_dcts = True,
-      auto_reduce_coefficients = False
+      auto_reduce_coefficients = False,
+      feature_matrix = None
   ):
 
     # call base class constructor
@@ -57,7 +123,8 @@ class DCTBlocks (Extractor):
         number_of_dct_coefficients = number_of_dct_coefficients,
         normalize_blocks = normalize_blocks,
         normalize_dcts = normalize_dcts,
-        auto_reduce_coefficients = auto_reduce_coefficients
+        auto_reduce_coefficients = auto_reduce_coefficients,
+        feature_matrix = feature_matrix
     )
 
     # block parameters
@@ -74,6 +141,24 @@ class DCTBlocks (Extractor):
 
     self.dct_features = bob.ip.base.DCTFeatures(number_of_dct_coefficients, block_size, block_overlap, normalize_blocks, normalize_dcts)
 
+    # the parameters and the zigzag-truncated DCT basis for the batch processing
+    self.block_size = tuple(block_size)
+    self.block_step = (block_size[0] - block_overlap[0], block_size[1] - block_overlap[1])
+    self.normalize_blocks = normalize_blocks
+    self.normalize_dcts = normalize_dcts
+    # the first (DC) coefficient is zero for normalized blocks, and it is removed
+    self.zigzag = _zigzag(self.block_size, number_of_dct_coefficients)[1 if normalize_blocks else 0:]
+    matrices = (_dct_matrix(block_size[0]), _dct_matrix(block_size[1]))
+    self.basis = numpy.array([numpy.outer(matrices[0][y], matrices[1][x]).ravel() for y, x in self.zigzag]).T
+    # for the separable transform: the required vertical frequencies, and for each of them the indices of the coefficients and the horizontal frequencies
+    self.dct_matrices = matrices
+    self._vertical = sorted(set(y for y, _ in self.zigzag))
+    self._horizontal = [[x for y, x in self.zigzag if y == v] for v in self._vertical]
+    # the order of the zigzag coefficients, when they are computed grouped by vertical frequency
+    self._order = numpy.argsort([i for v in self._vertical for i, (y, _) in enumerate(self.zigzag) if y == v], kind = 'mergesort')
+
+    self.feature_matrix = FeatureMatrix(feature_matrix, len(self.zigzag)) if feature_matrix is not None else None
+
   def __call__(self, image):
     """__call__(image) -> feature
 
@@ -81,8 +166,9 @@ class DCTBlocks (Extractor):
 
     **Parameters:**
 
-    image : 2D :py:class:`numpy.ndarray` (floats)
+    image : 2D :py:class:`numpy.ndarray` (floats or integers)
       The image to extract the features from.
+      Integer images, such as the ones produced by :py:class:`bob.bio.face.preprocessor.INormLBP`, are converted to floats.
 
     **Returns:**
 
@@ -92,11 +178,219 @@ class DCTBlocks (Extractor):
     """
     assert isinstance(image, numpy.ndarray)
     assert image.ndim == 2
-    assert image.dtype == numpy.float64
+    assert image.dtype == numpy.float64 or numpy.issubdtype(image.dtype, numpy.integer)
+    # integer images (e.g. LBP codes) are converted to float only here
+    image = image.astype(numpy.float64, copy = False)
 
     # Computes DCT features
     return self.dct_features(image)
 
+
+  def extract_batch(self, images, separable = None):
+    """extract_batch(images, separable = None) -> features
+
+    Computes the DCT blocks for a whole stack of equally sized images at once.
+
+    Two engines are available.
+    The direct engine gathers all blocks of all images into one matrix, and computes the DCT coefficients as a single matrix product with the zigzag-truncated DCT basis, which is precomputed in the constructor.
+    The separable engine exploits the overlap of the blocks: the vertical 1D DCTs are computed only once for each horizontal strip of the image, and shared by all blocks in that strip, before the horizontal 1D DCTs are applied to the sliding windows of the strip.
+    Only the frequencies that are required by the zigzag pattern are computed.
+    The block statistics for the normalization are computed from sliding window sums, so that the image blocks themselves are never gathered.
+
+    Both engines vectorize block and coefficient normalization.
+    The results are identical to the features computed by :py:meth:`__call__` for each image, up to numerical precision.
+
+    **Parameters:**
+
+    images : 3D :py:class:`numpy.ndarray` (floats or integers)
+      The stack of images to extract the features from.
+
+    separable : bool or ``None``
+      Select the separable (``True``) or the direct (``False``) engine.
+      By default, the separable engine is used when the blocks overlap.
+
+    **Returns:**
+
+    features : 3D :py:class:`numpy.ndarray` (floats)
+      The extracted DCT features, where the first index is the image, the second the block and the third the DCT coefficient.
+    """
+    images = numpy.asarray(images)
+    assert images.ndim == 3
+    images = images.astype(numpy.float64, copy = False)
+
+    if separable is None:
+      separable = self.block_step[0] < self.block_size[0] or self.block_step[1] < self.block_size[1]
+    features = self._separable_dct(images) if separable else self._direct_dct(images)
+
+    if self.normalize_dcts:
+      # normalize each coefficient over the blocks of each image
+      _normalize(features, axis = 1)
+    return features
+
+
+  def extract_chunks(self, images, chunk_size = 100000, stride = 1, fraction = None, seed = 0):
+    """extract_chunks(images, chunk_size = 100000, stride = 1, fraction = None, seed = 0) -> chunk
+
+    Extracts the DCT features of the given images, and yields them in chunks of bounded size, e.g., for training background models.
+
+    Only a subset of the blocks of each image can be selected, either deterministically by taking every ``stride``'th block, or randomly by selecting a ``fraction`` of the blocks using the given random ``seed``.
+    Only the DCT coefficients of the selected blocks are computed, so that the extraction time shrinks with the subsampling rate.
+
+    .. note::
+       When ``normalize_dcts`` is enabled, the coefficients are normalized with the statistics of the selected blocks of each image, which approximate the statistics of all blocks used by :py:meth:`__call__`.
+
+    **Parameters:**
+
+    images : iterable of 2D :py:class:`numpy.ndarray` (floats or integers)
+      The images to extract features from; might be a generator that reads the images one by one.
+
+    chunk_size : int
+      The number of feature rows in each yielded chunk; only the last chunk might be smaller.
+
+    stride : int
+      Select every ``stride``'th block of each image.
+
+    fraction : float or ``None``
+      If given, a random subset with this fraction of the blocks of each image is selected, after applying the ``stride``.
+
+    seed : int
+      The seed of the random number generator that selects the random blocks.
+
+    **Yields:**
+
+    chunk : 2D :py:class:`numpy.ndarray` (floats)
+      A chunk of DCT features, with one row per block.
+    """
+    generator = numpy.random.RandomState(seed)
+    pending, count = [], 0
+    for image in images:
+      image = numpy.asarray(image)
+      assert image.ndim == 2
+      image = image.astype(numpy.float64, copy = False)
+
+      # select the blocks of this image
+      blocks = _blocks(image[numpy.newaxis], self.block_size, self.block_step)[0]
+      indices = numpy.arange(0, blocks.shape[0] * blocks.shape[1], stride)
+      if fraction is not None:
+        indices = numpy.sort(generator.choice(indices, int(round(len(indices) * fraction)), replace = False))
+      if not len(indices):
+        continue
+
+      # gather and transform only the selected blocks
+      blocks = blocks[indices // blocks.shape[1], indices % blocks.shape[1]].reshape(len(indices), -1)
+      if self.normalize_blocks:
+        _normalize(blocks, axis = 1)
+      features = numpy.dot(blocks, self.basis)
+      if self.normalize_dcts:
+        _normalize(features, axis = 0)
+
+      # yield full chunks
+      pending.append(features)
+      count += len(features)
+      while count >= chunk_size:
+        features = numpy.concatenate(pending)
+        yield features[:chunk_size]
+        pending, count = [features[chunk_size:]], count - chunk_size
+    if count:
+      yield numpy.concatenate(pending)
+
+
+  def _direct_dct(self, images):
+    """Computes the DCT coefficients of all blocks by a matrix product of the gathered blocks with the DCT basis."""
+    # gather all blocks into a matrix with one flattened block per row
+    blocks = _blocks(images, self.block_size, self.block_step)
+    blocks = blocks.reshape(images.shape[0], -1, self.block_size[0] * self.block_size[1])
+    if self.normalize_blocks:
+      # reshaping usually copies the overlapping blocks, but it might return a view of the images
+      if numpy.may_share_memory(blocks, images):
+        blocks = blocks.copy()
+      _normalize(blocks, axis = 2)
+
+    # compute the selected DCT coefficients of all blocks at once
+    return numpy.dot(blocks, self.basis)
+
+
+  def _separable_dct(self, images):
+    """Computes the DCT coefficients of all blocks by separate vertical and horizontal 1D DCTs, sharing the vertical DCTs between overlapping blocks."""
+    height, width = self.block_size
+    strips = _sliding(numpy.ascontiguousarray(images), 1, height, self.block_step[0])
+
+    # vertical DCT of all strips, for the required vertical frequencies only
+    vertical = numpy.matmul(strips, self.dct_matrices[0][self._vertical].T)
+    windows = _sliding(numpy.ascontiguousarray(numpy.moveaxis(vertical, 3, 2)), 3, width, self.block_step[1])
+
+    # horizontal DCT of the sliding windows of each strip, for the required horizontal frequencies only
+    features = numpy.concatenate([
+        numpy.dot(windows[:,:,v].reshape(-1, width), self.dct_matrices[1][horizontal].T)
+        for v, horizontal in enumerate(self._horizontal)
+    ], axis = 1)[:, self._order]
+    features = features.reshape(images.shape[0], -1, len(self.zigzag))
+
+    if self.normalize_blocks:
+      # the DCT of a normalized block is the DCT of the block divided by its standard deviation, except for the removed DC coefficient
+      # the block statistics are computed from sliding window sums of the centered images, which keeps the rounding errors small
+      centered = images - images.mean(axis = (1,2), keepdims = True)
+      count = float(height * width)
+      means = _sliding(_sliding(centered, 1, height, self.block_step[0]).sum(axis = 3), 2, width, self.block_step[1]).sum(axis = 3) / count
+      squares = _sliding(_sliding(centered ** 2, 1, height, self.block_step[0]).sum(axis = 3), 2, width, self.block_step[1]).sum(axis = 3) / count
+      variances = squares - means ** 2
+      # blocks with a variance below the epsilon of bob.ip.base.DCTFeatures are not scaled
+      std = numpy.sqrt(numpy.maximum(variances, 0.))
+      std[variances < _EPSILON] = 1.
+      features /= std.reshape(images.shape[0], -1, 1)
+
+      # the rounding errors of the sliding sums and of the DCT of the unnormalized blocks are in the order of 1e-16 * squares
+      # hence, (almost) constant blocks are normalized and transformed directly, which applies the epsilon test of bob to their exact variances
+      uncertain = numpy.nonzero(variances < _EPSILON + 1e-12 * squares)
+      if len(uncertain[0]):
+        blocks = _blocks(images, self.block_size, self.block_step)[uncertain].reshape(-1, height * width)
+        features[uncertain[0], numpy.ravel_multi_index(uncertain[1:], variances.shape[1:])] = numpy.dot(_normalize(blocks, axis = 1), self.basis)
+
+    return features
+
+  def write_feature(self, feature, feature_file):
+    """write_feature(feature, feature_file) -> None
+
+    Writes the given feature to file, or appends it to the ``feature_matrix``, if one was selected in the constructor.
+    Files are written atomically, see :py:func:`bob.bio.face.preprocessor.atomic_write`.
+    In the latter case, a marker file is written to ``feature_file``, see :py:func:`bob.bio.face.preprocessor.write_marker`, so that the feature is not extracted again in later runs.
+
+    **Parameters:**
+
+    feature : 2D :py:class:`numpy.ndarray`
+      The extracted DCT features.
+
+    feature_file : str or :py:class:`bob.io.base.HDF5File`
+      The file to write the feature into, or the key of the feature in the ``feature_matrix``.
+    """
+    if self.feature_matrix is None:
+      if isinstance(feature_file, str):
+        return atomic_write(lambda data, filename : Extractor.write_feature(self, data, filename), feature, feature_file)
+      return Extractor.write_feature(self, feature, feature_file)
+    key = os.path.abspath(feature_file)
+    self.feature_matrix.write(key, feature)
+    write_marker(feature_file, "%d\t%d" % self.feature_matrix.index[key])
+
+
+  def read_feature(self, feature_file):
+    """read_feature(feature_file) -> feature
+
+    Reads the feature from file, or from the ``feature_matrix``, if one was selected in the constructor.
+
+    **Parameters:**
+
+    feature_file : str or :py:class:`bob.io.base.HDF5File`
+      The file to read the feature from, or the key of the feature in the ``feature_matrix``.
+
+    **Returns:**
+
+    feature : 2D :py:class:`numpy.ndarray` (floats)
+      The DCT features, converted to ``float64``; features read from the ``feature_matrix`` are rounded to ``float32`` precision.
+    """
+    if self.feature_matrix is None:
+      return Extractor.read_feature(self, feature_file)
+    return self.feature_matrix.read(os.path.abspath(feature_file)).astype(numpy.float64)
+
   # re-define the train function to get it non-documented
   def train(*args,**kwargs) : raise NotImplementedError("This function is not implemented and should not be called.")
   def load(*args,**kwargs) : pass
@@ -38,7 +38,7 @@ class Eigenface (Extractor):
     """Checks that the given data are appropriate."""
     assert isinstance(data, numpy.ndarray)
     assert data.ndim == 2
-    assert data.dtype == numpy.float64
+    assert data.dtype == numpy.float64 or numpy.issubdtype(data.dtype, numpy.integer)
 
 
   def train(self, training_images, extractor_file):
@@ -57,7 +57,7 @@ class Eigenface (Extractor):
     [self._check_data(image) for image in training_images]
 
     # Initializes an array for the data
-    data = numpy.vstack([image.flatten() for image in training_images])
+    data = numpy.vstack([image.flatten() for image in training_images]).astype(numpy.float64)
 
     logger.info("  -> Training LinearMachine using PCA (SVD)")
     t = bob.learn.linear.PCATrainer()
@@ -99,7 +99,7 @@ class Eigenface (Extractor):
 
     **Parameters:**
 
-    image : 2D :py:class:`numpy.ndarray` (floats)
+    image : 2D :py:class:`numpy.ndarray` (floats or integers)
       The image to extract the eigenface feature from.
 
     **Returns:**
@@ -109,4 +109,4 @@ class Eigenface (Extractor):
     """
     self._check_data(image)
     # Projects the data
-    return self.machine(image.flatten())
+    return self.machine(image.flatten().astype(numpy.float64))
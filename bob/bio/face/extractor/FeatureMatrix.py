@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import fcntl
+import os
+import numpy
+
+import bob.io.base
+
+class FeatureMatrix:
+  """Stores the rows of many 2D features, such as the DCT blocks of :py:class:`DCTBlocks`, in a single memory-mapped matrix.
+
+  The features of all files are appended to one binary matrix file ``features.bin``, which is stored in a compact data type (by default ``float32``).
+  An ``index`` text file records the range of rows of each feature.
+  Reading a feature returns a view into the memory-mapped matrix, without copying the data.
+  For training background models, all rows (or the rows of selected features) can be streamed in chunks of bounded size using :py:meth:`iterate`, without loading the matrix into memory; see :py:class:`bob.bio.face.algorithm.UBMTrainer`.
+
+  Several processes can write into the same ``directory`` at the same time: each write holds a lock on the ``lock`` file of the directory, and the rows written by other processes are read from the index before appending.
+
+  .. note::
+     When a feature is written again under the same key, its rows are overwritten in place.
+     Only when the number of rows has changed, the new rows are appended, and the old rows are no longer used.
+
+  **Parameters:**
+
+  directory : str
+    The directory, where the matrix and the index are stored.
+
+  dimension : int
+    The number of columns of the features, e.g., the number of DCT coefficients.
+
+  dtype : :py:class:`numpy.dtype` or convertible
+    The data type, in which the features are stored.
+  """
+
+  def __init__(self, directory, dimension, dtype = numpy.float32):
+    self.directory = directory
+    self.dimension = dimension
+    self.dtype = numpy.dtype(dtype)
+
+    # the range of rows of each key, and the part of the index file that has been read
+    self.index = {}
+    self.rows = 0
+    self._offset = 0
+    self._update_index()
+    self._matrix = None
+
+
+  def _update_index(self):
+    """Reads the lines that have been appended to the index file since the last call, possibly by other processes."""
+    if os.path.exists(self._filename('index')):
+      with open(self._filename('index'), 'rb') as f:
+        f.seek(self._offset)
+        for line in f:
+          # ignore incomplete lines, which might have been written by an interrupted process
+          if not line.endswith(b'\n'):
+            break
+          self._offset += len(line)
+          splits = line.decode('utf-8').rstrip('\n').rsplit('\t', 2)
+          # skip lines that have been terminated after an interruption, see write
+          if len(splits) == 3 and splits[1].isdigit() and splits[2].isdigit():
+            self.index[splits[0]] = (int(splits[1]), int(splits[2]))
+            self.rows = max(self.rows, int(splits[2]))
+
+
+  def _filename(self, name):
+    return os.path.join(self.directory, name)
+
+
+  def __contains__(self, key):
+    return key in self.index
+
+
+  def __len__(self):
+    return len(self.index)
+
+
+  def keys(self):
+    """keys() -> keys
+
+    Returns the keys of all stored features, including the features written by other processes.
+    """
+    self._update_index()
+    return self.index.keys()
+
+
+  def write(self, key, feature):
+    """write(key, feature) -> None
+
+    Appends the rows of the given feature to the matrix, or overwrites the rows of the feature with the same key.
+
+    **Parameters:**
+
+    key : str
+      The key of the feature, e.g., the name of the file that would otherwise be written.
+
+    feature : 2D :py:class:`numpy.ndarray`
+      The feature to store, with ``dimension`` columns.
+    """
+    feature = numpy.ascontiguousarray(feature, dtype = self.dtype)
+    if feature.ndim != 2 or feature.shape[1] != self.dimension:
+      raise ValueError("The feature shape %s does not fit to the dimension %d of this matrix" % (feature.shape, self.dimension))
+    bob.io.base.create_directories_safe(self.directory)
+    with open(self._filename('lock'), 'a') as lock:
+      fcntl.lockf(lock, fcntl.LOCK_EX)
+      try:
+        self._update_index()
+        start, stop = self.index.get(key, (0, -1))
+        if stop - start == feature.shape[0]:
+          # overwrite the rows of the existing feature
+          with open(self._filename('features.bin'), 'r+b') as f:
+            f.seek(start * self.dimension * self.dtype.itemsize)
+            feature.tofile(f)
+          return
+        # write the data first, and register it in the index afterward
+        with open(self._filename('features.bin'), 'ab') as f:
+          f.seek(self.rows * self.dimension * self.dtype.itemsize)
+          f.truncate()
+          feature.tofile(f)
+        start, stop = self.rows, self.rows + feature.shape[0]
+        with open(self._filename('index'), 'ab') as f:
+          if f.tell() > self._offset:
+            # terminate the incomplete line of an interrupted process, so that it is skipped
+            f.write(b'\t\n')
+          f.write(("%s\t%d\t%d\n" % (key, start, stop)).encode('utf-8'))
+        self._update_index()
+      finally:
+        fcntl.lockf(lock, fcntl.LOCK_UN)
+
+
+  def matrix(self):
+    """matrix() -> matrix
+
+    Returns the read-only memory-mapped matrix of all stored rows.
+
+    **Returns:**
+
+    matrix : 2D :py:class:`numpy.memmap`
+      The matrix with one row per block and ``dimension`` columns.
+    """
+    if self._matrix is None or self._matrix.shape[0] != self.rows:
+      self._matrix = numpy.memmap(self._filename('features.bin'), dtype = self.dtype, mode = 'r', shape = (self.rows, self.dimension)) if self.rows else numpy.empty((0, self.dimension), self.dtype)
+    return self._matrix
+
+
+  def read(self, key):
+    """read(key) -> feature
+
+    Returns the feature stored under the given key, as a read-only view into the memory-mapped matrix.
+
+    **Parameters:**
+
+    key : str
+      The key of the feature.
+
+    **Returns:**
+
+    feature : 2D :py:class:`numpy.ndarray`
+      The rows of the stored feature, which are not copied.
+    """
+    if key not in self.index:
+      # the feature might have been written by another process
+      self._update_index()
+    start, stop = self.index[key]
+    return self.matrix()[start:stop]
+
+
+  def iterate(self, keys = None, chunk_size = 100000):
+    """iterate(keys = None, chunk_size = 100000) -> chunk
+
+    Yields the rows of the selected features in chunks of at most ``chunk_size`` rows.
+
+    **Parameters:**
+
+    keys : [str] or ``None``
+      The keys of the features to iterate; if ``None``, the rows of all features are yielded in storage order.
+
+    chunk_size : int
+      The maximum number of rows per chunk.
+
+    **Yields:**
+
+    chunk : 2D :py:class:`numpy.ndarray`
+      A chunk of rows, converted to ``float64``.
+    """
+    self._update_index()
+    matrix = self.matrix()
+    ranges = sorted(self.index.values()) if keys is None else [self.index[key] for key in keys]
+    pending, count = [], 0
+    for start, stop in ranges:
+      while start < stop:
+        end = min(stop, start + chunk_size - count)
+        pending.append(matrix[start:end])
+        count += end - start
+        start = end
+        if count == chunk_size:
+          yield numpy.concatenate(pending).astype(numpy.float64)
+          pending, count = [], 0
+    if count:
+      yield numpy.concatenate(pending).astype(numpy.float64)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import collections
+import os
+import socket
+import time
+import numpy
+
+import bob.io.base
+import bob.ip.gabor
+
+from ..preprocessor.Journal import atomic_write, is_temporary_file
+
+# the kinds of features that can be stored
+_ARRAY, _JETS = 0, 1
+
+class FeatureShards:
+  """Stores many features of possibly varying size in a few compressed shard files.
+
+  Features are collected in memory and written in shards of ``shard_size`` features into compressed ``.npz`` files.
+  Inside a shard, all features are flattened and concatenated into a single array, and the ragged offsets and shapes of the features are stored alongside.
+  Besides arrays of any shape, such as the sparse histograms of :py:class:`LGBPHS` or the DCT coefficients of :py:class:`DCTBlocks`, lists of :py:class:`bob.ip.gabor.Jet` as extracted by :py:class:`GridGraph` are supported.
+
+  Features can be read by key, where the most recently read shards are kept in memory, or all features can be read sequentially shard by shard using :py:meth:`iterate`.
+
+  Each writing process writes its own shards, which are named after the host name and the process id, so that several processes can write into the same ``directory`` at the same time.
+  The shard files are written atomically, see :py:func:`bob.bio.face.preprocessor.atomic_write`.
+
+  .. note::
+     Features are only written to disk when a shard is full, or when :py:meth:`flush` is called.
+     When a feature is written again under the same key, the old feature stays in its shard, but the newest shard that contains the key is used for reading.
+
+  **Parameters:**
+
+  directory : str
+    The directory, where the shards are stored.
+
+  shard_size : int
+    The number of features stored in each shard.
+
+  cached_shards : int
+    The number of decompressed shards that are kept in memory when reading features by key.
+  """
+
+  def __init__(self, directory, shard_size = 1000, cached_shards = 8):
+    self.directory = directory
+    self.shard_size = shard_size
+    self.cached_shards = cached_shards
+
+    # the shard and the position inside the shard of each key, and the time when each shard was written
+    self.index = {}
+    self._written = {}
+    self._writer = None
+    self._shards = 0
+    self._pending = collections.OrderedDict()
+    self._cache = collections.OrderedDict()
+    self._load_index()
+
+
+  def _load_index(self):
+    """Reads the keys of all shards in the directory that are not yet known."""
+    if os.path.isdir(self.directory):
+      for filename in sorted(os.listdir(self.directory)):
+        # skip temporary files of shards that are currently written
+        if filename.startswith('shard-') and filename.endswith('.npz') and not is_temporary_file(filename):
+          shard = filename[:-len('.npz')]
+          if shard not in self._written:
+            with numpy.load(os.path.join(self.directory, filename)) as data:
+              self._written[shard] = float(data['written'])
+              for position, key in enumerate(data['keys']):
+                self._register(str(key), shard, position)
+
+
+  def _register(self, key, shard, position):
+    """Registers the given key in the index, unless it is stored in a newer shard already."""
+    if key in self.index:
+      current = self.index[key][0]
+      if (self._written[current], current) > (self._written[shard], shard):
+        return
+    self.index[key] = (shard, position)
+
+
+  def _filename(self, shard):
+    return os.path.join(self.directory, shard + '.npz')
+
+
+  def __contains__(self, key):
+    return key in self.index or key in self._pending
+
+
+  def __len__(self):
+    return len(self.index) + len(self._pending)
+
+
+  def write(self, key, feature):
+    """write(key, feature) -> written
+
+    Adds the given feature to the current shard, which is written to disk when it is full.
+    If a feature with the given key is already stored or pending, it is replaced.
+
+    **Parameters:**
+
+    key : str
+      The key of the feature, e.g., the name of the file that would otherwise be written.
+
+    feature : :py:class:`numpy.ndarray` or [:py:class:`bob.ip.gabor.Jet`]
+      The feature to store.
+
+    **Returns:**
+
+    written : [str]
+      The keys of the features that have been written to disk by this call, see :py:meth:`flush`.
+    """
+    self._pending[key] = feature
+    if len(self._pending) >= self.shard_size:
+      return self.flush()
+    return []
+
+
+  def flush(self):
+    """flush() -> written
+
+    Writes all pending features into a new shard of this process.
+
+    **Returns:**
+
+    written : [str]
+      The keys of the features that have been written to disk.
+    """
+    if not self._pending:
+      return []
+    keys, kinds, dtypes, shapes, arrays = [], [], [], [], []
+    for key, feature in self._pending.items():
+      if isinstance(feature, numpy.ndarray):
+        kind, array = _ARRAY, feature
+      else:
+        kind, array = _JETS, numpy.array([jet.complex for jet in feature])
+      keys.append(key)
+      kinds.append(kind)
+      dtypes.append(array.dtype.str)
+      shapes.append(array.shape)
+      arrays.append(array.ravel())
+
+    # store the ragged features as one array with offsets and (zero-padded) shapes
+    offsets = numpy.cumsum([0] + [len(array) for array in arrays])
+    dimensions = max(len(shape) for shape in shapes)
+    shape_array = numpy.zeros((len(shapes), dimensions + 1), numpy.int64)
+    for i, shape in enumerate(shapes):
+      shape_array[i, 0] = len(shape)
+      shape_array[i, 1:len(shape)+1] = shape
+
+    # the shards of this process follow the ones that were written with the same host name and process id before
+    writer = "%s-%d" % (socket.gethostname(), os.getpid())
+    if writer != self._writer:
+      self._writer, self._shards = writer, 0
+    while os.path.exists(self._filename('shard-%s-%05d' % (self._writer, self._shards))):
+      self._shards += 1
+    shard = 'shard-%s-%05d' % (self._writer, self._shards)
+
+    written = time.time()
+    atomic_write(lambda data, filename: numpy.savez_compressed(filename, **data), dict(
+        written = numpy.float64(written),
+        keys = numpy.array(keys),
+        kinds = numpy.array(kinds, numpy.uint8),
+        dtypes = numpy.array(dtypes),
+        shapes = shape_array,
+        offsets = offsets,
+        data = numpy.concatenate(arrays)
+    ), self._filename(shard))
+    self._written[shard] = written
+    for position, key in enumerate(keys):
+      self._register(key, shard, position)
+    self._shards += 1
+    self._pending = collections.OrderedDict()
+    return keys
+
+
+  def _load(self, shard):
+    """Loads the given shard into memory, keeping the ``cached_shards`` most recently loaded shards."""
+    if shard in self._cache:
+      data = self._cache.pop(shard)
+    else:
+      with numpy.load(self._filename(shard)) as loaded:
+        data = {name : loaded[name] for name in ('keys', 'kinds', 'dtypes', 'shapes', 'offsets', 'data')}
+    self._cache[shard] = data
+    while len(self._cache) > max(self.cached_shards, 1):
+      self._cache.popitem(last = False)
+    return data
+
+
+  def _feature(self, data, position):
+    """Extracts the feature at the given position from the given shard data."""
+    shape = tuple(data['shapes'][position, 1 : data['shapes'][position, 0] + 1])
+    array = data['data'][data['offsets'][position] : data['offsets'][position+1]].reshape(shape)
+    # features of different data types might have been concatenated into a common type
+    dtype = numpy.dtype(str(data['dtypes'][position]))
+    if numpy.iscomplexobj(array) and not numpy.issubdtype(dtype, numpy.complexfloating):
+      array = array.real
+    array = array.astype(dtype, copy = False)
+    if data['kinds'][position] == _JETS:
+      return [bob.ip.gabor.Jet(jet, False) for jet in array]
+    return array
+
+
+  def read(self, key):
+    """read(key) -> feature
+
+    Reads the feature with the given key.
+
+    **Parameters:**
+
+    key : str
+      The key of the feature.
+
+    **Returns:**
+
+    feature : :py:class:`numpy.ndarray` or [:py:class:`bob.ip.gabor.Jet`]
+      The stored feature.
+    """
+    if key in self._pending:
+      # the feature is not yet written
+      return self._pending[key]
+    if key not in self.index:
+      # the feature might have been written by another process
+      self._load_index()
+    shard, position = self.index[key]
+    return self._feature(self._load(shard), position)
+
+
+  def iterate(self):
+    """iterate() -> key, feature
+
+    Yields all stored features, reading one shard after the other with a single read operation each.
+
+    **Yields:**
+
+    key : str
+      The key of the feature.
+
+    feature : :py:class:`numpy.ndarray` or [:py:class:`bob.ip.gabor.Jet`]
+      The stored feature.
+    """
+    self._load_index()
+    for shard in sorted(set(shard for shard, _ in self.index.values())):
+      with numpy.load(self._filename(shard)) as data:
+        data = {name : data[name] for name in ('keys', 'kinds', 'dtypes', 'shapes', 'offsets', 'data')}
+      for position, key in enumerate(data['keys']):
+        # skip features that have been replaced in newer shards
+        if self.index[str(key)] == (shard, position):
+          yield str(key), self._feature(data, position)
+    for key, feature in self._pending.items():
+      yield key, feature
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import hashlib
+import math
+import multiprocessing.pool
+import os
+import threading
+
+import numpy
+
+import bob.ip.gabor
+
+from ..preprocessor.Journal import atomic_write
+
+# the engines and thread pools shared by all extractors and algorithms of this process
+_engines = {}
+_pools = {}
+_engines_lock = threading.Lock()
+# marks the threads that currently execute a task of map_wavelets, and keeps the objects that each thread needs for itself
+_worker = threading.local()
+# the number of wavelets that are multiplied and transformed at once by GaborEngine.transform
+_block_size = 8
+
+
+class GaborEngine:
+  """Performs Gabor wavelet transforms of batches of images, caching the wavelets in frequency domain for each image resolution.
+
+  The wavelets are generated by :py:class:`bob.ip.gabor.Transform` once per image resolution and kept in memory, so that images of alternating resolutions do not require re-generating the wavelets.
+  When a ``cache_directory`` is given, the wavelets are additionally stored on disk, and are loaded from there by other processes that use the same parameters.
+  Usually, the engine should not be created directly, but shared between all extractors and algorithms of the process using :py:func:`gabor_engine`.
+
+  **Parameters:**
+
+  number_of_scales, number_of_directions, sigma, k_max, k_fac, power_of_k, dc_free
+    The parameters of the Gabor wavelet family, see :py:class:`bob.ip.gabor.Transform`.
+
+  cache_directory : str or ``None``
+    If given, the wavelets in frequency domain are stored in and loaded from this directory.
+  """
+
+  def __init__(
+      self,
+      number_of_scales = 5,
+      number_of_directions = 8,
+      sigma = 2. * math.pi,
+      k_max = math.pi / 2.,
+      k_fac = math.sqrt(.5),
+      power_of_k = 0,
+      dc_free = True,
+      cache_directory = None
+  ):
+    self.parameters = (number_of_scales, number_of_directions, float(sigma), float(k_max), float(k_fac), float(power_of_k), bool(dc_free))
+    self.cache_directory = cache_directory
+
+    # the Gabor wavelet transform, which is also required by some of the Gabor jet similarity functions
+    self.gwt = bob.ip.gabor.Transform(
+        number_of_scales = number_of_scales,
+        number_of_directions = number_of_directions,
+        sigma = sigma,
+        k_max = k_max,
+        k_fac = k_fac,
+        power_of_k = power_of_k,
+        dc_free = dc_free
+    )
+    self.number_of_wavelets = self.gwt.number_of_wavelets
+
+    self._spectra = {}
+    self._lock = threading.Lock()
+
+
+  def _filename(self, shape):
+    """Returns the name of the file, in which the wavelets for the given resolution are stored."""
+    key = hashlib.sha1(repr(self.parameters).encode('utf-8')).hexdigest()
+    return os.path.join(self.cache_directory, "gabor-%s-%dx%d.npy" % (key, shape[0], shape[1]))
+
+
+  def spectra(self, shape):
+    """spectra(shape) -> wavelets
+
+    Returns the Gabor wavelets in frequency domain for images of the given resolution.
+
+    **Parameters:**
+
+    shape : (int, int)
+      The resolution ``(height, width)`` of the images.
+
+    **Returns:**
+
+    wavelets : 3D :py:class:`numpy.ndarray` (floats)
+      The wavelets in frequency domain, with one layer per wavelet; do not modify this array.
+    """
+    shape = tuple(int(s) for s in shape)
+    with self._lock:
+      if shape not in self._spectra:
+        filename = self._filename(shape) if self.cache_directory is not None else None
+        if filename is not None and os.path.exists(filename):
+          wavelets = numpy.load(filename)
+        else:
+          self.gwt.generate_wavelets(shape[0], shape[1])
+          wavelets = numpy.array([wavelet.wavelet for wavelet in self.gwt.wavelets])
+          if filename is not None:
+            atomic_write(lambda data, name: numpy.save(name, data), wavelets, filename)
+        wavelets.flags.writeable = False
+        self._spectra[shape] = wavelets
+      return self._spectra[shape]
+
+
+  def transform(self, images, trafo_images = None, threads = 1):
+    """transform(images, [trafo_images], [threads]) -> trafo_images
+
+    Performs the Gabor wavelet transform of one image or a batch of images of the same resolution.
+    The results are identical to :py:meth:`bob.ip.gabor.Transform.transform` (up to numerical precision).
+
+    The inverse Fourier transforms of the wavelets can be split between several threads, which reduces the time to transform a single image on multi-core machines.
+    The results do not depend on the number of threads.
+    Each thread transforms blocks of a few wavelets at once, so that the temporary memory stays small compared to the transformed images.
+
+    **Parameters:**
+
+    images : 2D or 3D :py:class:`numpy.ndarray` (floats)
+      A single image, or a batch of images stacked in the first dimension.
+
+    trafo_images : 3D or 4D :py:class:`numpy.ndarray` (complex) or ``None``
+      If given, the transformed images are written into this array.
+
+    threads : int
+      The number of threads, see :py:func:`map_wavelets`.
+
+    **Returns:**
+
+    trafo_images : 3D or 4D :py:class:`numpy.ndarray` (complex)
+      The transformed images, with one layer per wavelet, and an additional first dimension for batches of images.
+    """
+    images = numpy.asarray(images, numpy.float64)
+    assert images.ndim in (2, 3)
+    spectra = self.spectra(images.shape[-2:])
+
+    frequencies = numpy.fft.fft2(images)[..., numpy.newaxis, :, :]
+    if trafo_images is None:
+      trafo_images = numpy.ndarray(images.shape[:-2] + spectra.shape, numpy.complex128)
+
+    def _inverse(wavelets):
+      # transform all images with a block of wavelets using a single call to the FFT, re-using the buffer of the products
+      products = numpy.ndarray(images.shape[:-2] + (min(_block_size, wavelets.stop - wavelets.start),) + spectra.shape[1:], numpy.complex128)
+      for start in range(wavelets.start, wavelets.stop, _block_size):
+        block = slice(start, min(start + _block_size, wavelets.stop))
+        product = numpy.multiply(frequencies, spectra[block], out = products[..., :block.stop - block.start, :, :])
+        trafo_images[..., block, :, :] = numpy.fft.ifft2(product)
+
+    map_wavelets(_inverse, len(spectra), threads)
+    return trafo_images
+
+
+def gabor_engine(
+    number_of_scales = 5,
+    number_of_directions = 8,
+    sigma = 2. * math.pi,
+    k_max = math.pi / 2.,
+    k_fac = math.sqrt(.5),
+    power_of_k = 0,
+    dc_free = True,
+    cache_directory = None
+):
+  """gabor_engine(number_of_scales = 5, number_of_directions = 8, sigma = 2. * math.pi, k_max = math.pi / 2., k_fac = math.sqrt(.5), power_of_k = 0, dc_free = True, cache_directory = None) -> engine
+
+  Returns the :py:class:`GaborEngine` with the given parameters, which is shared by all callers in this process.
+  The engine is created at the first call with a given set of parameters.
+
+  **Parameters:**
+
+  number_of_scales, number_of_directions, sigma, k_max, k_fac, power_of_k, dc_free, cache_directory
+    The parameters of the :py:class:`GaborEngine`.
+
+  **Returns:**
+
+  engine : :py:class:`GaborEngine`
+    The shared engine.
+  """
+  key = (number_of_scales, number_of_directions, float(sigma), float(k_max), float(k_fac), float(power_of_k), bool(dc_free), cache_directory)
+  with _engines_lock:
+    if key not in _engines:
+      _engines[key] = GaborEngine(*key)
+    return _engines[key]
+
+
+def thread_pool(threads):
+  """thread_pool(threads) -> pool
+
+  Returns a pool with the given number of threads, which is shared by all callers in this process.
+  Since the FFT functions of NumPy release the global interpreter lock, the threads can work on different Gabor wavelets in parallel.
+
+  **Parameters:**
+
+  threads : int
+    The number of threads in the pool.
+
+  **Returns:**
+
+  pool : :py:class:`multiprocessing.pool.ThreadPool`
+    The shared thread pool.
+  """
+  with _engines_lock:
+    if threads not in _pools:
+      _pools[threads] = multiprocessing.pool.ThreadPool(threads)
+    return _pools[threads]
+
+
+def map_wavelets(function, count, threads = 1):
+  """map_wavelets(function, count, threads = 1) -> results
+
+  Splits the given number of wavelets evenly into ``threads`` consecutive slices, and calls the given function for each slice using the :py:func:`thread_pool`.
+  With a single thread, the function is called once for all wavelets in the calling thread.
+  When called from inside a task of another :py:func:`map_wavelets` call, the function is called for each slice in the calling thread, since waiting for the shared pool from one of its own threads could deadlock.
+
+  The function is called concurrently from several threads, so it must not modify shared state, e.g., the internal buffers of a shared :py:class:`bob.ip.base.LBP`.
+
+  **Parameters:**
+
+  function : callable
+    The function to call, with a :py:class:`slice` of the wavelet indices as the only parameter.
+
+  count : int
+    The number of wavelets.
+
+  threads : int
+    The number of threads to use.
+
+  **Returns:**
+
+  results : list
+    The results of the function calls, in the order of the slices.
+  """
+  if threads <= 1:
+    return [function(slice(0, count))]
+  slices = [slice(t * count // threads, (t+1) * count // threads) for t in range(threads)]
+  if getattr(_worker, 'active', False):
+    return [function(wavelets) for wavelets in slices]
+
+  def _task(wavelets):
+    _worker.active = True
+    try:
+      return function(wavelets)
+    finally:
+      _worker.active = False
+
+  return thread_pool(threads).map(_task, slices)
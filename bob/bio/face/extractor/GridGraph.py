@@ -7,6 +7,8 @@ import bob.io.base
 
 import numpy
 import math
+from .GaborEngine import gabor_engine, map_wavelets
+from ..preprocessor.Journal import atomic_write
 from bob.bio.base.extractor import Extractor
 
 class GridGraph (Extractor):
@@ -26,6 +28,9 @@ class GridGraph (Extractor):
     The parameters of the Gabor wavelet family, with its default values set as given in [WFK97]_.
     Please refer to :py:class:`bob.ip.gabor.Transform` for the documentation of these values.
 
+  gabor_cache_directory : str or ``None``
+    If given, the Gabor wavelets in frequency domain are stored in this directory, and re-used by other processes, see :py:class:`GaborEngine`.
+
   normalize_gabor_jets : bool
     Perform Gabor jet normalization during extraction?
 
@@ -45,6 +50,14 @@ class GridGraph (Extractor):
   first_node : (int, int) or ``None``
     Only used when ``eyes`` is ``None``.
     If ``None``, it is calculated automatically to equally cover the whole image.
+
+  sparse : bool
+    If enabled, the Gabor wavelet responses are evaluated only at the node positions, instead of performing the full Gabor wavelet transform of the image.
+    The extracted jets are identical (up to numerical precision), but the extraction is faster since the ``trafo_image`` is never computed.
+
+  threads : int
+    The number of threads, between which the Gabor wavelets of a single image are split.
+    This reduces the extraction time of single images on multi-core machines, without changing the extracted jets.
   """
 
   def __init__(
@@ -57,6 +70,7 @@ class GridGraph (Extractor):
       gabor_frequency_step = math.sqrt(.5),
       gabor_power_of_k = 0,
       gabor_dc_free = True,
+      gabor_cache_directory = None,
 
       # what kind of information to extract
       normalize_gabor_jets = True,
@@ -71,6 +85,10 @@ class GridGraph (Extractor):
       # setup of static grid
       node_distance = None,    # one or two integral values
       first_node = None,       # one or two integral values, or None -> automatically determined
+
+      # evaluate Gabor wavelets at the nodes only
+      sparse = False,
+      threads = 1
   ):
 
     # call base class constructor
@@ -84,6 +102,7 @@ class GridGraph (Extractor):
         gabor_frequency_step = gabor_frequency_step,
         gabor_power_of_k = gabor_power_of_k,
         gabor_dc_free = gabor_dc_free,
+        gabor_cache_directory = gabor_cache_directory,
         normalize_gabor_jets = normalize_gabor_jets,
         eyes = eyes,
         nodes_between_eyes = nodes_between_eyes,
@@ -91,19 +110,23 @@ class GridGraph (Extractor):
         nodes_above_eyes = nodes_above_eyes,
         nodes_below_eyes = nodes_below_eyes,
         node_distance = node_distance,
-        first_node = first_node
+        first_node = first_node,
+        sparse = sparse,
+        threads = threads
     )
 
-    # create Gabor wavelet transform class
-    self.gwt = bob.ip.gabor.Transform(
+    # get the Gabor wavelet transform that is shared with other extractors
+    self.engine = gabor_engine(
         number_of_scales = gabor_scales,
         number_of_directions = gabor_directions,
         sigma = gabor_sigma,
         k_max = gabor_maximum_frequency,
         k_fac = gabor_frequency_step,
         power_of_k = gabor_power_of_k,
-        dc_free = gabor_dc_free
+        dc_free = gabor_dc_free,
+        cache_directory = gabor_cache_directory
     )
+    self.gwt = self.engine.gwt
 
     # create graph extractor
     if eyes is not None:
@@ -127,6 +150,9 @@ class GridGraph (Extractor):
 
     self.normalize_jets = normalize_gabor_jets
     self.trafo_image = None
+    self.sparse = sparse
+    self.threads = threads
+    self._node_bases = None
 
   def _extractor(self, image):
     """Creates an extractor based on the given image.
@@ -135,7 +161,7 @@ class GridGraph (Extractor):
     If the ``first_node`` was not specified, it is calculated automatically.
     """
 
-    if self.trafo_image is None or self.trafo_image.shape[1:3] != image.shape:
+    if not self.sparse and (self.trafo_image is None or self.trafo_image.shape[1:3] != image.shape):
       # create trafo image
       self.trafo_image = numpy.ndarray((self.gwt.number_of_wavelets, image.shape[0], image.shape[1]), numpy.complex128)
 
@@ -168,6 +194,32 @@ class GridGraph (Extractor):
     return self._graph
 
 
+  def _node_responses(self, image, nodes):
+    """Computes the Gabor wavelet responses of the given image at the given node positions only.
+
+    The image is transformed into frequency domain, multiplied with the wavelets, and only the rows and columns of the node positions are transformed back, using a partial inverse discrete Fourier transform.
+    Returns a 2D complex array with one row of responses per node.
+    """
+    nodes = numpy.array(nodes, numpy.int64).reshape(-1, 2)
+    if numpy.any(nodes < 0) or numpy.any(nodes >= image.shape):
+      raise ValueError("Some nodes of the graph lie outside of the image of shape %s" % (image.shape,))
+
+    if self._node_bases is None or self._node_bases[0] != (image.shape, nodes.tobytes()):
+      # the wavelets in frequency domain, and the inverse Fourier bases of the rows and columns of the nodes
+      height, width = image.shape
+      wavelets = self.engine.spectra(image.shape)
+      rows, row_index = numpy.unique(nodes[:,0], return_inverse = True)
+      cols, col_index = numpy.unique(nodes[:,1], return_inverse = True)
+      row_basis = numpy.exp(2j * math.pi / height * (numpy.outer(rows, numpy.arange(height)) % height)) / height
+      col_basis = numpy.exp(2j * math.pi / width * (numpy.outer(numpy.arange(width), cols) % width)) / width
+      self._node_bases = ((image.shape, nodes.tobytes()), wavelets, row_basis, col_basis, row_index, col_index)
+    _, wavelets, row_basis, col_basis, row_index, col_index = self._node_bases
+
+    frequencies = numpy.fft.fft2(image)
+    responses = numpy.concatenate(map_wavelets(lambda w: numpy.matmul(numpy.matmul(row_basis, wavelets[w] * frequencies), col_basis), len(wavelets), self.threads))
+    return numpy.ascontiguousarray(responses[:, row_index, col_index].T)
+
+
   def __call__(self, image):
     """__call__(image) -> feature
 
@@ -175,8 +227,9 @@ class GridGraph (Extractor):
 
     **Parameters:**
 
-    image : 2D :py:class:`numpy.ndarray` (floats)
+    image : 2D :py:class:`numpy.ndarray` (floats or integers)
       The image to extract the features from.
+      Integer images, such as the ones produced by :py:class:`bob.bio.face.preprocessor.INormLBP`, are converted to floats.
 
     **Returns:**
 
@@ -186,14 +239,19 @@ class GridGraph (Extractor):
     """
     assert image.ndim == 2
     assert isinstance(image, numpy.ndarray)
-    assert image.dtype == numpy.float64
+    assert image.dtype == numpy.float64 or numpy.issubdtype(image.dtype, numpy.integer)
+    image = image.astype(numpy.float64, copy = False)
 
     extractor = self._extractor(image)
 
-    # perform Gabor wavelet transform
-    self.gwt.transform(image, self.trafo_image)
-    # extract face graph
-    jets = extractor.extract(self.trafo_image)
+    if self.sparse:
+      # evaluate the Gabor wavelets at the nodes only
+      jets = [bob.ip.gabor.Jet(responses, False) for responses in self._node_responses(image, extractor.nodes)]
+    else:
+      # perform Gabor wavelet transform
+      self.engine.transform(image, self.trafo_image, self.threads)
+      # extract face graph
+      jets = extractor.extract(self.trafo_image)
 
     # normalize the Gabor jets of the graph only
     if self.normalize_jets:
@@ -205,6 +263,7 @@ class GridGraph (Extractor):
 
   def write_feature(self, feature, feature_file):
     """Writes the feature extracted by the :py:meth:`__call__` function to the given file.
+    When a file name is given, the file is written atomically, see :py:func:`bob.bio.face.preprocessor.atomic_write`.
 
     **Parameters:**
 
@@ -214,8 +273,17 @@ class GridGraph (Extractor):
     feature_file : str or :py:class:`bob.io.base.HDF5File`
       The name of the file or the file opened for writing.
     """
-    feature_file = feature_file if isinstance(feature_file, bob.io.base.HDF5File) else bob.io.base.HDF5File(feature_file, 'w')
-    bob.ip.gabor.save_jets(feature, feature_file)
+    if isinstance(feature_file, bob.io.base.HDF5File):
+      bob.ip.gabor.save_jets(feature, feature_file)
+    else:
+      atomic_write(self._save_jets, feature, feature_file)
+
+
+  def _save_jets(self, jets, filename):
+    """Writes the given jets into a new HDF5 file, which is closed before it is renamed by :py:func:`bob.bio.face.preprocessor.atomic_write`."""
+    hdf5 = bob.io.base.HDF5File(filename, 'w')
+    bob.ip.gabor.save_jets(jets, hdf5)
+    hdf5.close()
 
 
   def read_feature(self, feature_file):
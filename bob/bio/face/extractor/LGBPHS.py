@@ -2,14 +2,26 @@
 # vim: set fileencoding=utf-8 :
 # Manuel Guenther <Manuel.Guenther@idiap.ch>
 
-import bob.ip.gabor
 import bob.ip.base
 
 import numpy
 import math
 
+from .GaborEngine import gabor_engine, map_wavelets, _worker
+from ..preprocessor.Journal import atomic_write
 from bob.bio.base.extractor import Extractor
 
+
+def _thread_lbp(parameters):
+  """Returns the :py:class:`bob.ip.base.LBP` with the given parameters, which is created once for each thread that calls this function, e.g., the threads of :py:func:`map_wavelets`."""
+  if not hasattr(_worker, 'lbps'):
+    _worker.lbps = {}
+  key = tuple(sorted(parameters.items()))
+  if key not in _worker.lbps:
+    _worker.lbps[key] = bob.ip.base.LBP(**parameters)
+  return _worker.lbps[key]
+
+
 class LGBPHS (Extractor):
   """Extracts *Local Gabor Binary Pattern Histogram Sequences* (LGBPHS) [ZSG+05]_ from the images, using functionality from :ref:`bob.ip.base <bob.ip.base>` and :ref:`bob.ip.gabor <bob.ip.gabor>`.
 
@@ -30,6 +42,9 @@ class LGBPHS (Extractor):
     The parameters of the Gabor wavelet family, with its default values set as given in [WFK97]_.
     Please refer to :py:class:`bob.ip.gabor.Transform` for the documentation of these values.
 
+  gabor_cache_directory : str or ``None``
+    If given, the Gabor wavelets in frequency domain are stored in this directory, and re-used by other processes, see :py:class:`GaborEngine`.
+
   use_gabor_phases : bool
     Extract also the Gabor phases (inline) and not only the absolute values.
     In this case, Extended LGBPHS features [ZSQ+09]_ will be extracted.
@@ -51,6 +66,10 @@ class LGBPHS (Extractor):
   split_histogram : one of ``('blocks', 'wavelets', 'both')`` or ``None``
     Defines, how the histogram sequence is split.
     This could be interesting, if the histograms should be used in another way as simply concatenating them into a single histogram sequence (the default).
+
+  threads : int
+    The number of threads, between which the Gabor wavelet transform and the LBP histograms of the wavelets of a single image are split.
+    The extracted features do not depend on the number of threads.
   """
 
   def __init__(
@@ -66,6 +85,7 @@ class LGBPHS (Extractor):
       gabor_frequency_step = math.sqrt(.5),
       gabor_power_of_k = 0,
       gabor_dc_free = True,
+      gabor_cache_directory = None,
       use_gabor_phases = False,
       # LBP parameters
       lbp_radius = 2,
@@ -77,7 +97,8 @@ class LGBPHS (Extractor):
       lbp_add_average = False,
       # histogram options
       sparse_histogram = False,
-      split_histogram = None
+      split_histogram = None,
+      threads = 1
   ):
     # call base class constructor
     Extractor.__init__(
@@ -92,6 +113,7 @@ class LGBPHS (Extractor):
         gabor_frequency_step = gabor_frequency_step,
         gabor_power_of_k = gabor_power_of_k,
         gabor_dc_free = gabor_dc_free,
+        gabor_cache_directory = gabor_cache_directory,
         use_gabor_phases = use_gabor_phases,
         lbp_radius = lbp_radius,
         lbp_neighbor_count = lbp_neighbor_count,
@@ -101,7 +123,8 @@ class LGBPHS (Extractor):
         lbp_compare_to_average = lbp_compare_to_average,
         lbp_add_average = lbp_add_average,
         sparse_histogram = sparse_histogram,
-        split_histogram = split_histogram
+        split_histogram = split_histogram,
+        threads = threads
     )
 
     # block parameters
@@ -110,20 +133,22 @@ class LGBPHS (Extractor):
     if self.block_size[0] < self.block_overlap[0] or self.block_size[1] < self.block_overlap[1]:
       raise ValueError("The overlap is bigger than the block size. This won't work. Please check your setup!")
 
-    # Gabor wavelet transform class
-    self.gwt = bob.ip.gabor.Transform(
+    # Gabor wavelet transform, which is shared with other extractors
+    self.engine = gabor_engine(
         number_of_scales = gabor_scales,
         number_of_directions = gabor_directions,
         sigma = gabor_sigma,
         k_max = gabor_maximum_frequency,
         k_fac = gabor_frequency_step,
         power_of_k = gabor_power_of_k,
-        dc_free = gabor_dc_free
+        dc_free = gabor_dc_free,
+        cache_directory = gabor_cache_directory
     )
+    self.gwt = self.engine.gwt
     self.trafo_image = None
     self.use_phases = use_gabor_phases
 
-    self.lbp = bob.ip.base.LBP(
+    self.lbp_parameters = dict(
         neighbors = lbp_neighbor_count,
         radius = float(lbp_radius),
         circular = lbp_circular,
@@ -133,8 +158,10 @@ class LGBPHS (Extractor):
         rotation_invariant = lbp_rotation_invariant,
         border_handling = 'wrap'
     )
+    self.lbp = bob.ip.base.LBP(**self.lbp_parameters)
 
     self.split = split_histogram
+    self.threads = threads
     self.sparse = sparse_histogram
     if self.sparse and self.split:
       raise ValueError("Sparse histograms cannot be split! Check your setup!")
@@ -181,8 +208,9 @@ class LGBPHS (Extractor):
 
     **Parameters:**
 
-    image : 2D :py:class:`numpy.ndarray` (floats)
+    image : 2D :py:class:`numpy.ndarray` (floats or integers)
       The image to extract the features from.
+      Integer images, such as the ones produced by :py:class:`bob.bio.face.preprocessor.INormLBP`, are converted to floats.
 
     **Returns:**
 
@@ -193,7 +221,8 @@ class LGBPHS (Extractor):
     """"""
     assert image.ndim == 2
     assert isinstance(image, numpy.ndarray)
-    assert image.dtype == numpy.float64
+    assert image.dtype == numpy.float64 or numpy.issubdtype(image.dtype, numpy.integer)
+    image = image.astype(numpy.float64, copy = False)
 
     # perform GWT on image
     if self.trafo_image is None or self.trafo_image.shape[1:3] != image.shape:
@@ -201,17 +230,26 @@ class LGBPHS (Extractor):
       self.trafo_image = numpy.ndarray((self.gwt.number_of_wavelets, image.shape[0], image.shape[1]), numpy.complex128)
 
     # perform Gabor wavelet transform
-    self.gwt.transform(image, self.trafo_image)
+    self.engine.transform(image, self.trafo_image, self.threads)
 
     jet_length = self.gwt.number_of_wavelets * (2 if self.use_phases else 1)
 
+    def _histograms(wavelets):
+      # computes the LBP histograms of the absolute values and phases of the given layers of the trafo image
+      # bob.ip.base.LBP is not reentrant, hence each thread uses its own instance
+      lbp = self.lbp if self.threads <= 1 else _thread_lbp(self.lbp_parameters)
+      histograms = []
+      for j in range(self.gwt.number_of_wavelets)[wavelets]:
+        abs_blocks = bob.ip.base.lbphs(numpy.abs(self.trafo_image[j]), lbp, self.block_size, self.block_overlap)
+        phase_blocks = bob.ip.base.lbphs(numpy.angle(self.trafo_image[j]), lbp, self.block_size, self.block_overlap) if self.use_phases else None
+        histograms.append((abs_blocks, phase_blocks))
+      return histograms
+
+    histograms = [h for part in map_wavelets(_histograms, self.gwt.number_of_wavelets, self.threads) for h in part]
+
     lgbphs_array = None
     # iterate through the layers of the trafo image
-    for j in range(self.gwt.number_of_wavelets):
-      # compute absolute part of complex response
-      abs_image = numpy.abs(self.trafo_image[j])
-      # Computes LBP histograms
-      abs_blocks = bob.ip.base.lbphs(abs_image, self.lbp, self.block_size, self.block_overlap)
+    for j, (abs_blocks, phase_blocks) in enumerate(histograms):
 
       # Converts to Blitz array (of different dimensionalities)
       self.n_bins = abs_blocks.shape[1]
@@ -236,10 +274,6 @@ class LGBPHS (Extractor):
       self._fill(lgbphs_array, abs_blocks, j)
 
       if self.use_phases:
-        # compute phase part of complex response
-        phase_image = numpy.angle(self.trafo_image[j])
-        # Computes LBP histograms
-        phase_blocks = bob.ip.base.lbphs(phase_image, self.lbp, self.block_size, self.block_overlap)
         # fill the array with the phases at the end of the blocks
         self._fill(lgbphs_array, phase_blocks, j + self.gwt.number_of_wavelets)
 
@@ -247,6 +281,24 @@ class LGBPHS (Extractor):
     # return the concatenated list of all histograms
     return self._sparsify(lgbphs_array)
 
+  def write_feature(self, feature, feature_file):
+    """write_feature(feature, feature_file) -> None
+
+    Writes the given LGBPHS feature to file.
+    When a file name is given, the feature is written into a temporary file, which is renamed afterward, see :py:func:`bob.bio.face.preprocessor.atomic_write`.
+
+    **Parameters:**
+
+    feature : 1D or 2D :py:class:`numpy.ndarray`
+      The extracted (sparse) histograms.
+
+    feature_file : str or :py:class:`bob.io.base.HDF5File`
+      The file to write the feature into.
+    """
+    if isinstance(feature_file, str):
+      return atomic_write(lambda data, filename : Extractor.write_feature(self, data, filename), feature, feature_file)
+    return Extractor.write_feature(self, feature, feature_file)
+
   # re-define the train function to get it non-documented
   def train(*args,**kwargs) : raise NotImplementedError("This function is not implemented and should not be called.")
   def load(*args,**kwargs) : pass
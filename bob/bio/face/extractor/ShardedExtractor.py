@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import os
+import atexit
+
+import bob.bio.base
+
+from .FeatureShards import FeatureShards
+from ..preprocessor.Journal import write_marker
+from bob.bio.base.extractor import Extractor
+
+class ShardedExtractor (Extractor):
+  """Runs the given extractor, but writes the extracted features into :py:class:`FeatureShards` instead of one HDF5 file per feature.
+
+  The name of the file that would be written is used as the key in the shards, so that algorithms can read the features with the usual file names.
+  The pending features are written to disk when a shard is full, when :py:meth:`flush` is called, and at the latest when the program exits normally.
+  As soon as a feature is written to disk, a marker file that names its shard is created in place of the feature file, so that the usual checks for existing files skip the feature in later runs.
+  Features that were pending when a job was killed have no marker file, and are extracted again.
+
+  **Parameters:**
+
+  extractor : str or :py:class:`bob.bio.base.extractor.Extractor`
+    The extractor to run, or the name of a registered extractor resource.
+
+  directory : str
+    The directory of the :py:class:`FeatureShards`.
+
+  shard_size : int
+    The number of features stored in each shard.
+  """
+
+  def __init__(
+      self,
+      extractor,
+      directory,
+      shard_size = 1000
+  ):
+    self.extractor = bob.bio.base.load_resource(extractor, 'extractor') if isinstance(extractor, str) else extractor
+
+    # call base class constructor with its set of parameters
+    Extractor.__init__(
+        self,
+        requires_training = self.extractor.requires_training,
+        split_training_data_by_client = self.extractor.split_training_data_by_client,
+        extractor = extractor,
+        directory = directory,
+        shard_size = shard_size
+    )
+
+    self.shards = FeatureShards(directory, shard_size)
+    atexit.register(self.flush)
+
+
+  def __call__(self, data):
+    """__call__(data) -> feature
+
+    Extracts the feature using the ``extractor`` given in the constructor.
+    """
+    return self.extractor(data)
+
+
+  def train(self, training_data, extractor_file):
+    """Trains the ``extractor`` given in the constructor."""
+    return self.extractor.train(training_data, extractor_file)
+
+
+  def load(self, extractor_file):
+    """Loads the ``extractor`` given in the constructor."""
+    return self.extractor.load(extractor_file)
+
+
+  def write_feature(self, feature, feature_file):
+    """write_feature(feature, feature_file) -> None
+
+    Adds the given feature to the shards, using the file name as the key.
+    The marker files of all features that are written to disk by this call are created.
+
+    **Parameters:**
+
+    feature : object
+      The extracted feature.
+
+    feature_file : str
+      The name of the file, which serves as the key in the shards.
+    """
+    self._mark(self.shards.write(os.path.abspath(feature_file), feature))
+
+
+  def read_feature(self, feature_file):
+    """read_feature(feature_file) -> feature
+
+    Reads the feature from the shards.
+
+    **Parameters:**
+
+    feature_file : str
+      The name of the file, which serves as the key in the shards.
+
+    **Returns:**
+
+    feature : object
+      The feature read from the shards.
+    """
+    return self.shards.read(os.path.abspath(feature_file))
+
+
+  def flush(self):
+    """flush() -> None
+
+    Writes all pending features to disk, and creates their marker files.
+    """
+    self._mark(self.shards.flush())
+
+
+  def _mark(self, feature_files):
+    """Creates the marker files for the given feature files."""
+    for feature_file in feature_files:
+      write_marker(feature_file, "%s\t%d" % self.shards.index[feature_file])
@@ -2,6 +2,12 @@ from .DCTBlocks import DCTBlocks
 from .GridGraph import GridGraph
 from .LGBPHS import LGBPHS
 from .Eigenface import Eigenface
+from .GaborEngine import GaborEngine, gabor_engine, thread_pool, map_wavelets
+
+from .FeatureShards import FeatureShards
+from .FeatureMatrix import FeatureMatrix
+from .ShardedExtractor import ShardedExtractor
+from .CachedExtractor import CachedExtractor
 
 # gets sphinx autodoc done right - don't remove it
 __all__ = [_ for _ in dir() if not _.startswith('_')]
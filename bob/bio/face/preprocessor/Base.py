@@ -2,6 +2,7 @@ import numpy
 import bob.io.image
 import bob.ip.color
 
+from .Journal import atomic_write
 from bob.bio.base.preprocessor import Preprocessor
 
 class Base (Preprocessor):
@@ -80,6 +81,15 @@ class Base (Preprocessor):
     return image
 
 
+  def _enhance_channels(self, image, output = None):
+    """Enhances all channels of the given 3D color image at once, treating the channels as a batch of images, see the ``enhance_batch`` functions of the derived classes."""
+    enhanced = self.enhance_batch(image)
+    if output is not None:
+      output[:] = enhanced
+      enhanced = output
+    return enhanced
+
+
   def __call__(self, image, annotations = None):
     """__call__(image, annotations = None) -> image
 
@@ -102,3 +112,29 @@ class Base (Preprocessor):
     # convert to grayscale
     image = self.color_channel(image)
     return self.data_type(image)
+
+
+  def write_data(self, data, data_file):
+    """write_data(data, data_file) -> None
+
+    Writes the given preprocessed data to file.
+    When a file name is given, the data is first written into a temporary file, which is renamed afterward, see :py:func:`atomic_write`.
+    Hence, interrupted preprocessing never leaves incomplete files behind.
+
+    **Parameters:**
+
+    data : object
+      The preprocessed data.
+
+    data_file : str or :py:class:`bob.io.base.HDF5File`
+      The file to write the data into.
+    """
+    if isinstance(data_file, str):
+      atomic_write(self._write_data, data, data_file)
+    else:
+      self._write_data(data, data_file)
+
+
+  def _write_data(self, data, data_file):
+    """Writes the data using the :py:meth:`bob.bio.base.preprocessor.Preprocessor.write_data` function."""
+    Preprocessor.write_data(self, data, data_file)
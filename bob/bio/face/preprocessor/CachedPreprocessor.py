@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import os
+
+import bob.bio.base
+
+from .StageCache import StageCache, content_hash
+from .Journal import Journal, atomic_write, remove_temporary_files
+from bob.bio.base.preprocessor import Preprocessor
+
+class CachedPreprocessor (Preprocessor):
+  """Runs the given preprocessor, but takes the preprocessed data from a :py:class:`StageCache` when the same image has already been preprocessed with the same configuration.
+
+  The cache key is computed by :py:func:`content_hash` from the constructor parameters of the ``preprocessor``, the content of the image and the annotations.
+  Hence, the preprocessed data is re-used by all experiments that share the ``cache_directory``, independent of their ``--sub-directory``.
+
+  Additionally, a :py:class:`Journal` of all preprocessed original files is kept in the ``journal`` sub-directory of the ``cache_directory``.
+  When an interrupted run is restarted, original files that are recorded in the journal -- for the same configuration, file size and modification time -- are neither read nor hashed again, but their preprocessed data is directly taken from the cache.
+  All files are written atomically, so that no partially written files remain after an interruption.
+  Temporary files that killed processes have left in the ``cache_directory`` are removed when the journal is opened, see :py:func:`remove_temporary_files`.
+
+  .. note::
+     The preprocessed data is still written by :py:meth:`write_data` into the files of the current experiment.
+
+  **Parameters:**
+
+  preprocessor : str or :py:class:`bob.bio.base.preprocessor.Preprocessor`
+    The preprocessor to run, or the name of a registered preprocessor resource.
+
+  cache_directory : str
+    The directory of the :py:class:`StageCache`.
+
+  max_size : int or ``None``
+    The maximum size of the cache directory in bytes, see :py:class:`StageCache`.
+  """
+
+  def __init__(
+      self,
+      preprocessor,
+      cache_directory,
+      max_size = None
+  ):
+
+    # call base class constructor with its set of parameters
+    Preprocessor.__init__(
+        self,
+        preprocessor = preprocessor,
+        cache_directory = cache_directory,
+        max_size = max_size
+    )
+
+    self.preprocessor = bob.bio.base.load_resource(preprocessor, 'preprocessor') if isinstance(preprocessor, str) else preprocessor
+    self.cache = StageCache(cache_directory, max_size)
+    self.journal = Journal(os.path.join(cache_directory, 'journal'))
+    # clean up after processes that were killed while writing into the cache
+    remove_temporary_files(cache_directory)
+    # the journal entry of the last read original file
+    self._original = None
+
+
+  def __call__(self, image, annotations = None):
+    """__call__(image, annotations = None) -> data
+
+    Returns the cached preprocessed data, or preprocesses the given image using the ``preprocessor`` given in the constructor and stores the result in the cache.
+
+    **Parameters:**
+
+    image : 2D or 3D :py:class:`numpy.ndarray`
+      The face image to be processed.
+
+    annotations : dict or ``None``
+      The annotations that fit to the given image.
+
+    **Returns:**
+
+    data : object
+      The preprocessed data.
+    """
+    annotation_key = content_hash(annotations)
+    if isinstance(image, _Completed):
+      # the original file has been preprocessed before
+      if image.annotation_key == annotation_key:
+        data = self.cache.read(image.key, self.preprocessor.read_data)
+        if data is not None:
+          return data
+      self._original = image.name
+      image = self.preprocessor.read_original_data(image.original_file_name)
+
+    key = content_hash(self.preprocessor, image, annotations)
+    data = self.cache.read(key, self.preprocessor.read_data)
+    if data is None:
+      data = self.preprocessor(image, annotations)
+      if data is None:
+        return None
+      self.cache.write(key, data, self.preprocessor.write_data)
+    if self._original is not None:
+      self.journal.record(self._original, "%s %s" % (key, annotation_key))
+      self._original = None
+    return data
+
+
+  def read_original_data(self, original_file_name):
+    """read_original_data(original_file_name) -> image
+
+    Reads the original data using the ``preprocessor`` given in the constructor.
+    If the original file is recorded in the journal, it is not read, but a marker is returned, which lets :py:meth:`__call__` take the preprocessed data from the cache.
+    """
+    stat = os.stat(original_file_name)
+    name = content_hash(self.preprocessor, os.path.abspath(original_file_name), stat.st_size, stat.st_mtime)
+    entry = self.journal.get(name)
+    if entry is not None:
+      key, annotation_key = entry.split()
+      if key in self.cache:
+        self._original = None
+        return _Completed(original_file_name, name, key, annotation_key)
+    self._original = name
+    return self.preprocessor.read_original_data(original_file_name)
+
+
+  def write_data(self, data, data_file):
+    """Writes the preprocessed data atomically using the ``preprocessor`` given in the constructor."""
+    atomic_write(self.preprocessor.write_data, data, data_file)
+
+
+  def read_data(self, data_file):
+    """Reads the preprocessed data using the ``preprocessor`` given in the constructor."""
+    return self.preprocessor.read_data(data_file)
+
+
+class _Completed:
+  """A marker for an original file, whose preprocessed data is stored in the cache."""
+  def __init__(self, original_file_name, name, key, annotation_key):
+    self.original_file_name = original_file_name
+    self.name = name
+    self.key = key
+    self.annotation_key = annotation_key
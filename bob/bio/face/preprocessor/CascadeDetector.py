@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import math
+import numpy
+
+import bob.io.base
+import bob.ip.base
+import bob.ip.facedetect
+import bob.learn.boosting
+
+
+class CascadeDetector:
+  """Detects faces by evaluating a face detector cascade on all windows of an image pyramid at once.
+
+  This detector reads the same cascade files as :py:class:`FaceDetect`, and it samples the same bounding boxes as :py:class:`bob.ip.facedetect.Sampler` does.
+  However, instead of evaluating the cascade for one bounding box after the other, the LBP feature maps are computed only once per pyramid level.
+  Each stage of the cascade is then evaluated for all bounding boxes of that level, which were not rejected by the previous stages, using vectorized look-up operations.
+  Finally, the detections are merged using a vectorized non-maximum suppression.
+
+  .. note::
+     Only cascades of :py:class:`bob.learn.boosting.LUTMachine` weak classifiers on LBP features (as trained by :ref:`bob.ip.facedetect <bob.ip.facedetect>`) are supported.
+
+  **Parameters:**
+
+  cascade : str or :py:class:`bob.ip.facedetect.Cascade` or ``None``
+    The face detector cascade, or the file name, where a cascade can be found.
+    If ``None``, the default cascade for frontal faces :py:func:`bob.ip.facedetect.default_cascade` is used.
+
+  distance, scale_base, lowest_scale
+    See the Sampling section in the :ref:`Users Guide of bob.ip.facedetect <bob.ip.facedetect>`.
+
+  block_size : int
+    The maximum number of weak classifiers that are evaluated at once, which limits the memory requirements of the vectorized evaluation.
+  """
+
+  def __init__(
+      self,
+      cascade = None,
+      distance = 2,
+      scale_base = math.pow(2., -1./16.),
+      lowest_scale = 0.125,
+      block_size = 64
+  ):
+    if cascade is None:
+      cascade = bob.ip.facedetect.default_cascade()
+    elif isinstance(cascade, str):
+      cascade = bob.ip.facedetect.Cascade(bob.io.base.HDF5File(cascade))
+    self.cascade = cascade
+
+    extractor = cascade.extractor
+    self.patch_size = tuple(extractor.patch_size)
+    self.lbps = list(extractor.extractors)
+    self.distance = distance
+    self.block_size = block_size
+    self.sampler = bob.ip.facedetect.Sampler(patch_size=self.patch_size, scale_factor=scale_base, lowest_scale=lowest_scale, distance=distance)
+
+    # the positions of all features inside the patch, as (extractor, y, x)
+    positions = []
+    for e, lbp in enumerate(self.lbps):
+      shape = lbp.lbp_shape(numpy.zeros(self.patch_size))
+      offset = lbp.offset
+      positions.extend((e, y + offset[0], x + offset[1]) for y in range(shape[0]) for x in range(shape[1]))
+    if len(positions) != extractor.number_of_features:
+      raise ValueError("The feature layout of the cascade could not be determined")
+    self.positions = numpy.array(positions, dtype=numpy.int64)
+
+    # the stages of the cascade as (feature indices, weighted look-up tables)
+    self.stages = [self._stage(machine) for machine in cascade.cascade]
+    self.thresholds = numpy.array(cascade.thresholds, dtype=numpy.float64)
+
+
+  def _stage(self, machine):
+    """Collects the feature indices and the weighted look-up tables of all weak classifiers of the given boosted machine."""
+    weak_machines = machine.weak_machines
+    weights = numpy.array(machine.weights, dtype=numpy.float64).reshape(len(weak_machines), -1)[:,0]
+    if not all(isinstance(weak, bob.learn.boosting.LUTMachine) for weak in weak_machines):
+      raise ValueError("Only cascades of LUT machines are supported")
+    indices = numpy.array([numpy.array(weak.index).flatten()[0] for weak in weak_machines], dtype=numpy.int64)
+    luts = [numpy.array(weak.lut, dtype=numpy.float64).reshape(-1, numpy.array(weak.index).size)[:,0] for weak in weak_machines]
+    table = numpy.zeros((len(luts), max(len(lut) for lut in luts)))
+    for i, lut in enumerate(luts):
+      table[i, :len(lut)] = weights[i] * lut
+    return indices, table
+
+
+  def _feature_maps(self, image):
+    """Computes the LBP codes of all extractors for the whole (scaled) image, aligned to the center positions of the LBP."""
+    codes = numpy.zeros((len(self.lbps),) + image.shape, numpy.uint16)
+    integral = None
+    for e, lbp in enumerate(self.lbps):
+      if lbp.is_multi_block_lbp:
+        if integral is None:
+          # integral image with a zero border, as bob.ip.base.integral computes it
+          integral = numpy.zeros((image.shape[0]+1, image.shape[1]+1))
+          numpy.cumsum(numpy.cumsum(image, axis=0), axis=1, out=integral[1:,1:])
+        code_map = lbp(integral, is_integral_image=True)
+      else:
+        code_map = lbp(image)
+      offset = lbp.offset
+      codes[e, offset[0] : offset[0] + code_map.shape[0], offset[1] : offset[1] + code_map.shape[1]] = code_map
+    return codes
+
+
+  def _predict(self, codes, windows, features, stage):
+    """Computes the predictions of the given stage for all given windows."""
+    indices, table = stage
+    features = features[indices]
+    prediction = numpy.zeros(len(windows))
+    for start in range(0, len(indices), self.block_size):
+      end = min(start + self.block_size, len(indices))
+      values = codes[windows[:,None] + features[None, start:end]]
+      prediction += table[numpy.arange(start, end)[None,:], values].sum(axis=1)
+    return prediction
+
+
+  def predictions(self, image):
+    """predictions(image) -> boxes, predictions
+
+    Computes the cascade predictions for all bounding boxes of all levels of the image pyramid.
+
+    As :py:meth:`bob.ip.facedetect.Sampler.iterate_cascade` does, the prediction of a bounding box that is rejected by a stage of the cascade is the accumulated prediction up to this stage.
+
+    **Parameters:**
+
+    image : 2D :py:class:`numpy.ndarray`
+      The gray level image to detect faces in.
+
+    **Returns:**
+
+    boxes : 2D :py:class:`numpy.ndarray` (float)
+      The bounding boxes in original image coordinates, one per row, as ``(top, left, bottom, right)``.
+
+    predictions : 1D :py:class:`numpy.ndarray` (float)
+      The predictions of the cascade for all bounding boxes.
+    """
+    all_boxes, all_predictions = [], []
+    for scale, shape in self.sampler.scales(image):
+      # scale the image and compute the feature maps once per level
+      scaled = numpy.ndarray(shape)
+      bob.ip.base.scale(image, scaled)
+      codes = self._feature_maps(scaled).ravel()
+
+      # the positions of all features relative to the top-left corner of the patch
+      features = self.positions[:,0] * (shape[0] * shape[1]) + self.positions[:,1] * shape[1] + self.positions[:,2]
+
+      # sample the bounding boxes of this level, as bob.ip.facedetect.Sampler does
+      ys = numpy.arange(0, shape[0] - self.patch_size[0], self.distance)
+      xs = numpy.arange(0, shape[1] - self.patch_size[1], self.distance)
+      if not len(ys) or not len(xs):
+        continue
+      ys, xs = [c.ravel() for c in numpy.meshgrid(ys, xs, indexing='ij')]
+      windows = ys * shape[1] + xs
+
+      # evaluate the cascade stage by stage, only for the bounding boxes that survived so far
+      predictions = numpy.zeros(len(windows))
+      alive = numpy.arange(len(windows))
+      for stage, threshold in zip(self.stages, self.thresholds):
+        predictions[alive] += self._predict(codes, windows[alive], features, stage)
+        alive = alive[predictions[alive] >= threshold]
+        if not len(alive):
+          break
+
+      # transform the bounding boxes back into original image coordinates
+      boxes = numpy.empty((len(windows), 4))
+      boxes[:,0] = ys / scale
+      boxes[:,1] = xs / scale
+      boxes[:,2] = boxes[:,0] + self.patch_size[0] / scale
+      boxes[:,3] = boxes[:,1] + self.patch_size[1] / scale
+      all_boxes.append(boxes)
+      all_predictions.append(predictions)
+
+    if not all_boxes:
+      return numpy.ndarray((0,4)), numpy.ndarray((0,))
+    return numpy.vstack(all_boxes), numpy.hstack(all_predictions)
+
+
+  def detect_single_face(self, image, minimum_overlap = 0.2, relative_prediction_threshold = 0.25):
+    """detect_single_face(image, minimum_overlap = 0.2, relative_prediction_threshold = 0.25) -> bounding_box, quality
+
+    Detects the single most prominent face in the given image, in the same way as :py:func:`bob.ip.facedetect.detect_single_face` does.
+
+    All bounding boxes with a positive prediction that overlap with the best detection are averaged, where only predictions of at least ``relative_prediction_threshold`` times the best prediction are taken into account.
+
+    **Parameters:**
+
+    image : 2D :py:class:`numpy.ndarray`
+      The gray level image to detect the face in.
+
+    minimum_overlap : float
+      The minimum overlap of a bounding box with the best detection to be taken into account.
+
+    relative_prediction_threshold : float
+      The minimum prediction relative to the best prediction to be taken into account.
+
+    **Returns:**
+
+    bounding_box : :py:class:`bob.ip.facedetect.BoundingBox` or ``None``
+      The detected face, or ``None`` if no face could be detected.
+
+    quality : float or ``None``
+      The quality of the detection.
+    """
+    boxes, predictions = self.predictions(image)
+    positive = predictions > 0
+    boxes, predictions = boxes[positive], predictions[positive]
+    if not len(predictions):
+      return None, None
+
+    best = numpy.argmax(predictions)
+    overlapping = _similarities(boxes[best], boxes) > minimum_overlap
+    overlapping[best] = True
+    boxes, predictions = boxes[overlapping], predictions[overlapping]
+
+    box, quality = _average(boxes, predictions, relative_prediction_threshold * predictions.max())
+    return _bounding_box(box), quality
+
+
+  def detect_all_faces(self, image, threshold = 0., minimum_overlap = 0.2):
+    """detect_all_faces(image, threshold = 0., minimum_overlap = 0.2) -> bounding_boxes, qualities
+
+    Detects all faces in the given image.
+
+    All bounding boxes with a prediction larger than ``threshold`` are pruned using non-maximum suppression.
+    Each remaining bounding box is refined by averaging all detections that overlap with it by more than ``minimum_overlap``.
+
+    **Parameters:**
+
+    image : 2D :py:class:`numpy.ndarray`
+      The gray level image to detect the faces in.
+
+    threshold : float
+      The minimum prediction of the cascade to consider a bounding box to contain a face.
+
+    minimum_overlap : float
+      The overlap of two bounding boxes, above which they are considered to contain the same face.
+
+    **Returns:**
+
+    bounding_boxes : [:py:class:`bob.ip.facedetect.BoundingBox`]
+      The detected faces, sorted by their quality, with the best detection first.
+
+    qualities : [float]
+      The qualities of the detected faces, i.e., the predictions of the cascade.
+    """
+    boxes, predictions = self.predictions(image)
+    detected = predictions > threshold
+    boxes, predictions = boxes[detected], predictions[detected]
+
+    faces = non_maximum_suppression(boxes, predictions, minimum_overlap)
+    bounding_boxes = []
+    for face in faces:
+      overlapping = (_similarities(boxes[face], boxes) > minimum_overlap) & (predictions > 0)
+      if numpy.any(overlapping):
+        box, _ = _average(boxes[overlapping], predictions[overlapping], 0.)
+      else:
+        box = boxes[face]
+      bounding_boxes.append(_bounding_box(box))
+    return bounding_boxes, [predictions[face] for face in faces]
+
+
+
+def _similarities(box, boxes):
+  """Computes the Jaccard similarity between the given box and all boxes."""
+  height = numpy.minimum(box[2], boxes[:,2]) - numpy.maximum(box[0], boxes[:,0])
+  width = numpy.minimum(box[3], boxes[:,3]) - numpy.maximum(box[1], boxes[:,1])
+  intersection = numpy.maximum(height, 0.) * numpy.maximum(width, 0.)
+  areas = (boxes[:,2] - boxes[:,0]) * (boxes[:,3] - boxes[:,1])
+  return intersection / ((box[2] - box[0]) * (box[3] - box[1]) + areas - intersection)
+
+
+def _average(boxes, predictions, minimum_prediction):
+  """Computes the weighted average of all boxes with at least the given prediction, and the weighted average prediction."""
+  valid = predictions >= minimum_prediction
+  weights = predictions[valid] / predictions[valid].sum()
+  return numpy.dot(weights, boxes[valid]), numpy.dot(weights, predictions[valid])
+
+
+def _bounding_box(box):
+  """Converts the given (top, left, bottom, right) box into a :py:class:`bob.ip.facedetect.BoundingBox`."""
+  return bob.ip.facedetect.BoundingBox(topleft = (box[0], box[1]), size = (box[2] - box[0], box[3] - box[1]))
+
+
+def non_maximum_suppression(boxes, predictions, minimum_overlap):
+  """non_maximum_suppression(boxes, predictions, minimum_overlap) -> indices
+
+  Prunes overlapping bounding boxes, keeping only the box with the highest prediction.
+
+  **Parameters:**
+
+  boxes : 2D :py:class:`numpy.ndarray` (float)
+    The bounding boxes, one per row, as ``(top, left, bottom, right)``.
+
+  predictions : 1D :py:class:`numpy.ndarray` (float)
+    The predictions for the bounding boxes.
+
+  minimum_overlap : float
+    The overlap of two bounding boxes, above which the box with the lower prediction is removed.
+
+  **Returns:**
+
+  indices : [int]
+    The indices of the remaining bounding boxes, sorted by decreasing prediction.
+  """
+  order = numpy.argsort(-predictions, kind='mergesort')
+  kept = []
+  while len(order):
+    best = order[0]
+    kept.append(best)
+    order = order[1:]
+    order = order[_similarities(boxes[best], boxes[order]) <= minimum_overlap]
+  return kept
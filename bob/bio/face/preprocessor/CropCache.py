@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import collections
+import hashlib
+import os
+import threading
+import weakref
+
+import numpy
+
+import bob.io.base
+
+from .Journal import atomic_write
+
+import logging
+logger = logging.getLogger("bob.bio.face")
+
+
+class _Memory:
+  """The in-memory cache of one face cropper configuration, with the :py:class:`CropCache` instances that use it."""
+
+  def __init__(self):
+    self.faces = collections.OrderedDict()
+    self.users = weakref.WeakSet()
+    self.lock = threading.Lock()
+
+
+class CropCache:
+  """Caches the faces cropped by a face cropper, so that several photometric preprocessors can re-use the same geometric crop of an image.
+
+  The cache is keyed by the content of the image, the annotations and the configuration of the face cropper.
+  Hence, the in-memory cache is shared between all :py:class:`CropCache` instances with identically configured face croppers: two preprocessors that wrap, e.g., ``'face-crop-eyes'``, will crop each image only once.
+  Each face cropper configuration has its own in-memory cache, from which the least recently used crops are removed when more than ``max_size`` faces are stored.
+  When several instances share a configuration, the largest ``max_size`` of the instances that still exist applies, so that an instance cannot evict the crops that another instance keeps.
+  The in-memory cache is released when the last instance with its configuration is deleted, and it can be used from several threads.
+  Additionally, the cropped faces can be stored on disk, so that they are re-used across experiments.
+
+  .. note::
+     Only the cropped faces are cached.
+     Side results of the cropper, such as the ``quality`` of the :py:class:`FaceDetect`, are not updated when a face is taken from the cache.
+
+  **Parameters:**
+
+  face_cropper : str or :py:class:`FaceCrop` or :py:class:`FaceDetect`
+    The face cropper to cache the results of.
+    It might be specified as a registered resource, a configuration file, or an instance of a preprocessor.
+
+  max_size : int
+    The maximum number of cropped faces of this face cropper configuration to keep in memory.
+
+  cache_directory : str or ``None``
+    If given, the cropped faces are additionally stored in (and read from) HDF5 files in this directory.
+  """
+
+  # the in-memory caches, which are shared between all existing instances with the same face cropper configuration
+  _memories = weakref.WeakValueDictionary()
+  _lock = threading.Lock()
+
+  def __init__(self, face_cropper, max_size = 1000, cache_directory = None):
+    from .utils import load_cropper
+    self.cropper = load_cropper(face_cropper)
+    assert self.cropper is not None
+    if isinstance(self.cropper, CropCache):
+      self.cropper = self.cropper.cropper
+    self.max_size = max_size
+    self.cache_directory = cache_directory
+    # the configuration of the face cropper, which is part of the key
+    self._config = str(self.cropper).encode('utf-8')
+    with CropCache._lock:
+      self._memory = CropCache._memories.get(self._config)
+      if self._memory is None:
+        self._memory = CropCache._memories[self._config] = _Memory()
+    with self._memory.lock:
+      self._memory.users.add(self)
+    self.hits = 0
+    self.misses = 0
+
+
+  def __str__(self):
+    return "CropCache(%s)" % self.cropper
+
+
+  def _key(self, image, annotations):
+    """Computes the key of the given image and annotations for the current face cropper."""
+    image = numpy.ascontiguousarray(image)
+    key = hashlib.sha1(self._config)
+    key.update(str((image.shape, image.dtype.str)).encode('utf-8'))
+    key.update(image.data)
+    if annotations is not None:
+      key.update(str(sorted(annotations.items())).encode('utf-8'))
+    return key.hexdigest()
+
+
+  def _filename(self, key):
+    return os.path.join(self.cache_directory, key[:2], key + ".hdf5")
+
+
+  def _store(self, key, face):
+    """Stores the given face in memory, and removes the least recently used faces."""
+    with self._memory.lock:
+      faces = self._memory.faces
+      faces[key] = face
+      max_size = max(user.max_size for user in self._memory.users)
+      while len(faces) > max_size:
+        faces.popitem(last = False)
+
+
+  def _lookup(self, key):
+    """Returns the face stored in memory under the given key and marks it as recently used, or returns ``None``."""
+    with self._memory.lock:
+      face = self._memory.faces.pop(key, None)
+      if face is not None:
+        self._memory.faces[key] = face
+      return face
+
+
+  def crop_face(self, image, annotations = None):
+    """crop_face(image, annotations = None) -> face
+
+    Returns the cropped face from the cache, or crops the face using the face cropper and stores it in the cache.
+
+    **Parameters:**
+
+    image : 2D or 3D :py:class:`numpy.ndarray`
+      The face image to be processed.
+
+    annotations : dict or ``None``
+      The annotations that fit to the given image.
+
+    **Returns:**
+
+    face : 2D or 3D :py:class:`numpy.ndarray` (float)
+      The cropped face.
+    """
+    key = self._key(image, annotations)
+
+    # look into memory
+    face = self._lookup(key)
+    if face is not None:
+      self.hits += 1
+      return face.copy()
+
+    # look onto disk
+    if self.cache_directory is not None and os.path.exists(self._filename(key)):
+      try:
+        face = bob.io.base.load(self._filename(key))
+        self._store(key, face)
+        self.hits += 1
+        return face.copy()
+      except (IOError, RuntimeError) as e:
+        logger.warn("Could not read cached face from file %s: %s", self._filename(key), e)
+
+    # crop the face
+    self.misses += 1
+    face = self.cropper.crop_face(image, annotations)
+    self._store(key, face.copy())
+    if self.cache_directory is not None:
+      atomic_write(lambda data, filename: bob.io.base.save(data, filename), face, self._filename(key))
+    return face
@@ -123,6 +123,8 @@ class FaceCrop (Base):
     # create objects required for face cropping
     self.cropper = bob.ip.base.FaceEyesNorm(crop_size=cropped_image_size, right_eye=cropped_positions[self.cropped_keys[0]], left_eye=cropped_positions[self.cropped_keys[1]])
     self.cropped_mask = numpy.ndarray(cropped_image_size, numpy.bool)
+    # the full input mask, which is re-used for images of the same size
+    self.mask = None
 
 
   def crop_face(self, image, annotations = None):
@@ -154,7 +156,8 @@ class FaceCrop (Base):
       raise ValueError("At least one of the expected annotations '%s' are not given in '%s'." % (self.cropped_keys, annotations.keys()))
 
     # create output
-    mask = numpy.ones(image.shape[-2:], dtype=numpy.bool)
+    if self.mask is None or self.mask.shape != image.shape[-2:]:
+      self.mask = numpy.ones(image.shape[-2:], dtype=numpy.bool)
     shape = self.cropped_image_size if image.ndim == 2 else [image.shape[0]] + list(self.cropped_image_size)
     cropped_image = numpy.zeros(shape)
     self.cropped_mask[:] = False
@@ -162,7 +165,7 @@ class FaceCrop (Base):
     # perform the cropping
     self.cropper(
         image,  # input image
-        mask,   # full input mask
+        self.mask,   # full input mask
         cropped_image, # cropped image
         self.cropped_mask,  # cropped mask
         right_eye = annotations[self.cropped_keys[0]], # position of first annotation, usually right eye
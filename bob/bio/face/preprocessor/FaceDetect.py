@@ -8,6 +8,7 @@ import bob.ip.base
 import numpy
 
 from .Base import Base
+from .CascadeDetector import CascadeDetector
 from .utils import load_cropper_only
 from bob.bio.base.preprocessor import Preprocessor
 
@@ -59,6 +60,27 @@ class FaceDetect (Base):
   lowest_scale : float
     See the Sampling section in the :ref:`Users Guide of bob.ip.facedetect <bob.ip.facedetect>`.
 
+  multiple_faces : bool
+    If selected, all faces in the image are detected and cropped, see :py:meth:`crop_faces`.
+    In this case, :py:meth:`__call__` returns a stack of cropped faces, which might also be empty.
+
+  detection_threshold : float
+    Only used when ``multiple_faces = True``.
+    The minimum prediction value of the cascade, so that a bounding box is considered to contain a face.
+
+  landmark_patch_size : (int, int) or ``None``
+    Only used when ``use_flandmark = True``.
+    If specified, the detected face (plus a small margin) is cut out of the image and scaled such that the face has the given size ``(height, width)``, before the landmarks are localized in this small patch.
+    This speeds up landmark localization in high-resolution images.
+    If ``None``, landmarks are localized in the original image.
+
+  landmark_quality_threshold : float or ``None``
+    Only used when ``use_flandmark = True``.
+    If specified, landmark localization is skipped for faces that are detected with a quality of at least this threshold, and the eye positions are estimated from the bounding box instead.
+
+  vectorized_detection : bool
+    If selected, the :py:class:`CascadeDetector` is used to evaluate the ``cascade`` on all bounding boxes of a pyramid level at once, instead of evaluating it on one bounding box after the other.
+
   kwargs
     Remaining keyword parameters passed to the :py:class:`Base` constructor, such as ``color_channel`` or ``dtype``.
   """
@@ -72,6 +94,11 @@ class FaceDetect (Base):
       distance = 2,
       scale_base = math.pow(2., -1./16.),
       lowest_scale = 0.125,
+      multiple_faces = False,
+      detection_threshold = 0.,
+      landmark_patch_size = None,
+      landmark_quality_threshold = None,
+      vectorized_detection = False,
       **kwargs
   ):
     # call base class constructors
@@ -85,7 +112,12 @@ class FaceDetect (Base):
       detection_overlap = detection_overlap,
       distance = distance,
       scale_base = scale_base,
-      lowest_scale = lowest_scale
+      lowest_scale = lowest_scale,
+      multiple_faces = multiple_faces,
+      detection_threshold = detection_threshold,
+      landmark_patch_size = landmark_patch_size,
+      landmark_quality_threshold = landmark_quality_threshold,
+      vectorized_detection = vectorized_detection
     )
 
     assert face_cropper is not None
@@ -95,27 +127,73 @@ class FaceDetect (Base):
       self.cascade = bob.ip.facedetect.default_cascade()
     else:
       self.cascade = bob.ip.facedetect.Cascade(bob.io.base.HDF5File(cascade))
+    self.detector = CascadeDetector(self.cascade, distance, scale_base, lowest_scale) if vectorized_detection else None
     self.detection_overlap = detection_overlap
     self.flandmark = bob.ip.flandmark.Flandmark() if use_flandmark else None
+    self.landmark_patch_size = landmark_patch_size
+    self.landmark_quality_threshold = landmark_quality_threshold
     self.quality = None
+    self.multiple_faces = multiple_faces
+    self.detection_threshold = detection_threshold
+    # the results of the last call to crop_faces
+    self.bounding_boxes = []
+    self.qualities = []
+    self.eye_positions = []
+    # buffers for the conversion of images, which are re-used between calls
+    self._buffers = {}
 
     self.cropper = load_cropper_only(face_cropper)
 
 
-  def _landmarks(self, image, bounding_box):
+  def _locate_in_patch(self, image, bb):
+    """Localizes the landmarks in a patch of the image, which is scaled such that the given bounding box has size ``landmark_patch_size``."""
+    # cut out the face region including a margin of a quarter of the face size
+    margin = (bb.size_f[0] / 4., bb.size_f[1] / 4.)
+    top = max(int(bb.top_f - margin[0]), 0)
+    left = max(int(bb.left_f - margin[1]), 0)
+    bottom = min(int(math.ceil(bb.bottom_f + margin[0])), image.shape[0])
+    right = min(int(math.ceil(bb.right_f + margin[1])), image.shape[1])
+    region = image[top:bottom, left:right]
+
+    # scale the region such that the face gets the desired size
+    shape = [max(int(round(region.shape[i] * self.landmark_patch_size[i] / bb.size_f[i])), 2) for i in (0,1)]
+    scaled = numpy.ndarray(shape)
+    bob.ip.base.scale(region, scaled)
+    patch = numpy.round(scaled).astype(numpy.uint8)
+
+    # the scaling factors, as applied by bob.ip.base.scale
+    scale = [float(shape[i] - 1) / max(region.shape[i] - 1, 1) for i in (0,1)]
+
+    # localize the landmarks inside the patch
+    p_top = max(int((bb.top_f - top) * scale[0]), 0)
+    p_left = max(int((bb.left_f - left) * scale[1]), 0)
+    p_bottom = min(int((bb.bottom_f - top) * scale[0]), shape[0])
+    p_right = min(int((bb.right_f - left) * scale[1]), shape[1])
+    landmarks = self.flandmark.locate(patch, p_top, p_left, p_bottom - p_top, p_right - p_left)
+
+    if landmarks is None:
+      return None
+    # map the landmarks back to the original image
+    return [(l[0] / scale[0] + top, l[1] / scale[1] + left) for l in landmarks]
+
+
+  def _landmarks(self, image, bounding_box, quality = None):
     """Try to detect the landmarks in the given bounding box, and return the eye locations."""
     # get the landmarks in the face
-    if self.flandmark is not None:
+    if self.flandmark is not None and (self.landmark_quality_threshold is None or quality is None or quality < self.landmark_quality_threshold):
       # use the flandmark detector
 
       # make the bounding box square shape by extending the horizontal position by 2 pixels times width/20
       bb = bob.ip.facedetect.BoundingBox(topleft = (bounding_box.top_f, bounding_box.left_f - bounding_box.size[1] / 10.), size = bounding_box.size)
 
-      top = max(bb.top, 0)
-      left = max(bb.left, 0)
-      bottom = min(bb.bottom, image.shape[0])
-      right = min(bb.right, image.shape[1])
-      landmarks = self.flandmark.locate(image, top, left, bottom-top, right-left)
+      if self.landmark_patch_size is not None:
+        landmarks = self._locate_in_patch(image, bb)
+      else:
+        top = max(bb.top, 0)
+        left = max(bb.left, 0)
+        bottom = min(bb.bottom, image.shape[0])
+        right = min(bb.right, image.shape[1])
+        landmarks = self.flandmark.locate(image, top, left, bottom-top, right-left)
 
       if landmarks is not None and len(landmarks):
         return {
@@ -129,6 +207,124 @@ class FaceDetect (Base):
     return bob.ip.facedetect.expected_eye_positions(bounding_box)
 
 
+  def _buffer(self, name, shape):
+    """Returns the uint8 buffer with the given name, which is only re-allocated when the shape changes."""
+    if name not in self._buffers or self._buffers[name].shape != shape:
+      self._buffers[name] = numpy.ndarray(shape, numpy.uint8)
+    return self._buffers[name]
+
+
+  def _detection_image(self, image):
+    """Returns the gray level uint8 image, in which faces and landmarks are detected.
+
+    At most one conversion of the data type and one color conversion are performed.
+    The results are written into buffers that are re-used for images of the same size, and which are only valid until the next call.
+    """
+    if image.dtype != numpy.uint8:
+      # convert the data type (truncating values, as numpy.astype does)
+      converted = self._buffer('color' if image.ndim == 3 else 'gray', image.shape)
+      numpy.copyto(converted, image, casting='unsafe')
+      image = converted
+    if image.ndim == 3:
+      # convert to gray level
+      gray = self._buffer('gray', image.shape[1:])
+      bob.ip.color.rgb_to_gray(image, gray)
+      image = gray
+    return image
+
+
+  def _average_detection(self, face, detections, predictions):
+    """Averages all detections that overlap with the given face, weighted by their predictions."""
+    top = left = bottom = right = weights = 0.
+    for detection, prediction in zip(detections, predictions):
+      if prediction > 0 and face.similarity(detection) > self.detection_overlap:
+        top += prediction * detection.top_f
+        left += prediction * detection.left_f
+        bottom += prediction * detection.bottom_f
+        right += prediction * detection.right_f
+        weights += prediction
+    if weights == 0.:
+      return face
+    return bob.ip.facedetect.BoundingBox(topleft = (top / weights, left / weights), size = ((bottom - top) / weights, (right - left) / weights))
+
+
+  def detect_faces(self, image):
+    """detect_faces(image) -> bounding_boxes, qualities
+
+    Detects all faces in the given gray level image.
+
+    The image pyramid is scanned only once with the face detector ``cascade``, and all bounding boxes with a prediction larger than ``detection_threshold`` are collected.
+    Afterward, overlapping detections are pruned using non-maximum suppression, where the ``detection_overlap`` defines the minimum overlap of two boxes to be considered as the same face.
+    Finally, each remaining bounding box is refined by averaging all detections that overlap with it.
+
+    **Parameters:**
+
+    image : 2D :py:class:`numpy.ndarray` (uint8)
+      The gray level image to detect the faces in.
+
+    **Returns:**
+
+    bounding_boxes : [:py:class:`bob.ip.facedetect.BoundingBox`]
+      The detected faces, sorted by their quality, with the best detection first.
+
+    qualities : [float]
+      The qualities of the detected faces, i.e., the predictions of the cascade.
+    """
+    if self.detector is not None:
+      return self.detector.detect_all_faces(image, self.detection_threshold, self.detection_overlap)
+
+    detections, predictions = [], []
+    # scan the image pyramid once for all faces
+    for prediction, bounding_box in self.sampler.iterate_cascade(self.cascade, image, self.detection_threshold):
+      detections.append(bounding_box)
+      predictions.append(prediction)
+
+    if not detections:
+      return [], []
+
+    # keep only one bounding box per face
+    faces, qualities = bob.ip.facedetect.prune_detections(detections, numpy.array(predictions), self.detection_overlap)
+
+    return [self._average_detection(face, detections, predictions) for face in faces], list(qualities)
+
+
+  def crop_faces(self, image, annotations=None):
+    """crop_faces(image, annotations = None) -> faces
+
+    Detects all faces (and their facial landmarks) in the given image, and uses the ``face_cropper`` given in the constructor to crop them.
+
+    The detected bounding boxes, their qualities and the eye positions used for cropping are stored in the ``bounding_boxes``, ``qualities`` and ``eye_positions`` members of this class, in the same order as the returned faces.
+
+    **Parameters:**
+
+    image : 2D or 3D :py:class:`numpy.ndarray`
+      The image to be processed.
+
+    annotations : any
+      Ignored.
+
+    **Returns:**
+
+    faces : 3D or 4D :py:class:`numpy.ndarray` (float)
+      The stack of detected and cropped faces, with the best detection first.
+      If no face is detected, the stack is empty.
+    """
+    uint8_image = self._detection_image(image)
+
+    # detect all faces
+    self.bounding_boxes, self.qualities = self.detect_faces(uint8_image)
+
+    # get the eye landmarks of all faces
+    self.eye_positions = [self._landmarks(uint8_image, bounding_box, quality) for bounding_box, quality in zip(self.bounding_boxes, self.qualities)]
+
+    # apply face cropping
+    shape = tuple(self.cropper.cropped_image_size) if image.ndim == 2 else (image.shape[0],) + tuple(self.cropper.cropped_image_size)
+    faces = numpy.ndarray((len(self.eye_positions),) + shape)
+    for i, eyes in enumerate(self.eye_positions):
+      faces[i] = self.cropper.crop_face(image, eyes)
+    return faces
+
+
   def crop_face(self, image, annotations=None):
     """crop_face(image, annotations = None) -> face
 
@@ -147,15 +343,16 @@ class FaceDetect (Base):
     face : 2D or 3D :py:class:`numpy.ndarray` (float)
       The detected and cropped face.
     """
-    uint8_image = image.astype(numpy.uint8)
-    if uint8_image.ndim == 3:
-      uint8_image = bob.ip.color.rgb_to_gray(uint8_image)
+    uint8_image = self._detection_image(image)
 
     # detect the face
-    bounding_box, self.quality = bob.ip.facedetect.detect_single_face(uint8_image, self.cascade, self.sampler, self.detection_overlap)
+    if self.detector is not None:
+      bounding_box, self.quality = self.detector.detect_single_face(uint8_image, self.detection_overlap)
+    else:
+      bounding_box, self.quality = bob.ip.facedetect.detect_single_face(uint8_image, self.cascade, self.sampler, self.detection_overlap)
 
     # get the eye landmarks
-    annotations = self._landmarks(uint8_image, bounding_box)
+    annotations = self._landmarks(uint8_image, bounding_box, self.quality)
 
     # apply face cropping
     return self.cropper.crop_face(image, annotations)
@@ -168,6 +365,7 @@ class FaceDetect (Base):
 
     First, the desired color channel is extracted from the given image.
     Afterward, the face is detected and cropped, see :py:meth:`crop_face`.
+    When ``multiple_faces`` was selected in the constructor, all faces are detected and cropped instead, see :py:meth:`crop_faces`.
     Finally, the resulting face is converted to the desired data type.
 
     **Parameters:**
@@ -182,12 +380,13 @@ class FaceDetect (Base):
 
     face : 2D :py:class:`numpy.ndarray`
       The cropped face.
+      When ``multiple_faces`` was selected, a 3D stack of cropped faces is returned.
     """
     # convert to the desired color channel
     image = self.color_channel(image)
 
-    # detect face and crop it
-    image = self.crop_face(image)
+    # detect face(s) and crop
+    image = self.crop_faces(image) if self.multiple_faces else self.crop_face(image)
 
     # convert data type
     return self.data_type(image)
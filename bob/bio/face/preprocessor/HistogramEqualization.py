@@ -29,7 +29,7 @@ class HistogramEqualization (Base):
 
   **Parameters:**
 
-  face_cropper : str or :py:class:`bob.bio.face.preprocessor.FaceCrop` or :py:class:`bob.bio.face.preprocessor.FaceDetect` or ``None``
+  face_cropper : str or :py:class:`bob.bio.face.preprocessor.FaceCrop` or :py:class:`bob.bio.face.preprocessor.FaceDetect` or :py:class:`bob.bio.face.preprocessor.CropCache` or ``None``
     The face image cropper that should be applied to the image.
     If ``None`` is selected, no face cropping is performed.
     Otherwise, the face cropper might be specified as a registered resource, a configuration file, or an instance of a preprocessor.
@@ -40,6 +40,9 @@ class HistogramEqualization (Base):
     Remaining keyword parameters passed to the :py:class:`Base` constructor, such as ``color_channel`` or ``dtype``.
   """
 
+  # enhance_batch computes the same look-up tables as enhance
+  exact_batch = True
+
   def __init__(
       self,
       face_cropper,
@@ -73,11 +76,64 @@ class HistogramEqualization (Base):
     equalized : 2D :py:class:`numpy.ndarray` (float)
       The photometrically enhanced image.
     """
-    heq = numpy.ndarray(image.shape)
+    return self.enhance(image)
+
+
+  def enhance(self, image, output = None):
+    """enhance(image, output = None) -> enhanced
+
+    Photometrically enhances the given (cropped) image using histogram equalization.
+
+    **Parameters:**
+
+    image : 2D or 3D :py:class:`numpy.ndarray`
+      The image to enhance.
+      For 3D color images, all color channels are enhanced independently in one vectorized call, see :py:meth:`enhance_batch`.
+
+    output : 2D or 3D :py:class:`numpy.ndarray` or ``None``
+      If given, the enhanced image is written into this array, which needs to have the correct shape and data type.
+
+    **Returns:**
+
+    enhanced : 2D or 3D :py:class:`numpy.ndarray`
+      The photometrically enhanced image.
+    """
+    if image.ndim == 3:
+      return self._enhance_channels(image, output)
+    heq = numpy.ndarray(image.shape) if output is None else output
     bob.ip.base.histogram_equalization(numpy.round(image).astype(numpy.uint8), heq)
     return heq
 
 
+  def enhance_batch(self, images):
+    """enhance_batch(images) -> enhanced
+
+    Performs the histogram equalization on a whole stack of equally sized (cropped) images at once.
+
+    The histograms of all images are computed with a single call to :py:func:`numpy.bincount`, the cumulative distributions of all images are turned into look-up tables at once, and all images are re-mapped with a single indexing operation.
+    The results are identical to the ones of :py:meth:`enhance`.
+
+    **Parameters:**
+
+    images : 3D :py:class:`numpy.ndarray`
+      The stack of images to enhance.
+      The images will be transformed to type ``uint8`` before computing the histograms.
+
+    **Returns:**
+
+    enhanced : 3D :py:class:`numpy.ndarray` (float)
+      The stack of photometrically enhanced images.
+    """
+    images = numpy.round(images).astype(numpy.uint8)
+    count, size = images.shape[0], images[0].size
+    # compute the histograms of all images, with a separate range of 256 bins per image
+    offsets = numpy.arange(count, dtype = numpy.int64)[:,None] * 256
+    histograms = numpy.bincount((images.reshape(count, size) + offsets).ravel(), minlength = count * 256).reshape(count, 256)
+    # the cumulative distributions are the look-up tables
+    luts = numpy.cumsum(histograms / float(size), axis = 1) * 255.
+    return luts[numpy.arange(count)[:,None,None], images]
+
+
   def __call__(self, image, annotations = None):
     """__call__(image, annotations = None) -> face
 
@@ -99,8 +155,8 @@ class HistogramEqualization (Base):
 
     **Returns:**
 
-    face : 2D :py:class:`numpy.ndarray`
-      The cropped and photometrically enhanced face.
+    face : 2D or 3D :py:class:`numpy.ndarray`
+      The cropped and photometrically enhanced face; 3D if ``color_channel = 'rgb'`` was selected.
     """
     image = self.color_channel(image)
     if self.cropper is not None:
@@ -20,13 +20,22 @@
 import bob.ip.base
 
 import numpy
+import math
 from .Base import Base
 from .utils import load_cropper
 from bob.bio.base.preprocessor import Preprocessor
 
+def _greater_or_close(first, second):
+  """Compares the given arrays like :py:class:`bob.ip.base.LBP`, i.e., with a relative tolerance of 1e-5 and an absolute tolerance of 1e-8."""
+  return (first > second) | (numpy.abs(first - second) <= 1e-8 + 1e-5 * numpy.minimum(numpy.abs(first), numpy.abs(second)))
+
+
 class INormLBP (Base):
   """Performs I-Norm LBP on the given image"""
 
+  # enhance_batch reproduces the LBP codes of bob.ip.base.LBP
+  exact_batch = True
+
   def __init__(
       self,
       face_cropper,
@@ -39,7 +48,7 @@ class INormLBP (Base):
 
     """Parameters of the constructor of this preprocessor:
 
-    face_cropper : str or :py:class:`bob.bio.face.preprocessor.FaceCrop` or :py:class:`bob.bio.face.preprocessor.FaceDetect` or ``None``
+    face_cropper : str or :py:class:`bob.bio.face.preprocessor.FaceCrop` or :py:class:`bob.bio.face.preprocessor.FaceDetect` or :py:class:`bob.bio.face.preprocessor.CropCache` or ``None``
       The face image cropper that should be applied to the image.
       It might be specified as a registered resource, a configuration file, or an instance of a preprocessor.
 
@@ -87,6 +96,119 @@ class INormLBP (Base):
 
     self.cropper = load_cropper(face_cropper)
 
+    # parameters of the batch processing
+    self.radius = radius
+    self.is_circular = is_circular
+    self.compare_to_average = compare_to_average
+    self.elbp_type = elbp_type
+    # the sampling indices and weights for each image geometry
+    self._sampling = {}
+
+
+  def enhance(self, image, output = None):
+    """enhance(image, output = None) -> enhanced
+
+    Photometrically enhances the given (cropped) image using I-Norm LBP [HRM06]_.
+
+    **Parameters:**
+
+    image : 2D :py:class:`numpy.ndarray`
+      The image to enhance.
+
+    output : 2D :py:class:`numpy.ndarray` or ``None``
+      If given, the enhanced image is written into this array, which needs to have the correct shape and data type.
+
+    **Returns:**
+
+    enhanced : 2D :py:class:`numpy.ndarray`
+      The photometrically enhanced image, i.e., the LBP codes of type ``uint16``.
+    """
+    return self.lbp_extractor(image) if output is None else self.lbp_extractor(image, output)
+
+
+  def _neighbor_sampling(self, shape):
+    """Returns the flat indices and interpolation weights to sample the 8 neighbors of all pixels of an image with the given shape.
+
+    The sampling follows :py:class:`bob.ip.base.LBP` with ``border_handling = 'wrap'`` exactly: the interpolation weights of circular LBP's are computed from the wrapped pixel indices, which results in extrapolated values in the outer ``radius`` pixels.
+    """
+    if shape not in self._sampling:
+      height, width = shape
+      y, x = numpy.indices(shape)
+      sampling = []
+      for n in range(8):
+        if self.is_circular:
+          angle = -0.75 * math.pi + 2. * math.pi * n / 8
+          yy, xx = y + self.radius * math.sin(angle), x + self.radius * math.cos(angle)
+          top, bottom = (numpy.floor(yy).astype(int) + height) % height, (numpy.ceil(yy).astype(int) + height) % height
+          left, right = (numpy.floor(xx).astype(int) + width) % width, (numpy.ceil(xx).astype(int) + width) % width
+          indices = [(top * width + left).ravel(), (top * width + right).ravel(), (bottom * width + left).ravel(), (bottom * width + right).ravel()]
+          sampling.append((indices, (right - xx).ravel(), (bottom - yy).ravel()))
+        else:
+          r = int(round(self.radius))
+          dy, dx = ((-r,-r), (-r,0), (-r,r), (0,r), (r,r), (r,0), (r,-r), (0,-r))[n]
+          sampling.append(([(((y + dy) % height) * width + (x + dx) % width).ravel()], None, None))
+      self._sampling[shape] = sampling
+    return self._sampling[shape]
+
+
+  def enhance_batch(self, images):
+    """enhance_batch(images) -> enhanced
+
+    Extracts the LBP codes [HRM06]_ of a whole stack of equally sized (cropped) images at once.
+
+    The sampling positions of the 8 neighbors and their bilinear interpolation weights are computed only once per image geometry.
+    The neighbors of all pixels of all images are sampled with vectorized operations, wrapping around the image borders.
+    Afterward, the codes are computed according to the ``elbp_type`` and ``compare_to_average`` parameters.
+    Interpolation, border handling and the tolerant comparison of :py:class:`bob.ip.base.LBP` are reproduced exactly, so that the codes are identical to the ones of :py:meth:`enhance`.
+
+    **Parameters:**
+
+    images : 3D :py:class:`numpy.ndarray`
+      The stack of images to extract LBP codes from.
+
+    **Returns:**
+
+    enhanced : 3D :py:class:`numpy.ndarray` (uint16)
+      The stack of LBP code images.
+    """
+    images = numpy.asarray(images, dtype = numpy.float64)
+    flat = images.reshape(images.shape[0], -1)
+
+    # sample the 8 neighbors of all pixels of all images
+    neighbors = []
+    for indices, x_weights, y_weights in self._neighbor_sampling(images.shape[1:]):
+      if x_weights is None:
+        neighbors.append(flat[:, indices[0]])
+      else:
+        upper = x_weights * flat[:, indices[0]] + (1. - x_weights) * flat[:, indices[1]]
+        lower = x_weights * flat[:, indices[2]] + (1. - x_weights) * flat[:, indices[3]]
+        neighbors.append(y_weights * upper + (1. - y_weights) * lower)
+
+    center = flat
+    if self.compare_to_average:
+      # accumulate in the same order as bob.ip.base.LBP
+      center = flat.copy()
+      for neighbor in neighbors:
+        center += neighbor
+      center /= 9.
+
+    codes = numpy.zeros(flat.shape, numpy.uint16)
+    if self.elbp_type == 'regular':
+      for n in range(8):
+        codes |= _greater_or_close(neighbors[n], center).astype(numpy.uint16) << (7 - n)
+    elif self.elbp_type == 'transitional':
+      for n in range(8):
+        codes |= _greater_or_close(neighbors[n], neighbors[(n+1) % 8]).astype(numpy.uint16) << (7 - n)
+    elif self.elbp_type == 'direction-coded':
+      for n in range(4):
+        first, second = neighbors[n] - center, neighbors[n+4] - center
+        codes |= (first * second >= 0.).astype(numpy.uint16) << (6 - 2*n)
+        codes |= _greater_or_close(numpy.abs(first), numpy.abs(second)).astype(numpy.uint16) << (7 - 2*n)
+    else:
+      raise ValueError("The elbp_type '%s' is not known" % self.elbp_type)
+
+    return codes.reshape(images.shape)
+
 
   def __call__(self, image, annotations = None):
     """__call__(image, annotations = None) -> face
@@ -115,5 +237,5 @@ class INormLBP (Base):
     image = self.color_channel(image)
     if self.cropper is not None:
       image = self.cropper.crop_face(image, annotations)
-    image = self.lbp_extractor(image)
+    image = self.enhance(image)
     return self.data_type(image)
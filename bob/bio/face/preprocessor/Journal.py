@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import os
+import re
+import socket
+import threading
+import time
+
+import bob.io.base
+
+
+def atomic_write(write_function, data, filename):
+  """atomic_write(write_function, data, filename) -> None
+
+  Writes the given data into a temporary file next to the given file name, and renames it afterward.
+  Since renaming is atomic, the file either does not exist or contains the complete data, even when the writing process is interrupted.
+  The name of the temporary file contains the process and the thread id, so that several processes and threads can write the same file at the same time.
+
+  **Parameters:**
+
+  write_function : callable
+    The function to write the data, called as ``write_function(data, file_name)``, e.g., :py:meth:`bob.bio.base.preprocessor.Preprocessor.write_data`.
+
+  data : object
+    The data to write.
+
+  filename : str
+    The name of the file to write.
+  """
+  base, extension = os.path.splitext(filename)
+  # keep the extension, which might define the file format
+  temp_file = "%s.%d-%d.tmp%s" % (base, os.getpid(), threading.get_ident(), extension)
+  bob.io.base.create_directories_safe(os.path.dirname(filename))
+  try:
+    write_function(data, temp_file)
+    os.rename(temp_file, filename)
+  finally:
+    if os.path.exists(temp_file):
+      os.remove(temp_file)
+
+
+# the size of marker files; bob.bio.base removes smaller preprocessed and extracted files as incomplete, see bob.bio.base.utils.check_file
+MARKER_SIZE = 1000
+
+
+def _write_text(text, filename):
+  with open(filename, 'w') as f:
+    f.write(text)
+
+
+def write_marker(filename, location):
+  """write_marker(filename, location) -> None
+
+  Writes a marker file in place of a data file, whose content is stored in a packed store instead.
+  The marker describes where the data is stored, and it is padded to :py:data:`MARKER_SIZE` bytes, so that the checks for existing files of ``bob.bio.base`` accept it.
+
+  **Parameters:**
+
+  filename : str
+    The name of the data file, which is replaced by the marker.
+
+  location : str
+    The location of the data, e.g., the shard and the row, in a single line.
+  """
+  text = "%s\n" % location
+  atomic_write(_write_text, text + ' ' * (MARKER_SIZE - len(text)), filename)
+
+
+# the names of the temporary files written by atomic_write
+_temporary = re.compile(r"\.\d+(-\d+)?\.tmp(\.[^.]*)?$")
+
+
+def is_temporary_file(filename):
+  """Returns whether the given file name is the name of a temporary file written by :py:func:`atomic_write`."""
+  return _temporary.search(filename) is not None
+
+
+def remove_temporary_files(directory, max_age = 3600):
+  """remove_temporary_files(directory, max_age = 3600) -> removed
+
+  Removes the temporary files of :py:func:`atomic_write` from the given directory and all its sub-directories, which have been left behind by killed processes.
+  Only files that have not been modified for ``max_age`` seconds are removed, so that files that are currently written by other processes are kept.
+
+  **Parameters:**
+
+  directory : str
+    The directory to clean up.
+
+  max_age : float
+    The minimum time in seconds since the last modification of the removed files.
+
+  **Returns:**
+
+  removed : int
+    The number of removed files.
+  """
+  removed = 0
+  oldest = time.time() - max_age
+  for dirpath, _, filenames in os.walk(directory):
+    for filename in filenames:
+      if is_temporary_file(filename):
+        filename = os.path.join(dirpath, filename)
+        try:
+          if os.path.getmtime(filename) < oldest:
+            os.remove(filename)
+            removed += 1
+        except OSError:
+          # the file has been renamed or removed by another process
+          pass
+  return removed
+
+
+class Journal:
+  """An append-only record of completed work items, which allows to resume interrupted runs.
+
+  Each process appends to its own journal file in the given ``directory``, so that several processes on several machines can share the same journal.
+  When a journal is opened, all journal files in the directory are read.
+  Lines that have not been completely written, e.g., because the process was killed, are ignored.
+
+  **Parameters:**
+
+  directory : str
+    The directory of the journal files.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    self.entries = {}
+    if os.path.isdir(directory):
+      for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.journal'):
+          with open(os.path.join(directory, filename)) as f:
+            for line in f:
+              if line.endswith('\n') and '\t' in line:
+                name, value = line.rstrip('\n').split('\t', 1)
+                self.entries[name] = value
+    self._file = None
+
+
+  def __contains__(self, name):
+    return name in self.entries
+
+
+  def __len__(self):
+    return len(self.entries)
+
+
+  def get(self, name, default = None):
+    """get(name, default = None) -> value
+
+    Returns the value that was recorded for the given work item, or ``default`` if the item has not been completed.
+    """
+    return self.entries.get(name, default)
+
+
+  def record(self, name, value = ''):
+    """record(name, value = '') -> None
+
+    Records the given work item as completed, and immediately writes it into the journal file of this process.
+
+    **Parameters:**
+
+    name : str
+      The name of the work item; must not contain tabs or line breaks.
+
+    value : str
+      A value to store with the work item, e.g., the key of its output; must not contain line breaks.
+    """
+    if self._file is None:
+      bob.io.base.create_directories_safe(self.directory)
+      self._file = open(os.path.join(self.directory, "%s-%d.journal" % (socket.gethostname(), os.getpid())), 'a')
+    self._file.write("%s\t%s\n" % (name, value))
+    self._file.flush()
+    self.entries[name] = value
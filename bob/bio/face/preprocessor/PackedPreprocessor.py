@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import os
+import numpy
+
+import bob.bio.base
+
+from .PackedStore import PackedStore
+from .Journal import write_marker
+from bob.bio.base.preprocessor import Preprocessor
+
+class PackedPreprocessor (Preprocessor):
+  """Runs the given preprocessor, but writes the preprocessed faces into a :py:class:`PackedStore` instead of one HDF5 file per face.
+
+  The name of the file that would be written is used as the key in the store, so that extractors can read the preprocessed faces with the usual file names.
+  Reading a face returns a view into the memory-mapped store, without copying the data.
+
+  .. note::
+     Instead of the preprocessed data files, only small marker files that name the shard and the row of the face are written, so that the usual checks for existing files skip the faces that have already been preprocessed.
+     Several parallel jobs can write into the same store, see :py:class:`PackedStore`.
+
+  **Parameters:**
+
+  preprocessor : str or :py:class:`bob.bio.base.preprocessor.Preprocessor`
+    The preprocessor to run, or the name of a registered preprocessor resource.
+    The preprocessed faces must have a fixed shape.
+
+  directory : str
+    The directory of the :py:class:`PackedStore`.
+
+  shape : (int, int) or (int, int, int)
+    The shape of the preprocessed faces, e.g., ``(80, 64)`` for ``'face-crop-eyes'``.
+
+  dtype : :py:class:`numpy.dtype` or convertible
+    The data type of the preprocessed faces.
+
+  shard_size : int
+    The number of faces stored in each shard of the :py:class:`PackedStore`.
+  """
+
+  def __init__(
+      self,
+      preprocessor,
+      directory,
+      shape = (80, 64),
+      dtype = numpy.float64,
+      shard_size = 10000
+  ):
+
+    # call base class constructor with its set of parameters
+    Preprocessor.__init__(
+        self,
+        preprocessor = preprocessor,
+        directory = directory,
+        shape = shape,
+        dtype = str(dtype),
+        shard_size = shard_size
+    )
+
+    self.preprocessor = bob.bio.base.load_resource(preprocessor, 'preprocessor') if isinstance(preprocessor, str) else preprocessor
+    self.store = PackedStore(directory, shape, dtype, shard_size)
+
+
+  def __call__(self, image, annotations = None):
+    """__call__(image, annotations = None) -> face
+
+    Preprocesses the given image using the ``preprocessor`` given in the constructor.
+
+    **Parameters:**
+
+    image : 2D or 3D :py:class:`numpy.ndarray`
+      The face image to be processed.
+
+    annotations : dict or ``None``
+      The annotations that fit to the given image.
+
+    **Returns:**
+
+    face : 2D or 3D :py:class:`numpy.ndarray`
+      The preprocessed face.
+    """
+    return self.preprocessor(image, annotations)
+
+
+  def read_original_data(self, original_file_name):
+    """Reads the original data using the ``preprocessor`` given in the constructor."""
+    return self.preprocessor.read_original_data(original_file_name)
+
+
+  def write_data(self, data, data_file):
+    """write_data(data, data_file) -> None
+
+    Writes the given preprocessed face into the packed store, using the file name as the key.
+    Afterward, a marker file is written to the given file name, see :py:func:`write_marker`.
+
+    **Parameters:**
+
+    data : 2D or 3D :py:class:`numpy.ndarray`
+      The preprocessed face.
+
+    data_file : str
+      The name of the file, which serves as the key in the store.
+    """
+    key = os.path.abspath(data_file)
+    self.store.write(key, numpy.asarray(data, dtype = self.store.dtype))
+    write_marker(data_file, "%s\t%d" % self.store.index[key])
+
+
+  def read_data(self, data_file):
+    """read_data(data_file) -> data
+
+    Reads the preprocessed face from the packed store, without copying the data.
+
+    **Parameters:**
+
+    data_file : str
+      The name of the file, which serves as the key in the store.
+
+    **Returns:**
+
+    data : 2D or 3D :py:class:`numpy.ndarray`
+      A read-only view of the preprocessed face.
+    """
+    return self.store.read(os.path.abspath(data_file))
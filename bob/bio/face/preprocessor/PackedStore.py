@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import os
+import socket
+import numpy
+
+import bob.io.base
+
+class PackedStore:
+  """Stores many equally sized images (such as cropped faces) packed into few memory-mapped array files.
+
+  The images are stored in shards, each of which consists of one contiguous ``.npy`` array file with up to ``shard_size`` images, and an ``.index`` text file that maps the keys of the images to the rows of the array.
+  The array files are memory-mapped, so that reading an image does not copy any data.
+
+  Each writing process appends to its own shards, which are named after the host name and the process id.
+  Hence, several processes -- e.g., the parallel jobs of an experiment -- can write into the same ``directory`` at the same time.
+  Keys that are not found in the index are looked up in the index files again, so that images written by other processes can be read.
+
+  **Parameters:**
+
+  directory : str
+    The directory, where the shards are stored.
+
+  shape : (int, int) or (int, int, int)
+    The shape of each image, e.g., ``(80, 64)`` for faces cropped by ``'face-crop-eyes'``.
+
+  dtype : :py:class:`numpy.dtype` or convertible
+    The data type of the images.
+
+  shard_size : int
+    The number of images stored in each shard.
+  """
+
+  def __init__(self, directory, shape, dtype = numpy.float64, shard_size = 10000):
+    self.directory = directory
+    self.shape = tuple(shape)
+    self.dtype = numpy.dtype(dtype)
+    self.shard_size = shard_size
+
+    # the shard and row of each key
+    self.index = {}
+    self._shards = {}
+    self._writer = None
+    self._count = 0
+    self._index_file = None
+    self._load_index()
+
+
+  def _load_index(self):
+    """Reads the index files of all shards in the directory."""
+    if os.path.isdir(self.directory):
+      for filename in sorted(os.listdir(self.directory)):
+        if filename.endswith('.index'):
+          shard = filename[:-len('.index')]
+          with open(os.path.join(self.directory, filename)) as f:
+            for line in f:
+              # skip lines that have not been completely written
+              if line.endswith('\n') and '\t' in line:
+                key, row = line.rstrip('\n').rsplit('\t', 1)
+                self.index[key] = (shard, int(row))
+
+
+  def _filename(self, shard, extension):
+    return os.path.join(self.directory, '%s.%s' % (shard, extension))
+
+
+  def _writer_shard(self, number):
+    """Returns the name of the given shard of the current writing process."""
+    return 'shard-%s-%05d' % (self._writer, number)
+
+
+  def _shard(self, shard, writable = False):
+    """Returns the memory-mapped array of the given shard, creating it if necessary."""
+    if shard not in self._shards or (writable and not self._shards[shard][1]):
+      filename = self._filename(shard, 'npy')
+      if os.path.exists(filename):
+        array = numpy.load(filename, mmap_mode = 'r+' if writable else 'r')
+      else:
+        bob.io.base.create_directories_safe(self.directory)
+        array = numpy.lib.format.open_memmap(filename, mode = 'w+', dtype = self.dtype, shape = (self.shard_size,) + self.shape)
+      self._shards[shard] = (array, writable)
+    return self._shards[shard][0]
+
+
+  def __contains__(self, key):
+    return key in self.index
+
+
+  def __len__(self):
+    return len(self.index)
+
+
+  def keys(self):
+    """keys() -> keys
+
+    Returns the keys of all stored images, including the images written by other processes.
+    """
+    self._load_index()
+    return self.index.keys()
+
+
+  def write(self, key, data):
+    """write(key, data) -> None
+
+    Stores the given image under the given key.
+    If the key already exists, the stored image is overwritten.
+
+    **Parameters:**
+
+    key : str
+      The key of the image, e.g., the name of the file that would otherwise be written.
+
+    data : 2D or 3D :py:class:`numpy.ndarray`
+      The image to store, which must have the ``shape`` given in the constructor.
+    """
+    if data.shape != self.shape:
+      raise ValueError("The data shape %s does not fit to the shape %s of this store" % (data.shape, self.shape))
+    if key in self.index:
+      shard, row = self.index[key]
+      self._shard(shard, True)[row] = data
+      return
+
+    # the rows of this process follow the ones that were written with the same host name and process id before
+    writer = "%s-%d" % (socket.gethostname(), os.getpid())
+    if writer != self._writer:
+      self._writer = writer
+      self._index_file = None
+      self._count = 0
+      while os.path.exists(self._filename(self._writer_shard(self._count // self.shard_size), 'index')):
+        with open(self._filename(self._writer_shard(self._count // self.shard_size), 'index')) as f:
+          rows = sum(1 for line in f)
+        self._count += rows
+        if rows < self.shard_size:
+          break
+
+    # write the data first, and register it in the index afterward
+    number, row = divmod(self._count, self.shard_size)
+    shard = self._writer_shard(number)
+    self._shard(shard, True)[row] = data
+    if self._index_file is None or self._index_file[0] != shard:
+      if self._index_file is not None:
+        self._index_file[1].close()
+      self._index_file = (shard, open(self._filename(shard, 'index'), 'a'))
+    self._index_file[1].write("%s\t%d\n" % (key, row))
+    self._index_file[1].flush()
+    self.index[key] = (shard, row)
+    self._count += 1
+
+
+  def read(self, key):
+    """read(key) -> data
+
+    Returns the image stored under the given key, as a read-only view into the memory-mapped shard.
+
+    **Parameters:**
+
+    key : str
+      The key of the image.
+
+    **Returns:**
+
+    data : 2D or 3D :py:class:`numpy.ndarray`
+      The stored image, which is not copied.
+    """
+    if key not in self.index:
+      # the image might have been written by another process
+      self._load_index()
+    shard, row = self.index[key]
+    data = self._shard(shard)[row].view()
+    data.flags.writeable = False
+    return data
+
+
+  def flush(self):
+    """flush() -> None
+
+    Writes all modified shards and the index to disk.
+    """
+    for array, writable in self._shards.values():
+      if writable:
+        array.flush()
+    if self._index_file is not None:
+      self._index_file[1].flush()
+
+
+  def close(self):
+    """close() -> None
+
+    Flushes and closes all shards.
+    """
+    self.flush()
+    if self._index_file is not None:
+      self._index_file[1].close()
+      self._index_file = None
+    self._shards = {}
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import bob.io.base
+import bob.bio.base
+
+from .Base import Base
+from .utils import load_cropper
+from bob.bio.base.preprocessor import Preprocessor
+
+class PhotometricVariants (Base):
+  """Crops the face once and computes several photometrically enhanced variants of it, e.g., for score fusion experiments.
+
+  All variants of one image are written into the same HDF5 file, one dataset per variant name.
+  When reading the preprocessed data, all variants are read, or only those selected by ``read_variants``.
+  Hence, the same preprocessed files can be used by several experiments, each of which uses a different variant.
+
+  **Parameters:**
+
+  face_cropper : str or :py:class:`bob.bio.face.preprocessor.FaceCrop` or :py:class:`bob.bio.face.preprocessor.FaceDetect` or :py:class:`bob.bio.face.preprocessor.CropCache` or ``None``
+    The face image cropper that should be applied to the image.
+    If ``None`` is selected, no face cropping is performed.
+    Otherwise, the face cropper might be specified as a registered resource, a configuration file, or an instance of a preprocessor.
+
+  variants : [str] or {str : object}
+    The photometric preprocessors to apply, such as :py:class:`TanTriggs`, :py:class:`SelfQuotientImage`, :py:class:`HistogramEqualization` or :py:class:`INormLBP`.
+    When given as a list of registered resource names, the resource names are used as variant names.
+    Only the ``enhance`` and ``data_type`` methods of these preprocessors are used, i.e., their face croppers are ignored.
+
+  read_variants : str or [str] or ``None``
+    The variants returned by :py:meth:`read_data`.
+    If a single variant name is given, only the image of this variant is returned.
+    If ``None``, all variants are returned.
+
+  kwargs
+    Remaining keyword parameters passed to the :py:class:`Base` constructor, such as ``color_channel`` or ``dtype``.
+  """
+
+  def __init__(
+      self,
+      face_cropper,
+      variants = ('tan-triggs', 'self-quotient', 'histogram', 'inorm-lbp'),
+      read_variants = None,
+      **kwargs
+  ):
+
+    Base.__init__(self, **kwargs)
+
+    # call base class constructor with its set of parameters
+    Preprocessor.__init__(
+        self,
+        face_cropper = face_cropper,
+        variants = variants,
+        read_variants = read_variants
+    )
+
+    self.cropper = load_cropper(face_cropper)
+    if not isinstance(variants, dict):
+      variants = {name : name for name in variants}
+    self.variants = {}
+    for name, variant in variants.items():
+      self.variants[name] = bob.bio.base.load_resource(variant, 'preprocessor') if isinstance(variant, str) else variant
+      assert hasattr(self.variants[name], 'enhance')
+    self.read_variants = read_variants
+
+
+  def __call__(self, image, annotations = None):
+    """__call__(image, annotations = None) -> variants
+
+    Aligns the given image according to the given annotations and computes all photometric variants.
+
+    First, the desired color channel is extracted from the given image.
+    Afterward, the face is eventually cropped using the ``face_cropper`` specified in the constructor.
+    Then, the cropped face is photometrically enhanced by all ``variants``.
+    Finally, the resulting faces are converted to the desired data type.
+
+    **Parameters:**
+
+    image : 2D or 3D :py:class:`numpy.ndarray`
+      The face image to be processed.
+
+    annotations : dict or ``None``
+      The annotations that fit to the given image.
+      Might be ``None``, when the ``face_cropper`` is ``None`` or of type :py:class:`FaceDetect`.
+
+    **Returns:**
+
+    variants : {str : 2D :py:class:`numpy.ndarray`}
+      The cropped and photometrically enhanced faces, one for each variant name.
+    """
+    image = self.color_channel(image)
+    if self.cropper is not None:
+      image = self.cropper.crop_face(image, annotations)
+    return {name : self.data_type(variant.data_type(variant.enhance(image))) for name, variant in self.variants.items()}
+
+
+  def _write_data(self, data, data_file):
+    """_write_data(data, data_file) -> None
+
+    Writes all variants into the given HDF5 file, one dataset per variant name.
+    This function is called by :py:meth:`Base.write_data`, which writes the file atomically.
+
+    **Parameters:**
+
+    data : {str : 2D :py:class:`numpy.ndarray`}
+      The preprocessed variants, as returned by :py:meth:`__call__`.
+
+    data_file : str or :py:class:`bob.io.base.HDF5File`
+      The file to write the variants into.
+    """
+    if isinstance(data_file, bob.io.base.HDF5File):
+      for name in sorted(data):
+        data_file.set(name, data[name])
+    else:
+      # the file needs to be closed before it is renamed by Base.write_data
+      hdf5 = bob.io.base.HDF5File(data_file, 'w')
+      try:
+        self._write_data(data, hdf5)
+      finally:
+        hdf5.close()
+
+
+  def read_data(self, data_file, variants = None):
+    """read_data(data_file, variants = None) -> data
+
+    Reads the selected variants from the given HDF5 file.
+
+    **Parameters:**
+
+    data_file : str or :py:class:`bob.io.base.HDF5File`
+      The file to read the variants from.
+
+    variants : str or [str] or ``None``
+      The variants to read; if ``None``, the ``read_variants`` given in the constructor are used.
+
+    **Returns:**
+
+    data : 2D :py:class:`numpy.ndarray` or {str : 2D :py:class:`numpy.ndarray`}
+      The image of the variant, if a single variant name is selected, otherwise a dictionary of the selected variants.
+    """
+    hdf5 = data_file if isinstance(data_file, bob.io.base.HDF5File) else bob.io.base.HDF5File(data_file)
+    variants = variants if variants is not None else self.read_variants
+    if isinstance(variants, str):
+      return hdf5.read(variants)
+    if variants is None:
+      variants = [key.lstrip('/') for key in hdf5.keys(relative = True)]
+    return {name : hdf5.read(name) for name in variants}
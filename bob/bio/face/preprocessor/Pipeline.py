@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import numpy
+
+import bob.bio.base
+
+from .Base import Base
+from bob.bio.base.preprocessor import Preprocessor
+
+
+def _describe(stage):
+  """Returns a description of the given stage that does not change between runs, which is recorded as the configuration of the :py:class:`Pipeline`."""
+  if isinstance(stage, str):
+    return stage
+  if isinstance(stage, Preprocessor):
+    # the class name and the constructor parameters
+    return str(stage)
+  if callable(stage) and hasattr(stage, '__qualname__'):
+    return "%s.%s" % (stage.__module__, stage.__qualname__)
+  raise ValueError("The stage '%r' cannot be described by a resource name, its parameters or its function name" % (stage,))
+
+
+class Pipeline (Base):
+  """Composes several preprocessing stages, such as face cropping, face detection and photometric enhancement, into one preprocessor.
+
+  The stages are specified declaratively as a list, where each element might be:
+
+  * a face cropper, i.e., an object with a ``crop_face`` method such as :py:class:`FaceCrop` or :py:class:`FaceDetect`,
+  * a photometric preprocessor with an ``enhance`` method, such as :py:class:`TanTriggs`, :py:class:`INormLBP`, :py:class:`HistogramEqualization` or :py:class:`SelfQuotientImage`; if this preprocessor contains a face cropper, the face cropper is added as a separate stage in front of it,
+  * any other function that takes a single image and returns the processed image, or
+  * the name of a registered preprocessor resource, which is loaded and handled as above.
+
+  The stages are run fused: the color channel is extracted only once before the first stage, and the data type is converted only once after the last stage.
+  The outputs of the photometric enhancement stages are written into buffers, which are planned at the first call and re-used for all following images of the same size.
+  A buffer is shared between enhancement stages, whenever its contents are no longer required.
+  Buffers that are passed to face croppers or functions are never re-used, since these might keep references to their input, and outputs that share memory with a buffer without being written into it by an enhancement stage are copied.
+
+  In the configuration of the pipeline, the stages are recorded by their resource names, by their class names and parameters, or by their function names.
+
+  **Parameters:**
+
+  stages : [object or str]
+    The list of stages to be run, in the given order.
+
+  kwargs
+    Remaining keyword parameters passed to the :py:class:`Base` constructor, such as ``color_channel`` or ``dtype``.
+  """
+
+  def __init__(
+      self,
+      stages,
+      **kwargs
+  ):
+
+    Base.__init__(self, **kwargs)
+
+    # call base class constructor with its set of parameters
+    Preprocessor.__init__(
+        self,
+        stages = [_describe(stage) for stage in stages]
+    )
+
+    self.stages = []
+    for stage in stages:
+      self.stages.extend(self._load_stage(stage))
+
+    # the planned buffers for each input shape, one entry per stage
+    self._plans = {}
+
+
+  def _load_stage(self, stage):
+    """Returns the list of ``(kind, stage)`` tuples for the given stage specification."""
+    if isinstance(stage, str):
+      stage = bob.bio.base.load_resource(stage, 'preprocessor')
+    if hasattr(stage, 'enhance'):
+      if getattr(stage, 'cropper', None) is not None:
+        return [('crop', stage.cropper), ('enhance', stage)]
+      return [('enhance', stage)]
+    if hasattr(stage, 'crop_face'):
+      return [('crop', stage)]
+    if callable(stage):
+      return [('function', stage)]
+    raise ValueError("The given stage '%s' is neither a face cropper, nor a photometric preprocessor, nor a function" % stage)
+
+
+  def _plan(self, inputs, outputs):
+    """Assigns buffers to the outputs of the enhancement stages, together with the input shapes that they were planned for.
+
+    A buffer can be re-used by a later enhancement stage, unless it contains the input of that stage, or it has been passed to a face cropper or function.
+    """
+    plan, buffers, previous, escaped = [None] * len(self.stages), [], None, set()
+    for i, (kind, _) in enumerate(self.stages):
+      if kind != 'enhance':
+        # the stage might keep a reference to its input buffer; its output is never a buffer, see _run
+        if previous is not None:
+          escaped.add(previous)
+        previous = None
+        continue
+      output = outputs[i]
+      candidates = [b for b, buffer in enumerate(buffers) if b != previous and b not in escaped and buffer.shape == output.shape and buffer.dtype == output.dtype]
+      if candidates:
+        previous = candidates[0]
+      else:
+        buffers.append(numpy.ndarray(output.shape, output.dtype))
+        previous = len(buffers) - 1
+      plan[i] = (inputs[i], buffers[previous])
+    return plan
+
+
+  def _run(self, image, annotations, plan):
+    """Runs all stages on the given image, writing the enhanced images into the planned buffers, if they fit."""
+    inputs, outputs = [], []
+    buffers = [entry[1] for entry in plan if entry is not None] if plan is not None else []
+    for i, (kind, stage) in enumerate(self.stages):
+      inputs.append(image.shape)
+      output = None
+      if kind == 'crop':
+        image = stage.crop_face(image, annotations)
+      elif kind == 'enhance':
+        if plan is not None and plan[i][0] == image.shape:
+          output = plan[i][1]
+        image = stage.enhance(image, output)
+      else:
+        image = stage(image)
+      if (output is None or image is not output) and any(numpy.may_share_memory(image, buffer) for buffer in buffers):
+        # the stage did not write into its own buffer, but returned a view of another buffer
+        image = image.copy()
+      outputs.append(image)
+    return image, inputs, outputs
+
+
+  def __call__(self, image, annotations = None):
+    """__call__(image, annotations = None) -> face
+
+    Runs all stages on the given image.
+
+    First, the desired color channel is extracted from the given image.
+    Afterward, all stages are applied in the given order, see :py:class:`Pipeline`.
+    Finally, the resulting face is converted to the desired data type.
+
+    **Parameters:**
+
+    image : 2D or 3D :py:class:`numpy.ndarray`
+      The face image to be processed.
+
+    annotations : dict or ``None``
+      The annotations that fit to the given image, which are passed to the face croppers.
+
+    **Returns:**
+
+    face : 2D :py:class:`numpy.ndarray`
+      The preprocessed face.
+    """
+    image = self.color_channel(image)
+
+    key = (image.shape, image.dtype)
+    plan = self._plans.get(key)
+    image, inputs, outputs = self._run(image, annotations, plan)
+    if plan is None:
+      # plan the buffers from the images computed in the first call
+      self._plans[key] = self._plan(inputs, outputs)
+    elif any(entry is not None and numpy.may_share_memory(image, entry[1]) for entry in plan):
+      # do not return the buffer that is overwritten by the next call
+      image = image.copy()
+
+    return self.data_type(image)
+
+
+  def process_batch(self, images, annotations = None):
+    """process_batch(images, annotations = None) -> faces
+
+    Runs all stages on a list of images.
+
+    The stages are run one after the other on all images.
+    When all images processed by a photometric enhancement stage have the same size, and the stage provides an ``enhance_batch`` method that is marked by ``exact_batch = True`` to give the same results as ``enhance`` (such as :py:meth:`TanTriggs.enhance_batch`), all images are enhanced at once.
+
+    **Parameters:**
+
+    images : [2D or 3D :py:class:`numpy.ndarray`]
+      The face images to be processed.
+
+    annotations : [dict] or ``None``
+      The annotations that fit to the given images, which are passed to the face croppers.
+
+    **Returns:**
+
+    faces : [2D :py:class:`numpy.ndarray`]
+      The preprocessed faces.
+    """
+    if annotations is None:
+      annotations = [None] * len(images)
+    images = [self.color_channel(image) for image in images]
+
+    for kind, stage in self.stages:
+      if kind == 'crop':
+        images = [stage.crop_face(image, annotation) for image, annotation in zip(images, annotations)]
+      elif kind == 'enhance' and getattr(stage, 'exact_batch', False) and len(images) and len(set(image.shape for image in images)) == 1:
+        images = list(stage.enhance_batch(numpy.array(images)))
+      elif kind == 'enhance':
+        images = [stage.enhance(image) for image in images]
+      else:
+        images = [stage(image) for image in images]
+
+    return [self.data_type(image) for image in images]
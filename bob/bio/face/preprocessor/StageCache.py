@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy
+
+import bob.io.base
+import bob.ip.gabor
+
+from .Journal import atomic_write, is_temporary_file
+from .CropCache import CropCache
+from bob.bio.base.preprocessor import Preprocessor
+from bob.bio.base.extractor import Extractor
+from bob.bio.base.algorithm import Algorithm
+
+import logging
+logger = logging.getLogger("bob.bio.face")
+
+
+def _saved_content(obj):
+  """Returns the datasets and attributes, which the given object writes into an HDF5 file using its ``save`` method."""
+  handle, filename = tempfile.mkstemp(prefix = 'bobhash_', suffix = '.hdf5')
+  os.close(handle)
+  try:
+    hdf5 = bob.io.base.HDF5File(filename, 'w')
+    obj.save(hdf5)
+    hdf5.close()
+    hdf5 = bob.io.base.HDF5File(filename)
+    content = {'/' : hdf5.get_attributes('/')}
+    for group in hdf5.sub_groups(relative = False, recursive = True):
+      content[group] = hdf5.get_attributes(group)
+    for path in hdf5.keys(relative = False):
+      content[path] = (hdf5.read(path), hdf5.get_attributes(path))
+    hdf5.close()
+    return content
+  finally:
+    os.remove(filename)
+
+
+def content_hash(*objects):
+  """content_hash(*objects) -> key
+
+  Computes a SHA-1 hash of a canonical representation of the given objects.
+
+  * Arrays and NumPy scalars are hashed by their shape, data type and content.
+  * ``None``, booleans, numbers, strings and byte strings are hashed by their type and value.
+  * Dictionaries are hashed by their items, sorted by the hashes of their keys, and lists and tuples element by element.
+  * Preprocessors, extractors and algorithms are hashed by their class and the parameters recorded in their constructor, :py:class:`CropCache` objects by their face cropper, and classes and functions by their module and name.
+  * Gabor jets are hashed by their absolute values and phases, and other objects that provide a ``save`` method, such as machines or GMM statistics, by the content that they write into an HDF5 file.
+
+  Since the representation of all other objects might not be stable, e.g., when it contains memory addresses, a :py:class:`TypeError` is raised for them.
+
+  **Parameters:**
+
+  objects : object
+    The objects to hash, e.g., the configuration of a stage and its input.
+
+  **Returns:**
+
+  key : str
+    The hexadecimal SHA-1 hash of all objects.
+  """
+  key = hashlib.sha1()
+  def _update(obj):
+    if isinstance(obj, numpy.generic):
+      obj = numpy.asarray(obj)
+    if isinstance(obj, numpy.ndarray):
+      if obj.dtype.hasobject:
+        raise TypeError("Cannot compute the content hash of arrays of objects")
+      obj = numpy.ascontiguousarray(obj)
+      key.update(("array%s%s" % (obj.shape, obj.dtype.str)).encode('utf-8'))
+      key.update(obj.data)
+    elif obj is None or isinstance(obj, (bool, int)):
+      key.update(("%s:%r" % (type(obj).__name__, obj)).encode('utf-8'))
+    elif isinstance(obj, float):
+      key.update(("float:%s" % float.__repr__(obj)).encode('utf-8'))
+    elif isinstance(obj, str):
+      key.update(("str%d:" % len(obj)).encode('utf-8') + obj.encode('utf-8'))
+    elif isinstance(obj, bytes):
+      key.update(("bytes%d:" % len(obj)).encode('utf-8') + obj)
+    elif isinstance(obj, dict):
+      key.update(("dict%d" % len(obj)).encode('utf-8'))
+      for k, v in sorted(obj.items(), key = lambda item : content_hash(item[0])):
+        _update(k)
+        _update(v)
+    elif isinstance(obj, (list, tuple)):
+      key.update(("list%d" % len(obj)).encode('utf-8'))
+      for o in obj:
+        _update(o)
+    elif isinstance(obj, (Preprocessor, Extractor, Algorithm)):
+      # the parameters that were recorded in the constructor of the stage
+      _update(type(obj))
+      _update(obj._kwargs)
+    elif isinstance(obj, CropCache):
+      # the cache does not change the cropped faces
+      _update(obj.cropper)
+    elif isinstance(obj, type) or callable(obj) and hasattr(obj, '__qualname__'):
+      name = "%s.%s" % (obj.__module__, obj.__qualname__)
+      if '<' in name:
+        raise TypeError("Cannot compute the content hash of the anonymous or local function %s" % name)
+      key.update(("callable:%s" % name).encode('utf-8'))
+    elif isinstance(obj, bob.ip.gabor.Jet):
+      _update(obj.jet)
+    elif hasattr(obj, 'save'):
+      key.update(("saved:%s" % type(obj).__name__).encode('utf-8'))
+      _update(_saved_content(obj))
+    else:
+      raise TypeError("Cannot compute the content hash of objects of type %s" % type(obj).__name__)
+  for obj in objects:
+    _update(obj)
+  return key.hexdigest()
+
+
+# the content hashes of the files read by read_hashed, by file name, modification time and size, and the last object read in each thread
+_file_hashes = {}
+_last_read = threading.local()
+
+
+def read_hashed(filename, read_function):
+  """read_hashed(filename, read_function) -> obj
+
+  Reads an object from file, and remembers its :py:func:`content_hash` for :py:func:`object_hash`.
+  The hash of each file is computed only once while the file is unchanged, so that files that are read repeatedly, such as the probes that are read once per model during scoring, are hashed once.
+
+  **Parameters:**
+
+  filename : str or :py:class:`bob.io.base.HDF5File`
+    The file to read; the hashes of open HDF5 files are not remembered.
+
+  read_function : callable
+    The function to read the object, called as ``read_function(filename)``.
+
+  **Returns:**
+
+  obj : object
+    The object read from file.
+  """
+  if not isinstance(filename, str):
+    return read_function(filename)
+  # the file is examined before reading, so that a file that is replaced in between is hashed again at the next read
+  stat = os.stat(filename)
+  obj = read_function(filename)
+  file_key = (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+  if file_key not in _file_hashes:
+    _file_hashes[file_key] = content_hash(obj)
+  _last_read.object = (obj, _file_hashes[file_key])
+  return obj
+
+
+def object_hash(obj):
+  """object_hash(obj) -> key
+
+  Returns the :py:func:`content_hash` of the given object, which is not re-computed when the object is the last object read by :py:func:`read_hashed` in this thread.
+  """
+  last = getattr(_last_read, 'object', None)
+  if last is not None and last[0] is obj:
+    return last[1]
+  return content_hash(obj)
+
+
+class StageCache:
+  """A content-addressed cache of the outputs of preprocessors and extractors, which is stored in a directory.
+
+  Outputs are stored under a key that is computed by :py:func:`content_hash` from the configuration of the stage and its input.
+  Since the key does not depend on the experiment, the same cache directory can be shared by several experiments, sub-directories and even several machines that share a file system.
+  Files are written under a temporary name and renamed afterward, so that no other process will ever read a partially written file.
+
+  When the size of all files in the cache exceeds ``max_size`` bytes, the least recently used files are deleted, until the cache occupies at most ``low_water`` times ``max_size`` bytes.
+  To be able to detect the least recently used files, the modification time of each file is updated whenever it is read from the cache.
+  The size of the cache is tracked incrementally, and the directory is only scanned when files need to be evicted, so that the cache can grow again by ``(1 - low_water) * max_size`` bytes before the next scan.
+  Files written by other processes are only taken into account at the next scan.
+
+  **Parameters:**
+
+  directory : str
+    The directory, where the cached outputs are stored.
+
+  max_size : int or ``None``
+    The maximum number of bytes that the cache might occupy; if ``None``, no files are ever deleted.
+
+  low_water : float
+    The fraction of ``max_size`` that the cache occupies after evicting files.
+  """
+
+  def __init__(self, directory, max_size = None, low_water = 0.9):
+    self.directory = directory
+    self.max_size = max_size
+    self.low_water = low_water
+    # the estimated size of the cache, which is updated by re-scanning the directory when it exceeds the maximum size
+    self._size = sum(size for _, _, size in self._files()) if max_size is not None else 0
+    self.hits = 0
+    self.misses = 0
+
+
+  def __str__(self):
+    return "StageCache(%s)" % self.directory
+
+
+  def filename(self, key, extension = ".hdf5"):
+    """filename(key, extension = ".hdf5") -> filename
+
+    Returns the name of the file that caches the output with the given key.
+    """
+    return os.path.join(self.directory, key[:2], key + extension)
+
+
+  def _files(self):
+    """Returns a list of (modification time, file name, size) of all files in the cache."""
+    files = []
+    if os.path.isdir(self.directory):
+      for dirpath, _, filenames in os.walk(self.directory):
+        for filename in filenames:
+          if is_temporary_file(filename) or not filename.endswith((".hdf5", ".scores")):
+            # skip files that are currently written by another process, and journal files
+            continue
+          filename = os.path.join(dirpath, filename)
+          try:
+            stat = os.stat(filename)
+          except OSError:
+            # the file has been deleted by another process
+            continue
+          files.append((stat.st_mtime, filename, stat.st_size))
+    return files
+
+
+  def __contains__(self, key):
+    return os.path.exists(self.filename(key))
+
+
+  def read(self, key, read_function):
+    """read(key, read_function) -> output or ``None``
+
+    Reads the cached output with the given key, and marks it as recently used.
+
+    **Parameters:**
+
+    key : str
+      The key of the output, see :py:func:`content_hash`.
+
+    read_function : callable
+      The function to read the output from file, e.g., :py:meth:`bob.bio.base.preprocessor.Preprocessor.read_data`.
+
+    **Returns:**
+
+    output : object or ``None``
+      The cached output, or ``None`` if the output is not cached.
+    """
+    filename = self.filename(key)
+    if os.path.exists(filename):
+      try:
+        output = read_function(filename)
+        os.utime(filename, None)
+        self.hits += 1
+        return output
+      except (IOError, OSError, RuntimeError) as e:
+        # the file might have been evicted by another process in the meantime
+        logger.warn("Could not read cached file %s: %s", filename, e)
+    self.misses += 1
+    return None
+
+
+  def write(self, key, output, write_function):
+    """write(key, output, write_function) -> None
+
+    Writes the given output into the cache, and evicts the least recently used outputs, if the cache is too large.
+
+    **Parameters:**
+
+    key : str
+      The key of the output, see :py:func:`content_hash`.
+
+    output : object
+      The output of the stage.
+
+    write_function : callable
+      The function to write the output to file, e.g., :py:meth:`bob.bio.base.preprocessor.Preprocessor.write_data`.
+    """
+    filename = self.filename(key)
+    atomic_write(write_function, output, filename)
+
+    self._size += os.path.getsize(filename)
+    if self.max_size is not None and self._size > self.max_size:
+      self.evict()
+
+
+  def cached_file(self, key, filename, create_function):
+    """cached_file(key, filename, create_function) -> None
+
+    Copies the cached file with the given key to the given file name, or creates the file and copies it into the cache.
+    This is used for files that are written by a stage itself, such as trained projectors.
+
+    **Parameters:**
+
+    key : str
+      The key of the file, see :py:func:`content_hash`.
+
+    filename : str
+      The name of the file to restore or to create.
+
+    create_function : callable
+      The function to create the file, called as ``create_function(filename)`` when the file is not cached.
+    """
+    copy = lambda source, target : shutil.copyfile(source, target)
+    if self.read(key, lambda cached : atomic_write(copy, cached, filename) or True) is None:
+      create_function(filename)
+      self.write(key, filename, copy)
+
+
+  def evict(self):
+    """evict() -> None
+
+    Deletes the least recently used files until the cache occupies at most ``low_water * max_size`` bytes.
+    """
+    files = sorted(self._files())
+    self._size = sum(size for _, _, size in files)
+    if self.max_size is None:
+      return
+    for _, filename, size in files:
+      if self._size <= self.low_water * self.max_size:
+        break
+      try:
+        os.remove(filename)
+      except OSError:
+        # the file has already been removed by another process
+        pass
+      self._size -= size
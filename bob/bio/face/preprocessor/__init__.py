@@ -1,11 +1,23 @@
 from .Base import Base
 from .FaceCrop import FaceCrop
 from .FaceDetect import FaceDetect
+from .CascadeDetector import CascadeDetector
+from .CropCache import CropCache
 
 from .TanTriggs import TanTriggs
 from .INormLBP import INormLBP
 from .HistogramEqualization import HistogramEqualization
 from .SelfQuotientImage import SelfQuotientImage
 
+from .Pipeline import Pipeline
+from .PhotometricVariants import PhotometricVariants
+
+from .PackedStore import PackedStore
+from .PackedPreprocessor import PackedPreprocessor
+
+from .Journal import Journal, atomic_write, write_marker, remove_temporary_files
+from .StageCache import StageCache, content_hash, read_hashed, object_hash
+from .CachedPreprocessor import CachedPreprocessor
+
 # gets sphinx autodoc done right - don't remove it
 __all__ = [_ for _ in dir() if not _.startswith('_')]
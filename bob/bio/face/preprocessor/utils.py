@@ -1,19 +1,24 @@
 import bob.bio.base
 
 
-def load_cropper(face_cropper):
+def load_cropper(face_cropper, cache = False, cache_directory = None):
   from .FaceCrop import FaceCrop
   from .FaceDetect import FaceDetect
+  from .CropCache import CropCache
   if face_cropper is None:
     cropper = None
   elif isinstance(face_cropper, str):
     cropper = bob.bio.base.load_resource(face_cropper, 'preprocessor')
-  elif isinstance(face_cropper, (FaceCrop, FaceDetect)):
+  elif isinstance(face_cropper, (FaceCrop, FaceDetect, CropCache)):
     cropper = face_cropper
   else:
     raise ValueError("The given face cropper type is not understood")
 
-  assert cropper is None or isinstance(cropper,  (FaceCrop, FaceDetect))
+  assert cropper is None or isinstance(cropper,  (FaceCrop, FaceDetect, CropCache))
+
+  # wrap the cropper into a cache of cropped faces, if desired
+  if cropper is not None and (cache or cache_directory is not None) and not isinstance(cropper, CropCache):
+    cropper = CropCache(cropper, cache_directory = cache_directory)
   return cropper
 
 
@@ -60,6 +60,7 @@ def command_line_arguments(command_line_parameters):
   parser.add_argument('-b', '--baseline-directory', default = 'baselines', help = 'The sub-directory, where the baseline results are stored.')
   # - the directories to write to
   parser.add_argument('-T', '--temp-directory', help = 'The directory to write temporary the data of the experiment into. If not specified, the default directory of the verify.py script is used (see ./bin/verify.py --help).')
+  parser.add_argument('-C', '--cache-directory', help = 'If given, the outputs of all stages are cached in this directory, which can be shared between experiments; when an experiment is re-run with --force (passed to the ./bin/verify.py script), only the outputs with changed inputs or configurations are recomputed.')
   parser.add_argument('-R', '--result-directory', help = 'The directory to write the resulting score files of the experiment into. If not specified, the default directories of the verify.py script are used (see ./bin/verify.py --help).')
 
   # - use the Idiap grid -- option is only useful if you are at Idiap
@@ -201,6 +202,13 @@ def main(command_line_parameters = None):
       # this is the default sub-directory that is used
       sub_directory = os.path.join(args.baseline_directory, algorithm)
 
+      # wrap all stages into caches, if desired
+      cached = args.cache_directory is not None and setup['preprocessor'] is not None
+      if cached:
+        setup['preprocessor'] = 'bob.bio.face.preprocessor.CachedPreprocessor(%r, %r)' % (setup['preprocessor'], args.cache_directory)
+        setup['extractor'] = 'bob.bio.face.extractor.CachedExtractor(%r, %r)' % (setup['extractor'], args.cache_directory)
+        setup['algorithm'] = 'bob.bio.face.algorithm.CachedAlgorithm(%r, %r)' % (setup['algorithm'], args.cache_directory)
+
       # create the command to the faceverify script
       command = [
           setup['script'],
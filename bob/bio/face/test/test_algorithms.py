@@ -19,6 +19,11 @@
 
 import bob.io.base
 import bob.ip.gabor
+import bob.math
+import bob.core
+import bob.learn.em
+
+from bob.bio.face.test.utils import temporary_directory
 
 import unittest
 import os
@@ -113,6 +118,115 @@ def test_histogram():
   assert abs(histogram.score_for_multiple_probes(model2, [feature2, feature2]) - reference) < 1e-5
 
 
+def test_cached_algorithm():
+  histogram = bob.bio.base.load_resource("histogram", "algorithm", preferred_package='bob.bio.face')
+  feature1 = bob.bio.base.load(pkg_resources.resource_filename('bob.bio.face.test', 'data/lgbphs_sparse.hdf5'))
+  feature2 = bob.bio.base.load(pkg_resources.resource_filename('bob.bio.face.test', 'data/lgbphs_with_phase.hdf5'))
+
+  with temporary_directory() as temp_dir:
+    cached = bob.bio.face.algorithm.CachedAlgorithm(histogram, temp_dir)
+    assert isinstance(cached, bob.bio.base.algorithm.Algorithm)
+    assert not cached.performs_projection
+    model = cached.enroll([feature1, feature1])
+    assert numpy.allclose(model, feature1)
+    assert abs(cached.score(model, feature1) - 40960.) < 1e-5
+    assert cached.cache.misses == 2
+
+    # a new experiment takes the model and the score from the cache, and computes only the score of the new probe
+    cached = bob.bio.face.algorithm.CachedAlgorithm("histogram", temp_dir)
+    model = cached.enroll([feature1, feature1])
+    assert abs(cached.score(model, feature1) - 40960.) < 1e-5
+    assert cached.cache.hits == 2 and cached.cache.misses == 0
+    assert abs(cached.score(model, feature1 * 2.) - histogram.score(model, feature1 * 2.)) < 1e-8
+    assert cached.cache.misses == 1
+
+    # a changed configuration invalidates the model and the scores
+    cached = bob.bio.face.algorithm.CachedAlgorithm(bob.bio.face.algorithm.Histogram(bob.math.histogram_intersection, is_distance_function = True), temp_dir)
+    model = cached.enroll([feature2, feature2])
+    assert abs(cached.score(model, feature2) + 81920.) < 1e-5
+    assert cached.cache.hits == 0 and cached.cache.misses == 2
+
+    # incomplete and malformed lines of the score files are skipped, and new scores are appended to complete lines
+    score_file = cached.cache.filename(cached._scores(model)[0], ".scores")
+    with open(score_file, 'a') as f:
+      f.write("malformed line\n%s 0." % bob.bio.face.preprocessor.content_hash(feature1))
+    cached = bob.bio.face.algorithm.CachedAlgorithm(bob.bio.face.algorithm.Histogram(bob.math.histogram_intersection, is_distance_function = True), temp_dir)
+    model = cached.enroll([feature2, feature2])
+    assert abs(cached.score(model, feature2) + 81920.) < 1e-5
+    assert cached.cache.hits == 2 and cached.cache.misses == 0
+    assert abs(cached.score(model, feature1) - histogram.score(model, feature1)) < 1e-8
+    assert cached.cache.misses == 1
+    cached = bob.bio.face.algorithm.CachedAlgorithm(bob.bio.face.algorithm.Histogram(bob.math.histogram_intersection, is_distance_function = True), temp_dir)
+    model = cached.enroll([feature2, feature2])
+    assert abs(cached.score(model, feature1) - histogram.score(model, feature1)) < 1e-8
+    assert cached.cache.misses == 0
+
+    # probes read from file are hashed only once
+    probe_file = os.path.join(temp_dir, 'probe.hdf5')
+    bob.bio.base.save(feature1, probe_file)
+    probe = cached.read_probe(probe_file)
+    assert bob.bio.face.preprocessor.object_hash(probe) == bob.bio.face.preprocessor.content_hash(feature1)
+    assert abs(cached.score(model, probe) - histogram.score(model, feature1)) < 1e-8
+    assert cached.cache.hits == 3
+
+    # trained projectors are restored from the cache, when the training features did not change
+    training_features = [numpy.random.RandomState(i).rand(10) for i in range(20)]
+    cached = bob.bio.face.algorithm.CachedAlgorithm(bob.bio.base.algorithm.PCA(3), temp_dir)
+    cached.train_projector(training_features, os.path.join(temp_dir, 'first', 'Projector.hdf5'))
+    assert cached.cache.misses == 1
+    cached = bob.bio.face.algorithm.CachedAlgorithm(bob.bio.base.algorithm.PCA(3), temp_dir)
+    cached.train_projector(training_features, os.path.join(temp_dir, 'second', 'Projector.hdf5'))
+    assert cached.cache.hits == 1 and cached.cache.misses == 0
+    with open(os.path.join(temp_dir, 'first', 'Projector.hdf5'), 'rb') as first, open(os.path.join(temp_dir, 'second', 'Projector.hdf5'), 'rb') as second:
+      assert first.read() == second.read()
+    cached.train_projector(training_features[1:], os.path.join(temp_dir, 'third', 'Projector.hdf5'))
+    assert cached.cache.misses == 1
+
+
+def test_ubm_trainer():
+  # two clusters of features with different sizes and variances
+  random = numpy.random.RandomState(42)
+  with temporary_directory() as temp_dir:
+    matrix = bob.bio.face.extractor.FeatureMatrix(temp_dir, 3)
+    for i in range(20):
+      center = numpy.array([5., 0., 0.]) if i % 4 == 0 else numpy.array([-5., 0., 0.])
+      matrix.write("feature-%d" % i, center + random.randn(50, 3) * numpy.array([1., .5, 2.]))
+
+    # the UBM is trained by streaming the matrix in small chunks
+    trainer = bob.bio.face.algorithm.UBMTrainer(2, chunk_size = 77)
+    ubm = trainer.train(bob.bio.face.extractor.FeatureMatrix(temp_dir, 3))
+    assert isinstance(ubm, bob.learn.em.GMMMachine)
+    assert ubm.shape == (2, 3)
+    order = numpy.argsort(ubm.means[:,0])
+    assert numpy.allclose(ubm.means[order], [[-5., 0., 0.], [5., 0., 0.]], atol = 0.3)
+    assert numpy.allclose(ubm.variances[order], [[1., .25, 4.]] * 2, rtol = 0.3)
+    assert numpy.allclose(ubm.weights[order], [0.75, 0.25])
+
+    # when all rows fit into one chunk, the UBM is identical to the one trained by bob.learn.em as in bob.bio.gmm
+    data = numpy.array(matrix.matrix(), numpy.float64)
+    kmeans = bob.learn.em.KMeansMachine(2, 3)
+    bob.learn.em.train(bob.learn.em.KMeansTrainer(), kmeans, data, 25, 5e-4, rng = bob.core.random.mt19937(5489))
+    variances, weights = kmeans.get_variances_and_weights_for_each_cluster(data)
+    reference = bob.learn.em.GMMMachine(2, 3)
+    reference.means = kmeans.means
+    reference.variances = variances
+    reference.weights = weights
+    reference.set_variance_thresholds(5e-4)
+    bob.learn.em.train(bob.learn.em.ML_GMMTrainer(True, True, True), reference, data, 25, 5e-4)
+    other = bob.bio.face.algorithm.UBMTrainer(2, chunk_size = 1000).train(matrix)
+    assert numpy.allclose(other.means, reference.means)
+    assert numpy.allclose(other.variances, reference.variances)
+    assert numpy.allclose(other.weights, reference.weights)
+    # with smaller chunks, only the initialization differs
+    order = numpy.argsort(reference.means[:,0])
+    assert numpy.allclose(ubm.means[order], reference.means[order], atol = 1e-2)
+    assert numpy.allclose(ubm.weights[order], reference.weights[order], atol = 1e-3)
+
+    # only the rows of the selected features are used
+    ubm = trainer.train(matrix, ["feature-%d" % i for i in range(1, 20, 4)])
+    assert all(ubm.means[:,0] < -4.)
+
+
 def test_bic_jets():
   bic = bob.bio.base.load_resource("bic-jets", "algorithm", preferred_package='bob.bio.face')
   assert isinstance(bic, bob.bio.base.algorithm.BIC)
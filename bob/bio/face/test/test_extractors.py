@@ -28,6 +28,7 @@ from nose.plugins.skip import SkipTest
 
 import bob.io.base.test_utils
 from bob.bio.base.test import utils
+from bob.bio.face.test.utils import temporary_directory
 
 import pkg_resources
 
@@ -65,6 +66,77 @@ def test_dct_blocks():
   reference = pkg_resources.resource_filename('bob.bio.face.test', 'data/dct_blocks.hdf5')
   _compare(feature, reference, dct.write_feature, dct.read_feature)
 
+  # the batch extraction computes identical features for all images
+  features = dct.extract_batch(numpy.array([data, data[:,::-1]]))
+  assert features.shape == (2, 80, 14)
+  _compare(features[0], reference, dct.write_feature, dct.read_feature)
+  assert numpy.allclose(features[1], dct(data[:,::-1].copy()))
+
+  _compare(dct.extract_batch(data[numpy.newaxis], separable = True)[0], reference, dct.write_feature, dct.read_feature)
+
+  # also for dense overlapping blocks, where the separable engine is selected by default
+  for normalize in (True, False):
+    dct = bob.bio.face.extractor.DCTBlocks(12, 11, 45, normalize_blocks = normalize, normalize_dcts = normalize)
+    features = dct.extract_batch(data[numpy.newaxis])
+    assert numpy.allclose(features[0], dct(data))
+    assert numpy.allclose(features, dct.extract_batch(data[numpy.newaxis], separable = False))
+
+  # constant and almost constant blocks are normalized with the same epsilon as in bob.ip.base.DCTFeatures
+  flat = data.copy()
+  flat[:40,:32] = 100.
+  flat[40:,32:] = 100. + numpy.random.RandomState(0).rand(40, 32) * 1e-6
+  normalized = bob.bio.face.extractor.DCTBlocks(12, 11, 45, normalize_dcts = False)
+  for separable in (True, False):
+    assert numpy.allclose(normalized.extract_batch(flat[numpy.newaxis], separable = separable)[0], normalized(flat), rtol = 1e-8, atol = 1e-10)
+
+  # streaming extraction in chunks of bounded size, without and with subsampling
+  chunks = list(dct.extract_chunks([data, data], chunk_size = 1000))
+  assert all(len(chunk) == 1000 for chunk in chunks[:-1])
+  assert numpy.allclose(numpy.vstack(chunks), numpy.vstack([features[0]] * 2))
+  assert numpy.allclose(numpy.vstack(dct.extract_chunks([data], stride = 7)), features[0][::7])
+  chunks = list(dct.extract_chunks([data] * 3, fraction = 0.1, seed = 42))
+  assert sum(len(chunk) for chunk in chunks) == 3 * int(round(len(features[0]) * 0.1))
+  assert numpy.allclose(numpy.vstack(chunks), numpy.vstack(dct.extract_chunks([data] * 3, fraction = 0.1, seed = 42)))
+
+
+def test_feature_matrix():
+  data = _data()
+  with temporary_directory() as temp_dir:
+    dct = bob.bio.face.extractor.DCTBlocks(8, (0,0), 15, feature_matrix = temp_dir)
+    reference = pkg_resources.resource_filename('bob.bio.face.test', 'data/dct_blocks.hdf5')
+    feature = dct(data)
+    files = [os.path.join(temp_dir, 'feature-%d.hdf5' % i) for i in range(3)]
+    for i, feature_file in enumerate(files):
+      dct.write_feature(feature + i, feature_file)
+    # instead of the features, marker files are written, which are kept by the checks of bob.bio.base
+    assert all(bob.bio.base.utils.check_file(feature_file, False, 1000) for feature_file in files)
+
+    # features are stored as float32, and read as float64
+    read = dct.read_feature(files[0])
+    assert read.dtype == numpy.float64
+    _compare(read, reference, atol = 1e-5)
+    assert numpy.allclose(dct.read_feature(files[2]), feature + 2, atol = 1e-5)
+
+    # a new matrix reads the existing data, and streams the rows in chunks
+    matrix = bob.bio.face.extractor.FeatureMatrix(temp_dir, 14)
+    assert len(matrix) == 3
+    assert matrix.matrix().shape == (240, 14)
+    assert matrix.matrix().dtype == numpy.float32
+    chunks = list(matrix.iterate(chunk_size = 100))
+    assert [len(chunk) for chunk in chunks] == [100, 100, 40]
+    chunks = list(matrix.iterate([os.path.abspath(files[1])], chunk_size = 50))
+    assert [len(chunk) for chunk in chunks] == [50, 30]
+    assert numpy.allclose(numpy.vstack(chunks), feature + 1, atol = 1e-5)
+
+    # rewriting a feature overwrites its rows, and features written by other instances are visible
+    dct.write_feature(feature + 5, files[0])
+    assert numpy.allclose(matrix.read(os.path.abspath(files[0])), feature + 5, atol = 1e-5)
+    other = bob.bio.face.extractor.FeatureMatrix(temp_dir, 14)
+    other.write('extra', feature[:10])
+    assert 'extra' in matrix.keys()
+    assert matrix.matrix().shape == (250, 14)
+    assert numpy.allclose(matrix.read('extra'), feature[:10], atol = 1e-5)
+
 
 def test_graphs():
   data = _data()
@@ -90,6 +162,31 @@ def test_graphs():
   assert all(isinstance(f, bob.ip.gabor.Jet) for f in feature)
   assert all(numpy.allclose(r.jet, f.jet) for r,f in zip(reference, feature))
 
+  # evaluating the Gabor wavelets at the nodes only extracts identical jets
+  sparse = bob.bio.face.extractor.GridGraph(node_distance = 24, sparse = True)
+  feature = sparse(data)
+  assert len(reference) == len(feature)
+  assert all(numpy.allclose(r.jet, f.jet) for r,f in zip(reference, feature))
+  assert sparse.trafo_image is None
+
+  # also when the wavelets are split between several threads
+  for sparse in (False, True):
+    threaded = bob.bio.face.extractor.GridGraph(node_distance = 24, sparse = sparse, threads = 3)
+    assert all(numpy.allclose(r.jet, f.jet) for r,f in zip(reference, threaded(data)))
+
+  # integer images, such as LBP codes, are accepted directly
+  codes = bob.bio.base.load_resource('inorm-lbp', 'preprocessor', preferred_package='bob.bio.face')(data)
+  assert codes.dtype == numpy.uint8
+  feature = graph(codes)
+  reference = graph(codes.astype(numpy.float64))
+  assert all(numpy.allclose(r.jet, f.jet) for r,f in zip(reference, feature))
+
+  # features are written atomically, without leaving temporary files behind
+  with temporary_directory() as temp_dir:
+    graph.write_feature(feature, os.path.join(temp_dir, 'graph', 'feature.hdf5'))
+    assert os.listdir(os.path.join(temp_dir, 'graph')) == ['feature.hdf5']
+    assert all(numpy.allclose(r.jet, f.jet) for r,f in zip(graph.read_feature(os.path.join(temp_dir, 'graph', 'feature.hdf5')), feature))
+
 
   # get reference face graph extractor
   cropper = bob.bio.base.load_resource('face-crop-eyes', 'preprocessor', preferred_package='bob.bio.face')
@@ -104,6 +201,7 @@ def test_graphs():
     nodes_below_eyes = 7
   )
 
+  feature = graph(data)
   nodes = graph._extractor(data).nodes
   assert len(nodes) == 100
   assert numpy.allclose(nodes[22], eyes['reye'])
@@ -112,6 +210,10 @@ def test_graphs():
   assert nodes[0] < eyes['reye']
   assert nodes[-1] > eyes['leye']
 
+  # also the aligned graph can be evaluated at its nodes only
+  graph.sparse = True
+  assert all(numpy.allclose(r.jet, f.jet) for r,f in zip(feature, graph(data)))
+
 
 def test_lgbphs():
   data = _data()
@@ -152,6 +254,55 @@ def test_lgbphs():
   reference = pkg_resources.resource_filename('bob.bio.face.test', 'data/lgbphs_with_phase.hdf5')
   _compare(feature, reference, lgbphs.write_feature, lgbphs.read_feature)
 
+  # splitting the wavelets between several threads extracts identical features
+  lgbphs = bob.bio.face.extractor.LGBPHS(
+      block_size = 8,
+      block_overlap = 0,
+      gabor_directions = 4,
+      gabor_scales = 2,
+      gabor_sigma = math.sqrt(2.) * math.pi,
+      use_gabor_phases = True,
+      threads = 3
+  )
+  assert numpy.allclose(lgbphs(data), feature)
+  # each thread re-uses its own LBP extractor in the following calls
+  assert numpy.allclose(lgbphs(data), feature)
+  from bob.bio.face.extractor.LGBPHS import _thread_lbp
+  assert _thread_lbp(lgbphs.lbp_parameters) is _thread_lbp(dict(lgbphs.lbp_parameters))
+
+
+def test_gabor_engine():
+  data = _data()
+  import bob.ip.gabor
+  # the engine is shared by the extractors with the same Gabor parameters
+  graph = bob.bio.face.extractor.GridGraph(node_distance = 24)
+  lgbphs = bob.bio.face.extractor.LGBPHS(block_size = 8)
+  engine = bob.bio.face.extractor.gabor_engine()
+  assert graph.engine is engine
+  assert lgbphs.engine is engine
+  assert bob.bio.face.extractor.LGBPHS(block_size = 8, gabor_scales = 2).engine is not engine
+
+  # the transform is identical to the one of bob.ip.gabor, also for batches of images
+  reference = bob.ip.gabor.Transform().transform(data)
+  assert numpy.allclose(engine.transform(data), reference)
+  trafo_images = engine.transform(numpy.array([data, data[::-1]]))
+  assert trafo_images.shape == (2, 40, 80, 64)
+  assert numpy.allclose(trafo_images[0], reference)
+  assert numpy.allclose(engine.transform(numpy.array([data, data[::-1]]), threads = 4), trafo_images)
+
+  # nested calls from inside the shared pool are executed serially instead of deadlocking
+  nested = bob.bio.face.extractor.map_wavelets(lambda w: bob.bio.face.extractor.map_wavelets(lambda v: list(range(40))[w][v], len(range(40)[w]), 2), 40, 2)
+  assert nested == [[list(range(0, 10)), list(range(10, 20))], [list(range(20, 30)), list(range(30, 40))]]
+  assert numpy.allclose(bob.bio.face.extractor.map_wavelets(lambda w: engine.transform(data, threads = 4)[w], 40, 4)[0], reference[:10])
+
+  # the wavelets can be stored on disk
+  with temporary_directory() as temp_dir:
+    engine = bob.bio.face.extractor.GaborEngine(cache_directory = temp_dir)
+    spectra = engine.spectra(data.shape)
+    assert spectra.shape == (40, 80, 64)
+    assert len(os.listdir(temp_dir)) == 1
+    assert numpy.allclose(bob.bio.face.extractor.GaborEngine(cache_directory = temp_dir).spectra(data.shape), spectra)
+
 
 def test_eigenface():
   temp_file = bob.io.base.test_utils.temporary_filename()
@@ -191,6 +342,98 @@ def test_eigenface():
   _compare(feature, reference, eigen1.write_feature, eigen1.read_feature)
 
 
+def test_feature_shards():
+  data = _data()
+  with temporary_directory() as temp_dir:
+    # store variable size LGBPHS features, Gabor graphs and DCT blocks in the same shards
+    lgbphs = bob.bio.face.extractor.LGBPHS(block_size = 8, block_overlap = 0, gabor_directions = 4, gabor_scales = 2, sparse_histogram = True)
+    graph = bob.bio.face.extractor.GridGraph(node_distance = 24)
+    dct = bob.bio.face.extractor.DCTBlocks(8, (0,0), 15)
+    features = {
+      'lgbphs-1' : lgbphs(data),
+      'lgbphs-2' : lgbphs(data[::-1].copy()),
+      'graph' : graph(data),
+      'dct' : dct(data)
+    }
+    assert features['lgbphs-1'].shape != features['lgbphs-2'].shape or not numpy.allclose(features['lgbphs-1'], features['lgbphs-2'])
+
+    shards = bob.bio.face.extractor.FeatureShards(temp_dir, shard_size = 3)
+    for key in sorted(features):
+      shards.write(key, features[key])
+    shards.flush()
+    assert len(os.listdir(temp_dir)) == 2
+
+    def _check(key, feature):
+      if key == 'graph':
+        assert all(isinstance(f, bob.ip.gabor.Jet) for f in feature)
+        assert all(numpy.allclose(r.jet, f.jet) for r,f in zip(features[key], feature))
+      else:
+        assert feature.shape == features[key].shape
+        assert numpy.allclose(feature, features[key])
+
+    # random access by key of a newly opened container
+    shards = bob.bio.face.extractor.FeatureShards(temp_dir)
+    assert len(shards) == 4
+    for key in features:
+      _check(key, shards.read(key))
+    # sequential read of all features
+    read = dict(shards.iterate())
+    assert sorted(read) == sorted(features)
+    for key in read:
+      _check(key, read[key])
+
+    # rewriting a feature replaces it, also for newly opened containers
+    assert shards.write('dct', features['dct'] + 1.) == []
+    assert shards.flush() == ['dct']
+    assert len(shards) == 4
+    assert len(os.listdir(temp_dir)) == 3
+    assert numpy.allclose(shards.read('dct'), features['dct'] + 1.)
+    shards = bob.bio.face.extractor.FeatureShards(temp_dir)
+    assert numpy.allclose(shards.read('dct'), features['dct'] + 1.)
+    read = dict(shards.iterate())
+    assert len(read) == 4
+    assert numpy.allclose(read['dct'], features['dct'] + 1.)
+
+    # the sharded extractor writes and reads features by file name
+    extractor = bob.bio.face.extractor.ShardedExtractor(dct, os.path.join(temp_dir, 'dct'))
+    assert isinstance(extractor, bob.bio.base.extractor.Extractor)
+    feature_file = os.path.join(temp_dir, 'dct-feature.hdf5')
+    extractor.write_feature(extractor(data), feature_file)
+    assert not os.path.exists(feature_file)
+    extractor.flush()
+    # a marker file is written when the feature is stored on disk, which is kept by the checks of bob.bio.base
+    assert bob.bio.base.utils.check_file(feature_file, False, 1000)
+    assert numpy.allclose(extractor.read_feature(feature_file), features['dct'])
+
+    # a forced rerun replaces the feature and rewrites the marker
+    extractor = bob.bio.face.extractor.ShardedExtractor(dct, os.path.join(temp_dir, 'dct'))
+    assert not bob.bio.base.utils.check_file(feature_file, True, 1000)
+    extractor.write_feature(features['dct'] * 2., feature_file)
+    extractor.flush()
+    assert bob.bio.base.utils.check_file(feature_file, False, 1000)
+    assert numpy.allclose(extractor.read_feature(feature_file), features['dct'] * 2.)
+
+
+def test_cached_extractor():
+  data = _data()
+  with temporary_directory() as temp_dir:
+    extractor = bob.bio.face.extractor.CachedExtractor(bob.bio.face.extractor.DCTBlocks(8, (0,0), 15), temp_dir)
+    assert isinstance(extractor, bob.bio.base.extractor.Extractor)
+    assert not extractor.requires_training
+    reference = pkg_resources.resource_filename('bob.bio.face.test', 'data/dct_blocks.hdf5')
+    _compare(extractor(data), reference, extractor.write_feature, extractor.read_feature)
+
+    # the same feature is taken from the cache, even by a new extractor
+    extractor = bob.bio.face.extractor.CachedExtractor(bob.bio.face.extractor.DCTBlocks(8, (0,0), 15), temp_dir)
+    _compare(extractor(data), reference, extractor.write_feature, extractor.read_feature)
+    assert extractor.cache.hits == 1 and extractor.cache.misses == 0
+
+    # extractors with a different configuration compute their own features
+    extractor = bob.bio.face.extractor.CachedExtractor(bob.bio.face.extractor.DCTBlocks(8, (0,0), 10), temp_dir)
+    assert extractor(data).shape == (80, 9)
+    assert extractor.cache.misses == 1
+
+
 """
   def test05_sift_key_points(self):
     # check if VLSIFT is available
@@ -20,6 +20,8 @@
 
 import unittest
 import os
+import math
+import multiprocessing.pool
 import numpy
 
 from nose.plugins.skip import SkipTest
@@ -31,6 +33,9 @@ regenerate_refs = False
 import bob.bio.base
 import bob.bio.face
 import bob.db.verification.utils
+import bob.io.base.test_utils
+
+from bob.bio.face.test.utils import temporary_directory
 
 
 def _compare(data, reference, write_function = bob.bio.base.save, read_function = bob.bio.base.load, atol = 1e-5, rtol = 1e-8):
@@ -127,12 +132,40 @@ def test_face_detect():
   _compare(cropper(image, annotation), reference, cropper.write_data, cropper.read_data)
   assert abs(cropper.quality - 33.1136586) < 1e-5
 
+  # the gray level uint8 image for detection is written into re-used buffers
+  gray = cropper._detection_image(image)
+  assert numpy.all(gray == bob.ip.color.rgb_to_gray(image))
+  assert cropper._detection_image(image.astype(numpy.float64)) is gray
+  assert cropper._detection_image(gray) is gray
+
   # execute face detector with flandmark
   cropper = bob.bio.face.preprocessor.FaceDetect(face_cropper='face-crop-eyes', use_flandmark=True)
   reference = pkg_resources.resource_filename('bob.bio.face.test', 'data/flandmark.hdf5')
   _compare(cropper(image, annotation), reference, cropper.write_data, cropper.read_data)
   assert abs(cropper.quality - 33.1136586) < 1e-5
 
+  # detect all faces in the image
+  cropper = bob.bio.face.preprocessor.FaceDetect(face_cropper='face-crop-eyes', multiple_faces=True)
+  faces = cropper(image, annotation)
+  assert faces.ndim == 3
+  assert faces.shape[0] >= 1
+  assert faces.shape[1:] == (80, 64)
+  assert len(cropper.bounding_boxes) == len(cropper.qualities) == len(cropper.eye_positions) == faces.shape[0]
+  assert all(cropper.qualities[i] >= cropper.qualities[i+1] for i in range(len(cropper.qualities)-1))
+  # the best detection is the one of the single face detector
+  bounding_box, _ = bob.ip.facedetect.detect_single_face(bob.ip.color.rgb_to_gray(image), cropper.cascade, cropper.sampler, cropper.detection_overlap)
+  assert cropper.bounding_boxes[0].similarity(bounding_box) > 0.8
+
+  # landmark localization in a down-scaled face patch
+  gray, quality = bob.ip.color.rgb_to_gray(image), cropper.qualities[0]
+  eyes = bob.bio.face.preprocessor.FaceDetect(face_cropper='face-crop-eyes', use_flandmark=True)._landmarks(gray, bounding_box)
+  cropper = bob.bio.face.preprocessor.FaceDetect(face_cropper='face-crop-eyes', use_flandmark=True, landmark_patch_size=(100,100))
+  patch_eyes = cropper._landmarks(gray, bounding_box)
+  assert all(numpy.allclose(eyes[k], patch_eyes[k], atol=5.) for k in ('reye', 'leye'))
+  # landmark localization is skipped for good detections
+  cropper = bob.bio.face.preprocessor.FaceDetect(face_cropper='face-crop-eyes', use_flandmark=True, landmark_quality_threshold=quality)
+  assert cropper._landmarks(gray, bounding_box, quality) == bob.ip.facedetect.expected_eye_positions(bounding_box)
+
   # execute face detector with tan-triggs
   cropper = bob.bio.face.preprocessor.TanTriggs(face_cropper='landmark-detect')
   preprocessed = cropper(image, annotation)
@@ -143,6 +176,36 @@ def test_face_detect():
   assert numpy.allclose(preprocessed, reference, atol=1e-5)
 
 
+def test_cascade_detector():
+  gray = bob.ip.color.rgb_to_gray(_image())
+
+  # the vectorized detector must find the same face as bob.ip.facedetect
+  detector = bob.bio.face.preprocessor.CascadeDetector()
+  cascade, sampler = bob.ip.facedetect.default_cascade(), bob.ip.facedetect.Sampler(scale_factor=math.pow(2., -1./16.), lowest_scale=0.125, distance=2)
+  bounding_box, quality = detector.detect_single_face(gray)
+  reference_box, reference_quality = bob.ip.facedetect.detect_single_face(gray, cascade, sampler)
+  assert bounding_box.similarity(reference_box) > 0.99
+  assert abs(quality - reference_quality) < 1e-5
+
+  # the predictions of all bounding boxes are identical
+  boxes, predictions = detector.predictions(gray)
+  reference = [(prediction, bb) for prediction, bb in sampler.iterate_cascade(cascade, gray, None)]
+  assert len(reference) == len(predictions)
+  assert numpy.allclose(sorted(predictions), sorted(p for p, _ in reference))
+
+  # the face detector uses the vectorized detector
+  cropper = bob.bio.face.preprocessor.FaceDetect(face_cropper='face-crop-eyes', vectorized_detection=True)
+  assert isinstance(cropper.detector, bob.bio.face.preprocessor.CascadeDetector)
+  reference = pkg_resources.resource_filename('bob.bio.face.test', 'data/detected.hdf5')
+  _compare(cropper(_image()), reference, cropper.write_data, cropper.read_data)
+  assert abs(cropper.quality - 33.1136586) < 1e-5
+
+  # multiple faces are found, too
+  bounding_boxes, qualities = detector.detect_all_faces(gray)
+  assert len(bounding_boxes) >= 1
+  assert bounding_boxes[0].similarity(reference_box) > 0.8
+
+
 def test_tan_triggs():
   # read input
   image, annotation = _image(), _annotation()
@@ -156,6 +219,13 @@ def test_tan_triggs():
   # execute face cropper
   _compare(preprocessor(image, annotation), pkg_resources.resource_filename('bob.bio.face.test', 'data/tan_triggs_cropped.hdf5'), preprocessor.write_data, preprocessor.read_data)
 
+  # batch processing of several crops gives the same results
+  cropped = bob.bio.base.load(pkg_resources.resource_filename('bob.bio.face.test', 'data/cropped.hdf5'))
+  batch = preprocessor.enhance_batch(numpy.array([cropped, cropped[:,::-1]]))
+  assert batch.shape == (2,) + cropped.shape
+  assert numpy.allclose(batch[0], preprocessor.tan_triggs(cropped))
+  assert numpy.allclose(batch[1], preprocessor.tan_triggs(cropped[:,::-1].copy()))
+
   # test the preprocessor without cropping
   preprocessor = bob.bio.base.load_resource('tan-triggs', 'preprocessor', preferred_package='bob.bio.face')
   assert preprocessor.cropper is None
@@ -178,6 +248,22 @@ def test_inorm_lbp():
   assert isinstance(preprocessor.cropper, bob.bio.face.preprocessor.FaceCrop)
   # execute preprocessor
   _compare(preprocessor(image, annotation), pkg_resources.resource_filename('bob.bio.face.test', 'data/inorm_lbp_cropped.hdf5'), preprocessor.write_data, preprocessor.read_data)
+  # LBP codes are stored as integers
+  assert preprocessor(image, annotation).dtype == numpy.uint8
+
+  # batch processing gives identical codes
+  cropped = bob.bio.base.load(pkg_resources.resource_filename('bob.bio.face.test', 'data/cropped.hdf5'))
+  reference = bob.bio.base.load(pkg_resources.resource_filename('bob.bio.face.test', 'data/inorm_lbp_cropped.hdf5'))
+  batch = preprocessor.enhance_batch(numpy.array([cropped, cropped[:,::-1]]))
+  assert batch.dtype == numpy.uint16
+  assert numpy.array_equal(batch[0], reference)
+  assert numpy.array_equal(batch[1], preprocessor.enhance(cropped[:,::-1].copy()))
+  # other LBP variants
+  for is_circular in (True, False):
+    for elbp_type in ('regular', 'transitional', 'direction-coded'):
+      for compare_to_average in (False, True):
+        lbp = bob.bio.face.preprocessor.INormLBP(face_cropper = None, is_circular = is_circular, elbp_type = elbp_type, compare_to_average = compare_to_average)
+        assert numpy.array_equal(lbp.enhance_batch(cropped[None,:,:])[0], lbp.enhance(cropped))
 
   # load the preprocessor without cropping
   preprocessor = bob.bio.base.load_resource('inorm-lbp', 'preprocessor', preferred_package='bob.bio.face')
@@ -199,6 +285,15 @@ def test_heq():
   # execute preprocessor
   _compare(preprocessor(image, annotation), pkg_resources.resource_filename('bob.bio.face.test', 'data/histogram_cropped.hdf5'), preprocessor.write_data, preprocessor.read_data)
 
+  # batch processing reproduces the reference exactly
+  cropped = bob.bio.base.load(pkg_resources.resource_filename('bob.bio.face.test', 'data/cropped.hdf5'))
+  reference = bob.bio.base.load(pkg_resources.resource_filename('bob.bio.face.test', 'data/histogram_cropped.hdf5'))
+  batch = preprocessor.enhance_batch(numpy.array([cropped, cropped[::-1], cropped / 2.]))
+  assert batch.shape == (3,) + cropped.shape
+  assert numpy.all(batch[0] == reference)
+  assert numpy.all(batch[1] == reference[::-1])
+  assert numpy.all(batch[2] == preprocessor.enhance(cropped / 2.))
+
   # load the preprocessor without cropping
   preprocessor = bob.bio.base.load_resource('histogram', 'preprocessor', preferred_package='bob.bio.face')
   assert preprocessor.cropper is None
@@ -219,9 +314,347 @@ def test_sqi():
   # execute preprocessor
   _compare(preprocessor(image, annotation), pkg_resources.resource_filename('bob.bio.face.test', 'data/self_quotient_cropped.hdf5'), preprocessor.write_data, preprocessor.read_data)
 
+  # the fast approximation stays within the documented error bounds
+  reference = bob.bio.base.load(pkg_resources.resource_filename('bob.bio.face.test', 'data/self_quotient_cropped.hdf5'))
+  cropped = bob.bio.base.load(pkg_resources.resource_filename('bob.bio.face.test', 'data/cropped.hdf5'))
+  approximation = bob.bio.face.preprocessor.SelfQuotientImage(face_cropper = 'face-crop-eyes', approximate = True)
+  difference = numpy.abs(approximation(image, annotation) - reference)
+  assert numpy.mean(difference) < 0.01
+  assert numpy.percentile(difference, 95) < 0.032
+  # only the exact algorithm is batched by the pipeline
+  assert preprocessor.exact_batch
+  assert not approximation.exact_batch
+  batch = approximation.enhance_batch(numpy.array([cropped, cropped[::-1]]))
+  assert numpy.allclose(batch[0], approximation.enhance(cropped))
+  assert numpy.allclose(batch[1], approximation.enhance(cropped[::-1]))
+  # without approximation, the batch is identical to the reference
+  assert numpy.allclose(preprocessor.enhance_batch(numpy.array([cropped]))[0], reference)
+
   # load the preprocessor without cropping
   preprocessor = bob.bio.base.load_resource('self-quotient', 'preprocessor', preferred_package='bob.bio.face')
   assert preprocessor.cropper is None
   # load the preprocessor landmark detection
   preprocessor = bob.bio.base.load_resource('self-quotient-landmark', 'preprocessor', preferred_package='bob.bio.face')
   assert isinstance(preprocessor.cropper, bob.bio.face.preprocessor.FaceDetect)
+
+
+def test_pipeline():
+  # read input
+  image, annotation = _image(), _annotation()
+
+  preprocessor = bob.bio.base.load_resource('tan-triggs-pipeline', 'preprocessor', preferred_package='bob.bio.face')
+  assert isinstance(preprocessor, bob.bio.face.preprocessor.Pipeline)
+  assert isinstance(preprocessor, bob.bio.face.preprocessor.Base)
+  assert isinstance(preprocessor, bob.bio.base.preprocessor.Preprocessor)
+  assert [kind for kind, _ in preprocessor.stages] == ['crop', 'enhance']
+
+  # the pipeline gives the same results as the Tan&Triggs preprocessor, also when the buffers are re-used
+  reference = pkg_resources.resource_filename('bob.bio.face.test', 'data/tan_triggs_cropped.hdf5')
+  first = _compare(preprocessor(image, annotation), reference, preprocessor.write_data, preprocessor.read_data)
+  second = preprocessor(image, annotation)
+  assert numpy.allclose(first, second)
+  # the batch path gives the same results
+  batch = preprocessor.process_batch([image, image], [annotation, annotation])
+  assert len(batch) == 2
+  assert all(numpy.allclose(face, first) for face in batch)
+
+  # a preprocessor that contains a face cropper is split into two stages; several enhancement stages can share buffers
+  preprocessor = bob.bio.face.preprocessor.Pipeline(['histogram-crop', 'tan-triggs', 'histogram'])
+  assert [kind for kind, _ in preprocessor.stages] == ['crop', 'enhance', 'enhance', 'enhance']
+  heq = bob.bio.base.load_resource('histogram', 'preprocessor', preferred_package='bob.bio.face')
+  tan_triggs = bob.bio.base.load_resource('tan-triggs', 'preprocessor', preferred_package='bob.bio.face')
+  cropped = bob.bio.base.load(pkg_resources.resource_filename('bob.bio.face.test', 'data/cropped.hdf5'))
+  expected = heq.enhance(tan_triggs.enhance(heq.enhance(cropped)))
+  for _ in range(2):
+    assert numpy.allclose(preprocessor(image, annotation), expected)
+  plan = list(preprocessor._plans.values())[0]
+  assert plan[1][1] is plan[3][1]
+  assert plan[2][1] is not plan[1][1]
+
+  # functions that return views of their input buffer do not get their results overwritten
+  preprocessor = bob.bio.face.preprocessor.Pipeline(['histogram-crop', numpy.fliplr, 'tan-triggs', 'histogram'])
+  expected = heq.enhance(tan_triggs.enhance(numpy.fliplr(heq.enhance(cropped))))
+  for _ in range(3):
+    assert numpy.allclose(preprocessor(image, annotation), expected)
+  plan = list(preprocessor._plans.values())[0]
+  assert plan[4][1] is not plan[1][1]
+
+  # the configuration contains the names of the stages, but no object addresses
+  assert 'numpy.fliplr' in str(preprocessor)
+  assert str(preprocessor) == str(bob.bio.face.preprocessor.Pipeline(['histogram-crop', numpy.fliplr, 'tan-triggs', 'histogram']))
+
+
+def test_crop_cache():
+  # read input
+  image, annotation = _image(), _annotation()
+  reference = pkg_resources.resource_filename('bob.bio.face.test', 'data/cropped.hdf5')
+
+  cache = bob.bio.face.preprocessor.CropCache('face-crop-eyes')
+  assert isinstance(cache.cropper, bob.bio.face.preprocessor.FaceCrop)
+  gray = bob.ip.color.rgb_to_gray(image)
+  _compare(cache.crop_face(gray, annotation), reference)
+  _compare(cache.crop_face(gray, annotation), reference)
+  assert cache.misses == 1
+  assert cache.hits == 1
+
+  # different photometric preprocessors share the crops of identically configured croppers
+  tan_triggs = bob.bio.face.preprocessor.TanTriggs(face_cropper = bob.bio.face.preprocessor.utils.load_cropper('face-crop-eyes', cache = True))
+  heq = bob.bio.face.preprocessor.HistogramEqualization(face_cropper = bob.bio.face.preprocessor.CropCache('face-crop-eyes'))
+  _compare(tan_triggs(image, annotation), pkg_resources.resource_filename('bob.bio.face.test', 'data/tan_triggs_cropped.hdf5'))
+  _compare(heq(image, annotation), pkg_resources.resource_filename('bob.bio.face.test', 'data/histogram_cropped.hdf5'))
+  assert tan_triggs.cropper.misses == heq.cropper.misses == 0
+
+  # different annotations give different crops
+  other = {'reye' : annotation['leye'], 'leye' : annotation['reye']}
+  cache.crop_face(gray, other)
+  assert cache.misses == 2
+
+  # crops can be stored on disk
+  with temporary_directory() as temp_dir:
+    small = bob.bio.face.preprocessor.FaceCrop(cropped_image_size = (20, 16), cropped_positions = {'leye' : (5, 12), 'reye' : (5, 3)})
+    cache = bob.bio.face.preprocessor.CropCache(small, max_size = 0, cache_directory = temp_dir)
+    first = cache.crop_face(gray, annotation)
+    second = cache.crop_face(gray, annotation)
+    assert cache.misses == 1
+    assert cache.hits == 1
+    assert numpy.allclose(first, second)
+    assert not [f for d, _, files in os.walk(temp_dir) for f in files if '.tmp' in f]
+
+  # caches of other configurations, and smaller caches of the same configuration, do not evict the stored crops
+  cache = bob.bio.face.preprocessor.CropCache('face-crop-eyes', max_size = 0)
+  _compare(cache.crop_face(gray, annotation), reference)
+  assert cache.misses == 0
+
+  # the largest size of the existing instances applies
+  large = bob.bio.face.preprocessor.CropCache(small, max_size = 10)
+  limited = bob.bio.face.preprocessor.CropCache(small, max_size = 1)
+  large.crop_face(gray, annotation)
+  large.crop_face(gray, other)
+  assert len(limited._memory.faces) == 2
+  del large
+  limited.crop_face(gray * 0.5, annotation)
+  assert len(limited._memory.faces) == 1
+
+  # several threads can use the same cache
+  images = [gray + i for i in range(8)]
+  threaded = bob.bio.face.preprocessor.CropCache(small, max_size = 4)
+  crops = multiprocessing.pool.ThreadPool(4).map(lambda i : threaded.crop_face(images[i % 8], annotation), range(64))
+  assert all(numpy.allclose(crop, small.crop_face(images[i % 8], annotation)) for i, crop in enumerate(crops))
+  assert len(threaded._memory.faces) == 4
+
+
+def test_photometric_variants():
+  # read input
+  image, annotation = _image(), _annotation()
+
+  preprocessor = bob.bio.base.load_resource('photometric-variants', 'preprocessor', preferred_package='bob.bio.face')
+  assert isinstance(preprocessor, bob.bio.face.preprocessor.PhotometricVariants)
+  assert isinstance(preprocessor, bob.bio.face.preprocessor.Base)
+  assert isinstance(preprocessor, bob.bio.base.preprocessor.Preprocessor)
+  assert isinstance(preprocessor.cropper, bob.bio.face.preprocessor.FaceCrop)
+
+  # all variants are identical to the results of the single preprocessors
+  variants = preprocessor(image, annotation)
+  references = {'tan-triggs' : 'tan_triggs_cropped', 'self-quotient' : 'self_quotient_cropped', 'histogram' : 'histogram_cropped', 'inorm-lbp' : 'inorm_lbp_cropped'}
+  assert sorted(variants) == sorted(references)
+  for name in references:
+    assert numpy.allclose(variants[name], bob.bio.base.load(pkg_resources.resource_filename('bob.bio.face.test', 'data/%s.hdf5' % references[name])), atol=1e-5)
+
+  # all variants are written into one file, and can be read selectively
+  filename = bob.io.base.test_utils.temporary_filename()
+  try:
+    preprocessor.write_data(variants, filename)
+    read = preprocessor.read_data(filename)
+    assert sorted(read) == sorted(variants)
+    assert all(numpy.allclose(read[name], variants[name]) for name in variants)
+    assert sorted(preprocessor.read_data(filename, ['histogram', 'inorm-lbp'])) == ['histogram', 'inorm-lbp']
+    selective = bob.bio.face.preprocessor.PhotometricVariants('face-crop-eyes', read_variants = 'tan-triggs')
+    assert numpy.allclose(selective.read_data(filename), variants['tan-triggs'])
+  finally:
+    os.remove(filename)
+
+
+def test_color_enhancement():
+  # read input
+  image, annotation = _image(), _annotation()
+  cropper = bob.bio.face.preprocessor.FaceCrop(cropped_image_size = (80, 64), cropped_positions = {'leye' : (16, 48), 'reye' : (16, 15)}, color_channel = 'rgb')
+  cropped = cropper(image, annotation)
+  assert cropped.shape == (3, 80, 64)
+
+  # all channels of color crops are enhanced independently
+  for preprocessor in (
+      bob.bio.face.preprocessor.TanTriggs(face_cropper = cropper, color_channel = 'rgb'),
+      bob.bio.face.preprocessor.HistogramEqualization(face_cropper = cropper, color_channel = 'rgb'),
+      bob.bio.face.preprocessor.SelfQuotientImage(face_cropper = cropper, color_channel = 'rgb'),
+      bob.bio.face.preprocessor.SelfQuotientImage(face_cropper = cropper, color_channel = 'rgb', approximate = True)
+  ):
+    enhanced = preprocessor(image, annotation)
+    assert enhanced.shape == (3, 80, 64)
+    for c in range(3):
+      assert numpy.allclose(enhanced[c], preprocessor.enhance(cropped[c].copy()))
+
+
+def test_packed_store():
+  # read input
+  image, annotation = _image(), _annotation()
+  reference = pkg_resources.resource_filename('bob.bio.face.test', 'data/cropped.hdf5')
+
+  with temporary_directory() as temp_dir:
+    preprocessor = bob.bio.face.preprocessor.PackedPreprocessor('face-crop-eyes', os.path.join(temp_dir, 'store'), shape = (80, 64), shard_size = 2)
+    assert isinstance(preprocessor, bob.bio.base.preprocessor.Preprocessor)
+    cropped = _compare(preprocessor(image, annotation), reference)
+
+    # write several faces, which are distributed over several shards
+    files = [os.path.join(temp_dir, 'face-%d.hdf5' % i) for i in range(5)]
+    for i, data_file in enumerate(files):
+      preprocessor.write_data(cropped + i, data_file)
+    assert len(preprocessor.store) == 5
+    # the marker files are kept by the checks for existing files of bob.bio.base
+    assert all(bob.bio.base.utils.check_file(data_file, False, 1000) for data_file in files)
+    assert all(numpy.allclose(preprocessor.read_data(data_file), cropped + i) for i, data_file in enumerate(files))
+
+    # the faces are read from the memory-mapped shards without copying
+    data = preprocessor.read_data(files[3])
+    assert not data.flags.writeable
+    assert not data.flags.owndata
+
+    # a new store reads the existing shards
+    preprocessor.store.close()
+    store = bob.bio.face.preprocessor.PackedStore(os.path.join(temp_dir, 'store'), (80, 64))
+    assert os.path.abspath(files[4]) in store
+    assert numpy.allclose(store.read(os.path.abspath(files[4])), cropped + 4)
+
+    # parallel processes write into their own shards of the same store
+    import multiprocessing
+    processes = [multiprocessing.Process(target = _write_packed, args = (os.path.join(temp_dir, 'store'), p, cropped)) for p in range(2)]
+    for process in processes: process.start()
+    for process in processes: process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    assert len(store.keys()) == 11
+    for p in range(2):
+      for i in range(3):
+        assert numpy.allclose(store.read('process-%d-%d' % (p, i)), cropped + 10 * p + i)
+    assert len(store) == 11
+
+
+def _write_packed(directory, process, cropped):
+  store = bob.bio.face.preprocessor.PackedStore(directory, (80, 64), shard_size = 2)
+  for i in range(3):
+    store.write('process-%d-%d' % (process, i), cropped + 10 * process + i)
+  store.close()
+
+
+def test_stage_cache():
+  # read input
+  image, annotation = _image(), _annotation()
+  reference = pkg_resources.resource_filename('bob.bio.face.test', 'data/cropped.hdf5')
+
+  with temporary_directory() as temp_dir:
+    cache_directory = os.path.join(temp_dir, 'cache')
+    preprocessor = bob.bio.face.preprocessor.CachedPreprocessor('face-crop-eyes', cache_directory)
+    assert isinstance(preprocessor, bob.bio.base.preprocessor.Preprocessor)
+    cropped = _compare(preprocessor(image, annotation), reference)
+    assert preprocessor.cache.misses == 1
+
+    # a second experiment with the same configuration re-uses the cached face
+    other = bob.bio.face.preprocessor.CachedPreprocessor(bob.bio.face.preprocessor.FaceCrop(cropped_image_size = (80, 64), cropped_positions = {'leye' : (16, 48), 'reye' : (16, 15)}), cache_directory)
+    assert numpy.allclose(other(image, annotation), cropped)
+    assert other.cache.hits == 1 and other.cache.misses == 0
+
+    # a different configuration, or different annotations, are not taken from the cache
+    other = bob.bio.face.preprocessor.CachedPreprocessor(bob.bio.face.preprocessor.FaceCrop(cropped_image_size = (80, 64), cropped_positions = {'leye' : (16, 48), 'reye' : (16, 16)}), cache_directory)
+    other(image, annotation)
+    preprocessor(image, {'leye' : annotation['leye'], 'reye' : (annotation['reye'][0], annotation['reye'][1] + 1)})
+    assert other.cache.misses == 1
+    assert preprocessor.cache.misses == 2
+
+    # limit the size of the cache, so that only two faces fit below the low-water mark
+    key = bob.bio.face.preprocessor.content_hash(preprocessor.preprocessor, image, annotation)
+    size = os.path.getsize(preprocessor.cache.filename(key))
+    cache = bob.bio.face.preprocessor.StageCache(cache_directory, max_size = int(2.5 * size))
+    # mark the first face as recently used
+    assert numpy.allclose(cache.read(key, bob.bio.base.load), cropped)
+    cache.evict()
+    files = [f for _, f, _ in cache._files()]
+    assert len(files) == 2
+    assert key in cache
+
+  # the hashes are computed from canonical representations
+  content_hash = bob.bio.face.preprocessor.content_hash
+  cropper = bob.bio.face.preprocessor.FaceCrop(cropped_image_size = (80, 64), cropped_positions = {'leye' : (16, 48), 'reye' : (16, 15)})
+  assert content_hash(cropper) == content_hash(bob.bio.face.preprocessor.FaceCrop(cropped_image_size = (80, 64), cropped_positions = {'reye' : (16, 15), 'leye' : (16, 48)}))
+  assert content_hash(cropper) == content_hash(bob.bio.face.preprocessor.CropCache(cropper))
+  assert content_hash({'a' : 1, 'b' : 2.}) == content_hash({'b' : 2., 'a' : 1})
+  assert content_hash(numpy.zeros((2,3))) != content_hash(numpy.zeros((3,2)))
+  assert content_hash(numpy.zeros(2)) != content_hash(numpy.zeros(2, numpy.float32))
+  assert content_hash(1) != content_hash(1.) != content_hash('1')
+  assert content_hash(numpy.fliplr) != content_hash(numpy.flipud)
+  for unstable in (object(), lambda x : x, numpy.array([None])):
+    try:
+      content_hash(unstable)
+      assert False
+    except TypeError:
+      pass
+
+
+def test_journal():
+  image_file = pkg_resources.resource_filename('bob.bio.face.test', 'data/testimage.jpg')
+  annotation = _annotation()
+  reference = pkg_resources.resource_filename('bob.bio.face.test', 'data/cropped.hdf5')
+
+  with temporary_directory() as temp_dir:
+    # records are kept across journal instances, and incomplete lines are ignored
+    journal = bob.bio.face.preprocessor.Journal(os.path.join(temp_dir, 'journal'))
+    journal.record('first', 'value')
+    journal.record('second')
+    with open(os.path.join(temp_dir, 'journal', 'interrupted.journal'), 'w') as f:
+      f.write('third\tincomplete')
+    journal = bob.bio.face.preprocessor.Journal(os.path.join(temp_dir, 'journal'))
+    assert len(journal) == 2
+    assert journal.get('first') == 'value'
+    assert 'second' in journal and 'third' not in journal
+
+    # atomic writes do not leave temporary files behind, also when writing fails
+    cropper = bob.bio.base.load_resource('face-crop-eyes', 'preprocessor', preferred_package='bob.bio.face')
+    data_file = os.path.join(temp_dir, 'data', 'face.hdf5')
+    cropper.write_data(cropper(_image(), annotation), data_file)
+    _compare(cropper.read_data(data_file), reference)
+    def _fail(data, filename):
+      bob.io.base.save(data, filename)
+      raise RuntimeError("interrupted")
+    try:
+      bob.bio.face.preprocessor.atomic_write(_fail, numpy.zeros((2,2)), os.path.join(temp_dir, 'data', 'failed.hdf5'))
+      assert False
+    except RuntimeError:
+      pass
+    assert os.listdir(os.path.join(temp_dir, 'data')) == ['face.hdf5']
+
+    # several threads can write the same file at the same time
+    shared_file = os.path.join(temp_dir, 'shared', 'data.hdf5')
+    multiprocessing.pool.ThreadPool(4).map(lambda i : bob.bio.face.preprocessor.atomic_write(bob.io.base.save, numpy.full((2,2), i), shared_file), range(32))
+    assert bob.io.base.load(shared_file)[0,0] in range(32)
+    assert os.listdir(os.path.dirname(shared_file)) == ['data.hdf5']
+
+    # a restarted run takes the preprocessed faces from the cache, without reading the original image
+    cache_directory = os.path.join(temp_dir, 'cache')
+    preprocessor = bob.bio.face.preprocessor.CachedPreprocessor('face-crop-eyes', cache_directory)
+    _compare(preprocessor(preprocessor.read_original_data(image_file), annotation), reference)
+    preprocessor = bob.bio.face.preprocessor.CachedPreprocessor('face-crop-eyes', cache_directory)
+    data = preprocessor.read_original_data(image_file)
+    assert not isinstance(data, numpy.ndarray)
+    _compare(preprocessor(data, annotation), reference)
+    assert preprocessor.cache.hits == 1
+
+    # changed annotations require the original image to be read again
+    preprocessor(preprocessor.read_original_data(image_file), {'leye' : annotation['leye'], 'reye' : (annotation['reye'][0], annotation['reye'][1] + 1)})
+    assert preprocessor.cache.misses == 1
+
+    # stale temporary files of killed processes are removed when the journal is opened, while recent ones are kept
+    stale, recent = os.path.join(cache_directory, 'ab', 'key.123.tmp.hdf5'), os.path.join(cache_directory, 'ab', 'other.456-789.tmp.hdf5')
+    bob.io.base.create_directories_safe(os.path.dirname(stale))
+    for filename in (stale, recent):
+      open(filename, 'w').close()
+    os.utime(stale, (0, 0))
+    bob.bio.face.preprocessor.CachedPreprocessor('face-crop-eyes', cache_directory)
+    assert not os.path.exists(stale)
+    assert os.path.exists(recent)
@@ -14,6 +14,22 @@ def test_baselines():
       main(parameters)
       parameters.extend(['-e', 'HTER'])
       main(parameters)
+      # wrap all stages into caches
+      main(['-d', database, '--dry-run', '--cache-directory', 'cache'])
+
+    # the cached stages are passed to the script, but the recomputation is not forced
+    import subprocess
+    commands = []
+    call = subprocess.call
+    subprocess.call = commands.append
+    try:
+      main(['-d', 'atnt', '--cache-directory', 'cache'])
+    finally:
+      subprocess.call = call
+    assert len(commands) == 1
+    assert commands[0][commands[0].index('--preprocessor') + 1] == "bob.bio.face.preprocessor.CachedPreprocessor('base', 'cache')"
+    assert commands[0][commands[0].index('--algorithm') + 1].startswith("bob.bio.face.algorithm.CachedAlgorithm(")
+    assert '--force' not in commands[0]
 
     for algorithm in all_algorithms:
       parameters = ['-a', algorithm, '--dry-run']
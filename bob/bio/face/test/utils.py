@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import contextlib
+import shutil
+import tempfile
+
+
+@contextlib.contextmanager
+def temporary_directory():
+  """Creates a temporary directory for a test, which is removed with all its content afterward."""
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    yield temp_dir
+  finally:
+    shutil.rmtree(temp_dir)
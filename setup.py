@@ -142,6 +142,9 @@ setup(
         'tan-triggs        = bob.bio.face.config.preprocessor.tan_triggs:preprocessor_no_crop', # Tan&Triggs w/o face-crop
         'histogram         = bob.bio.face.config.preprocessor.histogram_equalization:preprocessor_no_crop', # histogram equalization w/o face-crop
         'self-quotient     = bob.bio.face.config.preprocessor.self_quotient_image:preprocessor_no_crop', # self quotient image w/o face-crop
+
+        'tan-triggs-pipeline = bob.bio.face.config.preprocessor.pipeline:preprocessor', # face crop + Tan&Triggs as fused pipeline
+        'photometric-variants = bob.bio.face.config.preprocessor.photometric_variants:preprocessor', # face crop + all photometric enhancements in one file
       ],
 
       'bob.bio.extractor': [